@@ -1,54 +1,134 @@
 #!/usr/bin/env python3
 import os.path
+import sys
 
+import archive
+import daemon
 import downloader
+import duplicates
+import instrumentation
 import minifier
+import pipeline
+import spatialindex
 import storage
-from common import logger, config
+from common import logger, config, load_config
 import ftpuploader
 import mapgenerator
+from pipeline import Stage, fingerprint_file, fingerprint_directory, fingerprint_config, fingerprint_values, fingerprint_code
 
 
 # ##########################################################
 # Main program
 # ##########################################################
 
+load_config()
+if config["mode"]["daemon"] == "ON":
+    daemon.run_daemon()
+    sys.exit(0)
+
+instrumentation.start_run()
+
 output_map_filename = config["output"]["map-filename"]
 output_map_minified_filename = config["output"]["map-minified-filename"]
+output_data_directory = os.path.join(os.path.dirname(output_map_filename), 'data')
+templates_directory = os.path.join(os.path.dirname(__file__), 'templates')
 config_mode = config["mode"]
+upload_filename = output_map_minified_filename if config_mode["minifier"] == "ON" else output_map_filename
 
-if config_mode["downloader"] == "ON":
+
+def download():
     downloader.download_new_activities()
 
-if config_mode["map-creator"] == "ON":
-    activities = storage.load_activities_from_csv()
-    logger.info(f"Loaded {len(activities)} activities")
 
-    mapgenerator.create_map_with_activities(activities, output_map_filename)
+def create_map():
+    # activities are streamed from the database, coordinates are loaded only for the time the activity is being written
+    mapgenerator.create_map_with_activities(storage.iter_activities_from_csv(), output_map_filename)
     if config_mode["date-filter"] == "ON":
         mapgenerator.add_date_range_filter(output_map_filename)
     logger.info(f"Generated {output_map_filename}. Size: {round(os.path.getsize(output_map_filename) / 1048576, 2)} MB")
 
-if config_mode["minifier"] == "ON":
+
+def minify():
     minifier.minify(output_map_filename, output_map_minified_filename)
     logger.info(
         f"Minified output saved into {output_map_minified_filename}. Size: {round(os.path.getsize(output_map_minified_filename) / 1048576, 2)} MB")
 
-if config_mode["uploader"] == "ON":
-    filename = output_map_minified_filename if config_mode["minifier"] == "ON" else output_map_filename
 
+def upload():
     # Use the new upload function that handles HTML + JSON data files
-    ftpuploader.upload_map_with_data_to_ftp_incremental(filename)
+    return ftpuploader.upload_map_with_data_to_ftp_incremental(upload_filename)
+
+
+def map_creator_inputs():
+    return {
+        'database': fingerprint_file(config['storage']['activities-database']),
+        'journal': fingerprint_file(config['storage']['activities-journal']),
+        'coordinates': fingerprint_directory(config['storage']['directory-coordinates']),
+        'config': fingerprint_config('activities', 'map-tiles', 'output', 'spatial-index', 'explorer-tiles', 'heatmap', 'duplicates'),
+        'duplicates': fingerprint_file(config['storage']['duplicates-report']),
+        'date-filter': fingerprint_values(config_mode["date-filter"]),
+        'templates': fingerprint_directory(templates_directory),
+        'code': fingerprint_code(mapgenerator, storage),
+    }
+
+
+def minifier_inputs():
+    return {
+        'map': fingerprint_file(output_map_filename),
+        'externs': fingerprint_file('externs.js'),
+        'code': fingerprint_code(minifier),
+    }
+
+
+def uploader_inputs():
+    return {
+        'map': fingerprint_file(upload_filename),
+        'data': fingerprint_directory(output_data_directory, '.json'),
+        'config': fingerprint_config('ftp'),
+    }
+
+
+stages = []
+if config_mode["downloader"] == "ON":
+    # Garmin Connect is a remote input, new activities can only be found by asking for them
+    stages.append(Stage("downloader", download))
+if config_mode["map-creator"] == "ON":
+    stages.append(Stage("map-creator", create_map, map_creator_inputs,
+                        [output_map_filename, os.path.join(output_data_directory, 'manifest.json')]))
+if config_mode["minifier"] == "ON":
+    stages.append(Stage("minifier", minify, minifier_inputs, [output_map_minified_filename]))
+if config_mode["uploader"] == "ON":
+    stages.append(Stage("uploader", upload, uploader_inputs))
+
+if stages:
+    pipeline.run_pipeline(stages, config_mode["skip-unchanged-stages"] == "ON")
 
 utility_mode = config_mode["utility-mode"]
 if utility_mode != "OFF":
-    if utility_mode == "REDOWNLOAD":
-        downloader.redownload_activity(config_mode["activity-id"])
-    elif utility_mode == "REGENERATE_COORDINATES":
-        downloader.regenerate_coordinates()
-    elif utility_mode == "REGENERATE_CSV":
-        downloader.regenerate_csv()
-    elif utility_mode == "RESORT_CSV":
-        storage.resort_database()
-    elif utility_mode == "ENCRYPT_FTP_PASSWORD":
-        ftpuploader.encrypt_password()
\ No newline at end of file
+    with instrumentation.span(f"utility:{utility_mode}"):
+        if utility_mode == "REDOWNLOAD":
+            downloader.redownload_activity(config_mode["activity-id"])
+        elif utility_mode == "REDOWNLOAD_BATCH":
+            downloader.redownload_activities()
+        elif utility_mode == "REGENERATE_COORDINATES":
+            downloader.regenerate_coordinates()
+        elif utility_mode == "REGENERATE_CSV":
+            downloader.regenerate_csv()
+        elif utility_mode == "RESORT_CSV":
+            storage.resort_database()
+        elif utility_mode == "COMPACT_DATABASE":
+            storage.compact_database()
+        elif utility_mode == "RESTORE_DATABASE":
+            storage.restore_database(config_mode["restore-time"])
+        elif utility_mode == "ENCRYPT_FTP_PASSWORD":
+            ftpuploader.encrypt_password()
+        elif utility_mode == "FIND_ACTIVITIES":
+            spatialindex.print_activities()
+        elif utility_mode == "REBUILD_SPATIAL_INDEX":
+            spatialindex.build_index()
+        elif utility_mode == "FIND_DUPLICATES":
+            duplicates.find_duplicates()
+        elif utility_mode == "MIGRATE_TO_ARCHIVE":
+            archive.migrate()
+
+instrumentation.finish_run()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Summary statistics of activities per category and day: number of activities, total distance, total duration and the longest activity.
+
+Statistics are accumulated during the pass over activities which writes the data files and are stored in the manifest, so that the
+page can show totals for any selection of categories and dates without downloading the data files. The pass reads coordinates only
+for categories whose data files are written, so a poll of the daemon with a single new activity refreshes the statistics of all the
+categories for the cost of reading the database. Days are the granularity of the date range slider, so totals of any range selected
+on the page are exact. Months and years are sums of their days.
+
+In the manifest each day is a list [count, distance, duration, longest] with longest as [activity_id, name, distance] - there is
+an entry for every day with an activity, dicts would make the manifest several times larger.
+"""
+
+
+class PeriodStats:
+    def __init__(self, count=0, distance=0.0, duration=0.0, longest=None):
+        self.count = count
+        self.distance = distance
+        self.duration = duration
+        # the longest activity by distance - {activity_id, name, date, distance, duration}
+        self.longest = longest
+
+    def add(self, activity):
+        self.count += 1
+        self.distance += activity.distance
+        self.duration += activity.duration
+        if self.longest is None or activity.distance > self.longest['distance']:
+            self.longest = {
+                'activity_id': activity.activity_id,
+                'name': activity.name,
+                'date': activity.date,
+                'distance': activity.distance,
+                'duration': activity.duration
+            }
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'distance': round(self.distance, 2),
+            'duration': round(self.duration, 1),
+            'longest': self.longest
+        }
+
+    def to_list(self):
+        """Compact form of a day for the manifest, the date of the longest activity is the day itself"""
+        longest = [self.longest['activity_id'], self.longest['name'], self.longest['distance']] if self.longest else None
+        return [self.count, round(self.distance, 2), round(self.duration, 1), longest]
+
+
+class ActivityStats:
+    def __init__(self):
+        # category name -> 'YYYY-MM-DD' -> PeriodStats
+        self.categories = {}
+
+    def add(self, category_name, activity):
+        days = self.categories.setdefault(category_name, {})
+        period = days.get(activity.date)
+        if period is None:
+            period = days[activity.date] = PeriodStats()
+        period.add(activity)
+
+    def to_dict(self):
+        """Categories and days are sorted so that the output is stable"""
+        return {category_name: {day: days[day].to_list() for day in sorted(days)}
+                for category_name, days in sorted(self.categories.items())}
+
+    def get_totals(self, category_name=None, period=None):
+        """Sum of the days, optionally only of a category and/or a period - a year, month or day prefix of the date (e.g. 2024-05)"""
+        totals = PeriodStats()
+        for name, days in self.categories.items():
+            if category_name is not None and name != category_name:
+                continue
+            for day, day_stats in days.items():
+                if period is not None and not day.startswith(str(period)):
+                    continue
+                totals.count += day_stats.count
+                totals.distance += day_stats.distance
+                totals.duration += day_stats.duration
+                if day_stats.longest and (totals.longest is None or day_stats.longest['distance'] > totals.longest['distance']):
+                    totals.longest = day_stats.longest
+        return totals
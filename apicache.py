@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Record/replay cache of Garmin Connect API responses used by the downloader and consolidation
+(get_activities_by_date, get_activity, download_activity and pages of the activity listing requested through connectapi).
+
+Modes ([api-cache][mode]):
+ - OFF          .. calls go to Garmin Connect directly
+ - RECORD       .. calls go to Garmin Connect, every response is stored
+ - READ_THROUGH .. stored responses are served, only calls not stored yet go to Garmin Connect (and get stored)
+ - REPLAY       .. stored responses are served without logging in to Garmin Connect. This is a local stand-in of Garmin Connect:
+                   it waits as long as the recorded call took (times [api-cache][replay-latency-factor]), listings of activities
+                   for date ranges which were not recorded are assembled from all the recorded listings, other calls which were
+                   not recorded fail with ApiCacheMiss.
+
+Responses are stored in [storage][directory-api-cache], one file per call named by a hash of the method and its arguments, along
+with the arguments and the time the call took. Downloaded files are stored next to it as they are.
+Other methods of the Garmin client (e.g. uploads and changes of activities in consolidation) are passed through, never cached.
+"""
+import datetime
+import enum
+import hashlib
+import json
+import os
+import time
+
+from common import logger, config
+
+MODES = ("OFF", "RECORD", "READ_THROUGH", "REPLAY")
+# the only generic connectapi requests which are cached - they do not change anything in Garmin Connect
+ACTIVITIES_SEARCH_PATH = "/activitylist-service/activities/search/activities"
+
+
+class ApiCacheMiss(Exception):
+    pass
+
+
+def normalize_argument(value):
+    """Arguments as stored in the cache and used for the key - dates, enums and ids in a stable textual form"""
+    if value is None:
+        return None
+    if isinstance(value, enum.Enum):
+        return value.name
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, dict):
+        return {key: normalize_argument(item) for key, item in sorted(value.items())}
+    return str(value)
+
+
+class ResponseStore:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def get_filename(self, method, arguments):
+        key = hashlib.sha256(json.dumps([method, arguments]).encode()).hexdigest()[:24]
+        return os.path.join(self.directory, method, key)
+
+    def load(self, method, arguments):
+        """Returns (response, elapsed seconds) or None when the call is not stored"""
+        filename = self.get_filename(method, arguments)
+        if not os.path.exists(filename + ".json"):
+            return None
+        return self.read_record(filename)
+
+    @staticmethod
+    def read_record(filename):
+        with open(filename + ".json", 'r') as record_file:
+            record = json.load(record_file)
+        if record.get('binary'):
+            with open(filename + ".bin", 'rb') as binary_file:
+                return binary_file.read(), record['elapsed']
+        return record['response'], record['elapsed']
+
+    def save(self, method, arguments, response, elapsed):
+        filename = self.get_filename(method, arguments)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        record = {'method': method, 'arguments': arguments, 'elapsed': round(elapsed, 4),
+                  'recorded': datetime.datetime.now().isoformat(timespec='seconds')}
+        if isinstance(response, bytes):
+            # the file first, the record marks the call as stored
+            with open(filename + ".bin.tmp", 'wb') as binary_file:
+                binary_file.write(response)
+            os.replace(filename + ".bin.tmp", filename + ".bin")
+            record['binary'] = True
+        else:
+            record['response'] = response
+        with open(filename + ".json.tmp", 'w') as record_file:
+            json.dump(record, record_file)
+        os.replace(filename + ".json.tmp", filename + ".json")
+
+    def iter_responses(self, method):
+        method_directory = os.path.join(self.directory, method)
+        if not os.path.isdir(method_directory):
+            return
+        for filename in sorted(os.listdir(method_directory)):
+            if filename.endswith(".json"):
+                yield self.read_record(os.path.join(method_directory, filename[:-len(".json")]))
+
+
+class CachedApi:
+    """Drop-in replacement of the Garmin client for the calls of the downloader, see the module description"""
+
+    def __init__(self, api, store: ResponseStore, mode, latency_factor=1.0):
+        if mode not in MODES or mode == "OFF":
+            raise ValueError(f"Unsupported API cache mode {mode}")
+        self.api = api
+        self.store = store
+        self.mode = mode
+        self.latency_factor = latency_factor
+        if api is not None:
+            self.ActivityDownloadFormat = api.ActivityDownloadFormat
+        else:
+            from garminconnect import Garmin
+            self.ActivityDownloadFormat = Garmin.ActivityDownloadFormat
+
+    def call(self, method, *args, request=None):
+        """request - optional. Function making the call to Garmin Connect, the method of the client called with args by default"""
+        arguments = [normalize_argument(arg) for arg in args]
+        if self.mode != "RECORD":
+            stored = self.store.load(method, arguments)
+            if stored is not None:
+                response, elapsed = stored
+                if self.mode == "REPLAY" and self.latency_factor > 0:
+                    time.sleep(elapsed * self.latency_factor)
+                logger.debug(f"API cache hit: {method}{tuple(arguments)}")
+                return response
+            if self.mode == "REPLAY":
+                return self.replay_missing(method, arguments)
+
+        start = time.perf_counter()
+        response = request() if request else getattr(self.api, method)(*args)
+        elapsed = time.perf_counter() - start
+        self.store.save(method, arguments, response, elapsed)
+        logger.debug(f"API call stored: {method}{tuple(arguments)} in {elapsed:.2f}s")
+        return response
+
+    def replay_missing(self, method, arguments):
+        if method == "get_activities_by_date":
+            start_date, end_date, activity_type, sort_order = arguments
+            return self.replay_listing(start_date, end_date, activity_type, sort_order)
+        if method == "connectapi":
+            params = arguments[1]
+            activities = self.replay_listing(params['startDate'], params.get('endDate'), params.get('activityType'),
+                                             params.get('sortOrder'))
+            start = int(params.get('start', 0))
+            return activities[start:start + int(params.get('limit', 20))]
+        raise ApiCacheMiss(f"No recorded response for {method}{tuple(arguments)}")
+
+    def replay_listing(self, start_date, end_date, activity_type, sort_order):
+        """Activities of the date range assembled from all the recorded listings. Waits as long as the recorded listings took on average."""
+        activities = {}
+        elapsed_times = []
+        for method in ("get_activities_by_date", "connectapi"):
+            for listing, elapsed in self.store.iter_responses(method):
+                elapsed_times.append(elapsed)
+                for api_activity in listing:
+                    day = api_activity.get('startTimeLocal', '')[:10]
+                    if day < start_date[:10] or (end_date is not None and day > end_date[:10]):
+                        continue
+                    if activity_type is not None and api_activity.get('activityType', {}).get('typeKey') != activity_type:
+                        continue
+                    activities[api_activity.get('activityId')] = api_activity
+        if elapsed_times and self.latency_factor > 0:
+            time.sleep(sum(elapsed_times) / len(elapsed_times) * self.latency_factor)
+        return sorted(activities.values(), key=lambda api_activity: api_activity.get('startTimeLocal', ''),
+                      reverse=sort_order != "asc")
+
+    def get_activities_by_date(self, startdate, enddate=None, activitytype=None, sortorder=None):
+        return self.call("get_activities_by_date", startdate, enddate, activitytype, sortorder)
+
+    def get_activity(self, activity_id):
+        return self.call("get_activity", activity_id)
+
+    def download_activity(self, activity_id, dl_fmt=None):
+        return self.call("download_activity", activity_id, dl_fmt or self.ActivityDownloadFormat.TCX)
+
+    def connectapi(self, path, **kwargs):
+        if path != ACTIVITIES_SEARCH_PATH:
+            if self.api is None:
+                raise ApiCacheMiss(f"Request of {path} is not available when replaying recorded API responses")
+            return self.api.connectapi(path, **kwargs)
+        return self.call("connectapi", path, kwargs.get('params', {}), request=lambda: self.api.connectapi(path, **kwargs))
+
+    def __getattr__(self, name):
+        # called only for attributes not defined above - the rest of the Garmin client
+        if self.api is None:
+            raise ApiCacheMiss(f"{name} is not available when replaying recorded API responses")
+        return getattr(self.api, name)
+
+
+def create_cached_api(api):
+    """Wrap the logged-in Garmin client (None in REPLAY mode) by the cache configured in [api-cache]"""
+    cache_config = config['api-cache']
+    directory = config['storage']['directory-api-cache']
+    logger.info(f"Garmin Connect API cache in {cache_config['mode']} mode, responses stored in '{directory}'")
+    return CachedApi(api, ResponseStore(directory), cache_config['mode'], cache_config['replay-latency-factor'])
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Archive of raw activity files (GPX, FIT and JSON from Garmin Connect) packed into a few large compressed files instead of tens of
+thousands of small ones in [storage][directory-gpx], [storage][directory-fit] and [storage][directory-json].
+
+Each file is compressed on its own and appended to the current pack file (pack_00001.dat, ... in [storage][directory-archive]).
+A new pack is started once the current one reaches [archive][pack-size-mb]. Location of every file is appended to the index
+(index.jsonl) - activity id, kind (gpx/fit/json), pack, offset and length. The latest line of an activity and kind wins, so a
+re-downloaded file is simply appended again and a deleted one gets a line without a pack. Reading a file seeks to its offset and
+decompresses it while it is being read.
+
+When [archive][enabled] the downloader stores new files into the archive. Readers use open_track/open_json which fall back to the
+directories, so activities not migrated yet keep working. Utility mode MIGRATE_TO_ARCHIVE moves the existing directories into
+the archive.
+"""
+import io
+import json
+import os
+import threading
+import zlib
+
+from common import logger, config
+
+KINDS = ('gpx', 'fit', 'json')
+# kinds of the original track, an activity has at most one of them
+TRACK_KINDS = ('gpx', 'fit')
+CHUNK_SIZE = 65536
+
+
+class RecordStream(io.RawIOBase):
+    """Decompresses a record of a pack file while it is being read"""
+
+    def __init__(self, pack_file, length):
+        self.pack_file = pack_file
+        self.remaining = length
+        self.decompressor = zlib.decompressobj()
+        self.buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, target):
+        while not self.buffer:
+            if self.decompressor.unconsumed_tail:
+                data = self.decompressor.unconsumed_tail
+            elif self.remaining:
+                data = self.pack_file.read(min(CHUNK_SIZE, self.remaining))
+                self.remaining -= len(data)
+            else:
+                self.buffer = self.decompressor.flush()
+                if not self.buffer:
+                    return 0
+                break
+            self.buffer = self.decompressor.decompress(data, CHUNK_SIZE)
+        size = min(len(target), len(self.buffer))
+        target[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+    def close(self):
+        self.pack_file.close()
+        super().close()
+
+
+class ArchiveStore:
+    def __init__(self, directory, pack_size, compression_level):
+        self.directory = directory
+        self.pack_size = pack_size
+        self.compression_level = compression_level
+        # (activity id, kind) -> [pack, offset, length, size], loaded when needed
+        self.index = None
+        # the downloader may store files from several threads
+        self.lock = threading.Lock()
+
+    @property
+    def index_filename(self):
+        return os.path.join(self.directory, 'index.jsonl')
+
+    def get_pack_filename(self, pack):
+        return os.path.join(self.directory, f"pack_{pack:05d}.dat")
+
+    def load_index(self):
+        if self.index is not None:
+            return self.index
+        self.index = {}
+        if os.path.exists(self.index_filename):
+            with open(self.index_filename, 'r') as index_file:
+                for line in index_file:
+                    entry = json.loads(line)
+                    key = (entry['id'], entry['kind'])
+                    if entry['pack'] is None:
+                        self.index.pop(key, None)
+                    else:
+                        self.index[key] = [entry['pack'], entry['offset'], entry['length'], entry['size']]
+        return self.index
+
+    def contains(self, activity_id, kind):
+        return (activity_id, kind) in self.load_index()
+
+    def open(self, activity_id, kind):
+        """Binary stream of the file, None when it is not archived"""
+        location = self.load_index().get((activity_id, kind))
+        if location is None:
+            return None
+        pack, offset, length, _ = location
+        pack_file = open(self.get_pack_filename(pack), 'rb')
+        pack_file.seek(offset)
+        return io.BufferedReader(RecordStream(pack_file, length), CHUNK_SIZE)
+
+    def read(self, activity_id, kind):
+        stream = self.open(activity_id, kind)
+        if stream is None:
+            return None
+        with stream:
+            return stream.read()
+
+    def get_current_pack(self):
+        packs = sorted(int(filename[5:10]) for filename in os.listdir(self.directory)
+                       if filename.startswith('pack_') and filename.endswith('.dat'))
+        if not packs:
+            return 1
+        if os.path.getsize(self.get_pack_filename(packs[-1])) >= self.pack_size:
+            return packs[-1] + 1
+        return packs[-1]
+
+    def add(self, activity_id, kind, data: bytes):
+        compressed = zlib.compress(data, self.compression_level)
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            index = self.load_index()
+            pack = self.get_current_pack()
+            # the record first, the index line makes it visible
+            with open(self.get_pack_filename(pack), 'ab') as pack_file:
+                offset = pack_file.tell()
+                pack_file.write(compressed)
+            self.append_index({'id': activity_id, 'kind': kind, 'pack': pack, 'offset': offset, 'length': len(compressed),
+                               'size': len(data)})
+            index[(activity_id, kind)] = [pack, offset, len(compressed), len(data)]
+
+    def remove(self, activity_id, kind):
+        with self.lock:
+            index = self.load_index()
+            if (activity_id, kind) in index:
+                self.append_index({'id': activity_id, 'kind': kind, 'pack': None})
+                del index[(activity_id, kind)]
+
+    def append_index(self, entry):
+        with open(self.index_filename, 'a') as index_file:
+            index_file.write(json.dumps(entry) + "\n")
+
+
+stores = {}
+
+
+def get_store():
+    directory = config['storage']['directory-archive']
+    if directory not in stores:
+        archive_config = config['archive']
+        stores[directory] = ArchiveStore(directory, archive_config['pack-size-mb'] * 1048576, archive_config['compression-level'])
+    return stores[directory]
+
+
+def get_filename(activity, kind):
+    return getattr(activity, f"{kind}_filename")
+
+
+def open_file(activity, kind):
+    """Binary stream of the raw file of the activity from the archive or its directory, None when there is no such file"""
+    stream = get_store().open(activity.activity_id, kind)
+    if stream is not None:
+        return stream
+    filename = get_filename(activity, kind)
+    return open(filename, 'rb') if os.path.exists(filename) else None
+
+
+def open_track(activity):
+    """(kind, binary stream) of the original track of the activity (GPX or FIT), (None, None) when there is none"""
+    for kind in TRACK_KINDS:
+        stream = open_file(activity, kind)
+        if stream is not None:
+            return kind, stream
+    return None, None
+
+
+def open_json(activity):
+    return open_file(activity, 'json')
+
+
+def save(activity, kind, data: bytes):
+    """Store raw file of the activity into the archive when it is enabled, into its directory otherwise"""
+    if config['archive']['enabled']:
+        logger.info(f"Archiving {kind} of {activity.activity_id}")
+        get_store().add(activity.activity_id, kind, data)
+        return
+    filename = get_filename(activity, kind)
+    logger.info(f"Writing {filename}")
+    with open(filename, 'wb') as output_file:
+        output_file.write(data)
+
+
+def delete(activity, kind):
+    """Delete a raw file of the activity from the archive and its directory, e.g. a GPX track replaced by a FIT one"""
+    get_store().remove(activity.activity_id, kind)
+    filename = get_filename(activity, kind)
+    if os.path.exists(filename):
+        logger.info(f"Deleting {filename}")
+        os.remove(filename)
+
+
+def remove(activity):
+    """Remove raw files of the activity from the archive (files in the directories are deleted by storage.delete_activity_files)"""
+    store = get_store()
+    for kind in KINDS:
+        store.remove(activity.activity_id, kind)
+
+
+def migrate():
+    """Utility mode MIGRATE_TO_ARCHIVE - move raw files of all activities from the directories into the archive"""
+    import storage
+
+    store = get_store()
+    keep_files = config['archive']['keep-migrated-files']
+    migrated_files = 0
+    original_size = 0
+    for activity in storage.iter_activities_from_csv():
+        for kind in KINDS:
+            filename = get_filename(activity, kind)
+            if not os.path.exists(filename):
+                continue
+            with open(filename, 'rb') as input_file:
+                data = input_file.read()
+            if not store.contains(activity.activity_id, kind) or store.read(activity.activity_id, kind) != data:
+                store.add(activity.activity_id, kind, data)
+                if store.read(activity.activity_id, kind) != data:
+                    raise IOError(f"Verification of archived {filename} failed")
+            if not keep_files:
+                os.remove(filename)
+            migrated_files += 1
+            original_size += len(data)
+
+    packed_size = sum(os.path.getsize(os.path.join(store.directory, filename)) for filename in os.listdir(store.directory)) \
+        if os.path.isdir(store.directory) else 0
+    logger.info(f"Migrated {migrated_files} files ({round(original_size / 1048576, 1)} MB) into {store.directory} "
+                f"({round(packed_size / 1048576, 1)} MB)")
@@ -0,0 +1,173 @@
+"""
+Minimal local FTP server used as a stand-in for a real FTP site in benchmarks.
+
+It implements just the commands used by ftpuploader (login, CWD, MKD, SIZE, MDTM, STOR, NLST, DELE) in passive mode and keeps the
+uploaded files in memory. An artificial latency can be added to every command to simulate a remote server.
+"""
+import datetime
+import socket
+import socketserver
+import threading
+import time
+
+
+class FtpStubServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0):
+        super().__init__((host, port), FtpStubHandler)
+        self.latency = latency
+        # path -> (content, modification time)
+        self.files = {}
+        self.directories = {"/"}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FtpStubHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.cwd = "/"
+        self.passive_socket = None
+
+    def reply(self, line):
+        self.wfile.write((line + "\r\n").encode())
+
+    def resolve(self, path):
+        if path.startswith("/"):
+            resolved = path
+        else:
+            resolved = self.cwd.rstrip("/") + "/" + path
+        return resolved.rstrip("/") or "/"
+
+    def handle(self):
+        self.reply("220 FTP stub ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            command, _, argument = line.decode().strip().partition(" ")
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            handler = getattr(self, "do_" + command.upper(), None)
+            if handler is None:
+                self.reply("502 Command not implemented")
+                continue
+            if handler(argument) is False:
+                break
+
+    def do_USER(self, argument):
+        self.reply("331 Password required")
+
+    def do_PASS(self, argument):
+        self.reply("230 Logged in")
+
+    def do_TYPE(self, argument):
+        self.reply("200 Type set")
+
+    def do_PWD(self, argument):
+        self.reply(f"257 \"{self.cwd}\"")
+
+    def do_CWD(self, argument):
+        path = self.resolve(argument)
+        with self.server.lock:
+            exists = path in self.server.directories
+        if exists:
+            self.cwd = path
+            self.reply("250 Directory changed")
+        else:
+            self.reply("550 No such directory")
+
+    def do_MKD(self, argument):
+        path = self.resolve(argument)
+        with self.server.lock:
+            if path in self.server.directories:
+                self.reply("550 Directory already exists")
+                return
+            self.server.directories.add(path)
+        self.reply(f"257 \"{path}\" created")
+
+    def do_SIZE(self, argument):
+        with self.server.lock:
+            stored = self.server.files.get(self.resolve(argument))
+        if stored is None:
+            self.reply("550 No such file")
+        else:
+            self.reply(f"213 {len(stored[0])}")
+
+    def do_MDTM(self, argument):
+        with self.server.lock:
+            stored = self.server.files.get(self.resolve(argument))
+        if stored is None:
+            self.reply("550 No such file")
+        else:
+            self.reply("213 " + datetime.datetime.fromtimestamp(stored[1], datetime.timezone.utc).strftime("%Y%m%d%H%M%S"))
+
+    def do_PASV(self, argument):
+        if self.passive_socket:
+            self.passive_socket.close()
+        self.passive_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.passive_socket.bind((self.server.server_address[0], 0))
+        self.passive_socket.listen(1)
+        host, port = self.passive_socket.getsockname()
+        self.reply(f"227 Entering Passive Mode ({host.replace('.', ',')},{port >> 8},{port & 0xFF})")
+
+    def accept_data_connection(self):
+        if not self.passive_socket:
+            self.reply("425 Use PASV first")
+            return None
+        connection, _ = self.passive_socket.accept()
+        self.passive_socket.close()
+        self.passive_socket = None
+        return connection
+
+    def do_STOR(self, argument):
+        connection = self.accept_data_connection()
+        if connection is None:
+            return
+        self.reply("150 Ready to receive")
+        chunks = []
+        with connection:
+            while True:
+                chunk = connection.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        with self.server.lock:
+            self.server.files[self.resolve(argument)] = (b"".join(chunks), time.time())
+        self.reply("226 Transfer complete")
+
+    def do_NLST(self, argument):
+        connection = self.accept_data_connection()
+        if connection is None:
+            return
+        self.reply("150 Listing")
+        prefix = self.cwd.rstrip("/") + "/"
+        with self.server.lock:
+            names = [path[len(prefix):] for path in self.server.files if path.startswith(prefix) and "/" not in path[len(prefix):]]
+        with connection:
+            connection.sendall("".join(name + "\r\n" for name in names).encode())
+        self.reply("226 Listing complete")
+
+    def do_DELE(self, argument):
+        with self.server.lock:
+            removed = self.server.files.pop(self.resolve(argument), None)
+        self.reply("250 Deleted" if removed is not None else "550 No such file")
+
+    def do_QUIT(self, argument):
+        self.reply("221 Bye")
+        return False
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite covering every stage of the pipeline on synthetic data. No Garmin account or FTP site is needed.
+
+Run it from the root directory of the project:
+    python -m benchmarks.run --scale 1k
+    python -m benchmarks.run --activities 5000 --points 1200 --repeat 5
+    python -m benchmarks.run --scale 10k --compare data/benchmarks/benchmark_20241020_101010.json
+
+A synthetic dataset (database, coordinate files, a sample of GPX and FIT files) is generated into a scratch directory first. Generation is
+deterministic, so results of two runs with the same parameters are comparable. Results are written as JSON into data/benchmarks and
+can be compared with a previous result file to track regressions.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+import apicache
+import archive
+import downloader
+import ftpuploader
+import mapgenerator
+import minifier
+import storage
+from benchmarks import synthetic
+from benchmarks.ftpstub import FtpStubServer
+from common import logger, config, load_config
+
+SCALES = {'1k': 1_000, '10k': 10_000, '100k': 100_000}
+
+# What each mode of activities-map.py needs to import before it can start working. Measured in a fresh interpreter.
+ENTRY_POINT_IMPORTS = ("import common; common.load_config(); "
+                       "import downloader, ftpuploader, instrumentation, mapgenerator, minifier, pipeline, storage")
+COLD_START_MODES = {
+    'interpreter': "pass",
+    'entry_point': ENTRY_POINT_IMPORTS,
+    'downloader': ENTRY_POINT_IMPORTS + "; import garminconnect, gpxpy, simplification.cutil",
+    'map_creator': ENTRY_POINT_IMPORTS + "; import folium",
+    'uploader': ENTRY_POINT_IMPORTS + "; import cryptography.fernet",
+}
+
+
+class BenchmarkResult:
+    def __init__(self, name, times, items, unit):
+        self.name = name
+        self.times = times
+        self.items = items
+        self.unit = unit
+
+    def to_dict(self):
+        best = min(self.times)
+        return {
+            'min_s': round(best, 6),
+            'median_s': round(statistics.median(self.times), 6),
+            'runs': len(self.times),
+            'items': self.items,
+            'unit': self.unit,
+            'throughput_per_s': round(self.items / best, 1) if best > 0 else None,
+        }
+
+
+def measure(name, function, repeat, items, unit, setup=None):
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    result = BenchmarkResult(name, times, items, unit)
+    print(f"{name:<28} min {min(times):9.4f}s  median {statistics.median(times):9.4f}s  "
+          f"{result.to_dict()['throughput_per_s'] or 0:>12} {unit}/s", flush=True)
+    return result
+
+
+def configure_scratch_directory(directory):
+    """Point all storage and output paths to the scratch directory"""
+    config['storage']['activities-database'] = os.path.join(directory, 'activities_list.csv')
+    config['storage']['activities-journal'] = os.path.join(directory, 'activities_journal.jsonl')
+    config['storage']['activities-snapshot'] = os.path.join(directory, 'activities_snapshot.csv')
+    config['storage']['directory-json'] = os.path.join(directory, 'json')
+    config['storage']['directory-gpx'] = os.path.join(directory, 'gpx')
+    config['storage']['directory-fit'] = os.path.join(directory, 'fit')
+    config['storage']['directory-coordinates'] = os.path.join(directory, 'coordinates')
+    config['storage']['directory-cache'] = os.path.join(directory, 'cache')
+    config['storage']['pipeline-state'] = os.path.join(directory, 'pipeline_state.json')
+    config['storage']['spatial-index'] = os.path.join(directory, 'spatial_index.json')
+    config['storage']['explored-tiles'] = os.path.join(directory, 'explored_tiles.json')
+    config['storage']['directory-heatmap'] = os.path.join(directory, 'heatmap')
+    config['storage']['directory-archive'] = os.path.join(directory, 'archive')
+    config['storage']['simplification-report'] = os.path.join(directory, 'simplification_report.json')
+    config['storage']['duplicates-report'] = os.path.join(directory, 'duplicates.json')
+    config['storage']['directory-api-cache'] = os.path.join(directory, 'api_cache')
+    config['storage']['download-cursor'] = os.path.join(directory, 'download_cursor.json')
+    config['output']['map-filename'] = os.path.join(directory, 'output', 'activities_map.html')
+    config['output']['map-minified-filename'] = os.path.join(directory, 'output', 'activities_map.min.html')
+
+
+def benchmark_cold_start(args):
+    """Start a new interpreter for each mode and import what the mode needs"""
+    def run(code):
+        subprocess.run([sys.executable, "-c", code], check=True, capture_output=True)
+
+    return [measure(f"cold_start_{mode}", lambda code=code: run(code), max(args.repeat, 5), 1, "starts")
+            for mode, code in COLD_START_MODES.items()]
+
+
+def benchmark_storage(args):
+    activities_count = len(storage.load_activities_from_csv(False))
+    results = [measure("csv_load", lambda: storage.load_activities_from_csv(False), args.repeat, activities_count, "activities")]
+
+    loaded = []
+    results.append(measure("coordinates_load", lambda: loaded.append(storage.load_activities_from_csv(True)), args.repeat,
+                           activities_count, "activities"))
+    return results, loaded[-1]
+
+
+def benchmark_simplification(args, activities):
+    """Simplification of the GPX and FIT files of the same tracks, sizes of both formats are printed"""
+    track_data = {'gpx': [], 'fit': []}
+    for activity in activities[:args.gpx_sample]:
+        for track_kind in track_data:
+            with open(archive.get_filename(activity, track_kind), 'rb') as track_file:
+                track_data[track_kind].append(track_file.read())
+
+    def simplify_all(track_kind):
+        for data in track_data[track_kind]:
+            downloader.simplify_coordinates(data, track_kind)
+
+    for track_kind, data in track_data.items():
+        size = sum(len(file_data) for file_data in data)
+        compressed_size = sum(len(zlib.compress(file_data)) for file_data in data)
+        print(f"{track_kind.upper()} files: {size / 1048576:.2f} MB, compressed {compressed_size / 1048576:.2f} MB", flush=True)
+    points = len(track_data['gpx']) * args.points
+    return [measure("simplify_coordinates", lambda: simplify_all('gpx'), args.repeat, points, "points"),
+            measure("simplify_coordinates_fit", lambda: simplify_all('fit'), args.repeat, points, "points")]
+
+
+def benchmark_downloader(args, activities, scratch_directory):
+    """Download of the activities having a GPX file from recorded responses replayed by apicache (no Garmin account needed)"""
+    store = apicache.ResponseStore(config['storage']['directory-api-cache'])
+    recorded = synthetic.generate_api_recording(activities, store, args.api_latency_ms / 1000)
+    api = apicache.CachedApi(None, store, "REPLAY")
+
+    # download into an empty storage, the dataset stays untouched for the other benchmarks
+    original_config = {section: dict(config[section]) for section in ('storage', 'output')}
+    download_directory = os.path.join(scratch_directory, 'download')
+
+    def reset_storage():
+        shutil.rmtree(download_directory, ignore_errors=True)
+        configure_scratch_directory(download_directory)
+        config['storage']['directory-api-cache'] = store.directory
+        os.makedirs(download_directory)
+
+    track_format = config['activities']['track-format']
+    try:
+        results = []
+        for name, benchmarked_format in (("download_replay", "GPX"), ("download_replay_fit", "FIT")):
+            config['activities']['track-format'] = benchmarked_format
+            results.append(measure(name, lambda: downloader.download_activities(api), args.repeat, recorded, "activities",
+                                   setup=reset_storage))
+        return results
+    finally:
+        config['activities']['track-format'] = track_format
+        for section, values in original_config.items():
+            config[section] = values
+
+
+def benchmark_map(args, activities):
+    output_filename = config['output']['map-filename']
+    output_directory = os.path.dirname(output_filename)
+    return [
+        measure("create_activity_data_files", lambda: mapgenerator.create_activity_data_files(activities, output_directory),
+                args.repeat, len(activities), "activities"),
+        measure("create_map_with_activities", lambda: mapgenerator.create_map_with_activities(activities, output_filename),
+                args.repeat, len(activities), "activities"),
+        measure("create_map_streaming", lambda: mapgenerator.create_map_with_activities(storage.iter_activities_from_csv(), output_filename),
+                args.repeat, len(activities), "activities"),
+    ]
+
+
+def legacy_rewrite_js(js):
+    """The original minifier rewrite (one replace over the whole script per polyline), kept to verify and compare the current one"""
+    js = js.replace("{\"maxWidth\": 500}", "")
+    js = re.sub(" id=\"html_\\w+\" style=\"width: 100.0%; height: 100.0%;\"", "", js)
+
+    groups = []
+    pattern = re.compile(r"(L\.polyline\(\s+(\[\[.+\]\]),\s+({.+})\s+\)\.addTo\((\w+)\);)")
+    for match in re.findall(pattern, js):
+        whole, coords, style, group_name = match
+        group = next((g for g in groups if g.name == group_name), None)
+        if not group:
+            group = minifier.Group(len(groups), group_name, style)
+            groups.append(group)
+        js = js.replace(whole, f"{group.method_name}({coords});")
+
+    for group in groups:
+        js = group.method_def + js + "\n"
+
+    js = js.replace("mouseout:", "'mouseout':")
+    js = js.replace("mouseover:", "'mouseover':")
+    js = js.replace("popupopen:", "'popupopen':")
+    js = js.replace("popupclose:", "'popupclose':")
+    return js
+
+
+def benchmark_minifier(args, activities, scratch_directory):
+    sample = activities[:args.minify_activities]
+    html = synthetic.generate_folium_html(sample)
+    results = [measure("minify_rewrite", lambda: minifier.rewrite_html(html), args.repeat, len(sample), "polylines")]
+
+    # the original implementation is quadratic, compare on a smaller sample
+    legacy_sample = activities[:args.legacy_minify_activities]
+    legacy_html = synthetic.generate_folium_html(legacy_sample)
+    legacy_match, chunks = minifier.rewrite_html(legacy_html)
+    if "".join(chunks) != legacy_rewrite_js(legacy_match[2]):
+        raise AssertionError("Minifier output differs from the original implementation")
+    results.append(measure("minify_rewrite_sample", lambda: minifier.rewrite_html(legacy_html), args.repeat, len(legacy_sample),
+                           "polylines"))
+    results.append(measure("minify_rewrite_legacy_sample", lambda: legacy_rewrite_js(legacy_match[2]), args.repeat,
+                           len(legacy_sample), "polylines"))
+
+    if args.with_closure:
+        html_filename = os.path.join(scratch_directory, 'folium_map.html')
+        with open(html_filename, 'w') as html_file:
+            html_file.write(html)
+        minified_filename = os.path.join(scratch_directory, 'folium_map.min.html')
+        results.append(measure("minify_with_closure", lambda: minifier.minify(html_filename, minified_filename), args.repeat,
+                               len(sample), "polylines"))
+    return results
+
+
+def benchmark_upload(args, activities_count):
+    from cryptography.fernet import Fernet
+
+    server = FtpStubServer(latency=args.ftp_latency_ms / 1000).start()
+    try:
+        config['ftp'].update({
+            'host': server.server_address[0],
+            'port': server.port,
+            'user': 'benchmark',
+            'pass': Fernet(ftpuploader.CRYPTO_KEY).encrypt(b'benchmark').decode(),
+            'remote-path': '/',
+        })
+        html_filename = config['output']['map-filename']
+
+        def reset_server():
+            server.files.clear()
+            server.directories.clear()
+            server.directories.add("/")
+
+        return [
+            measure("ftp_upload_initial", lambda: ftpuploader.upload_map_with_data_to_ftp_incremental(html_filename),
+                    args.repeat, activities_count, "activities", setup=reset_server),
+            measure("ftp_upload_unchanged", lambda: ftpuploader.upload_map_with_data_to_ftp_incremental(html_filename),
+                    args.repeat, activities_count, "activities"),
+        ]
+    finally:
+        server.stop()
+
+
+def compare(results, previous_filename):
+    with open(previous_filename, 'r') as previous_file:
+        previous = json.load(previous_file)['results']
+    print(f"\nComparison with {previous_filename} (ratio < 1 means faster now):")
+    for name, result in results.items():
+        if name in previous and previous[name]['min_s'] > 0:
+            ratio = result['min_s'] / previous[name]['min_s']
+            print(f"  {name:<28} {previous[name]['min_s']:9.4f}s -> {result['min_s']:9.4f}s  ratio {ratio:6.2f}")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark pipeline stages on synthetic data")
+    parser.add_argument('--scale', choices=SCALES.keys(), default='1k', help="number of activities")
+    parser.add_argument('--activities', type=int, help="number of activities, overrides --scale")
+    parser.add_argument('--points', type=int, default=600, help="points per generated track (one point per second)")
+    parser.add_argument('--gpx-sample', type=int, default=50, help="number of activities with GPX and FIT files to simplify")
+    parser.add_argument('--minify-activities', type=int, default=20000, help="number of polylines in the html for the minifier")
+    parser.add_argument('--legacy-minify-activities', type=int, default=1000,
+                        help="number of polylines to compare the minifier with its original quadratic implementation")
+    parser.add_argument('--with-closure', action='store_true', help="include Closure Compiler (requires Java) in the minifier benchmark")
+    parser.add_argument('--ftp-latency-ms', type=float, default=0.0, help="artificial latency of each FTP command")
+    parser.add_argument('--api-latency-ms', type=float, default=0.0,
+                        help="latency of each replayed Garmin Connect call in the downloader benchmark")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="result file, data/benchmarks/benchmark_<timestamp>.json by default")
+    parser.add_argument('--compare', help="previous result file to compare with")
+    parser.add_argument('--keep', action='store_true', help="keep the generated scratch directory")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    load_config()
+    activities_count = args.activities or SCALES[args.scale]
+    logging.getLogger().setLevel(logging.WARNING)
+    logger.setLevel(logging.WARNING)
+
+    scratch_directory = tempfile.mkdtemp(prefix="activities-map-benchmark-")
+    configure_scratch_directory(scratch_directory)
+    try:
+        print(f"Generating {activities_count} activities with {args.points} points each into {scratch_directory}", flush=True)
+        start = time.perf_counter()
+        synthetic.generate_dataset(activities_count, args.points, args.gpx_sample, args.seed)
+        print(f"Generated in {time.perf_counter() - start:.1f}s\n", flush=True)
+
+        all_results = benchmark_cold_start(args)
+        results, activities = benchmark_storage(args)
+        all_results += results
+        all_results += benchmark_simplification(args, activities)
+        all_results += benchmark_downloader(args, activities, scratch_directory)
+        all_results += benchmark_map(args, activities)
+        all_results += benchmark_minifier(args, activities, scratch_directory)
+        all_results += benchmark_upload(args, len(activities))
+    finally:
+        if args.keep:
+            print(f"Scratch directory kept: {scratch_directory}")
+        else:
+            shutil.rmtree(scratch_directory, ignore_errors=True)
+
+    results = {result.name: result.to_dict() for result in all_results}
+    report = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'parameters': {
+            'activities': activities_count,
+            'points': args.points,
+            'gpx_sample': args.gpx_sample,
+            'minify_activities': args.minify_activities,
+            'legacy_minify_activities': args.legacy_minify_activities,
+            'with_closure': args.with_closure,
+            'ftp_latency_ms': args.ftp_latency_ms,
+            'api_latency_ms': args.api_latency_ms,
+            'repeat': args.repeat,
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+
+    output_filename = args.output or os.path.join('data', 'benchmarks',
+                                                  f"benchmark_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output_filename) or '.', exist_ok=True)
+    with open(output_filename, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f"\nResults written into {output_filename}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+"""
+Deterministic generator of synthetic activities for benchmarks.
+
+The same seed, scale and number of points always produce byte-identical files. Tracks are random walks starting from random points
+around Central Europe, sampled each second, so that they resemble real running and cycling activities closely enough for the
+simplification and serialization to have realistic costs.
+"""
+import csv
+import datetime
+import io
+import math
+import os
+import random
+import struct
+import zipfile
+
+import storage
+from common import config
+
+ACTIVITY_TYPES = [("running", 3.0), ("cycling", 7.0), ("hiking", 1.3), ("inline_skating", 4.5), ("resort_skiing", 6.0)]
+
+GPX_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<gpx creator="synthetic" version="1.1" xmlns="http://www.topografix.com/GPX/1/1">
+ <trk>
+  <name>{name}</name>
+  <trkseg>
+"""
+GPX_POINT = """   <trkpt lat="{lat:.7f}" lon="{lon:.7f}"><ele>{ele:.1f}</ele><time>{time}</time></trkpt>
+"""
+GPX_FOOTER = """  </trkseg>
+ </trk>
+</gpx>
+"""
+
+
+FIT_EPOCH = datetime.datetime(1989, 12, 31, tzinfo=datetime.timezone.utc)
+FIT_CRC_TABLE = [0x0000, 0xCC01, 0xD801, 0x1400, 0xF001, 0x3C00, 0x2800, 0xE401,
+                 0xA001, 0x6C00, 0x7800, 0xB401, 0x5000, 0x9C01, 0x8801, 0x4400]
+
+
+class SyntheticActivity:
+    def __init__(self, activity: storage.Activity, start: datetime.datetime, speed):
+        self.activity = activity
+        self.start = start
+        self.speed = speed
+
+
+def generate_track(rng: random.Random, points, speed, start_lat=None, start_lon=None):
+    """Random walk with a slowly changing heading. Returns a list of (latitude, longitude, elevation) tuples."""
+    lat = start_lat if start_lat is not None else rng.uniform(48.5, 51.0)
+    lon = start_lon if start_lon is not None else rng.uniform(12.0, 18.8)
+    ele = rng.uniform(150, 1500)
+    heading = rng.uniform(0, 2 * math.pi)
+    track = []
+    for _ in range(points):
+        track.append((lat, lon, ele))
+        heading += rng.gauss(0, 0.08)
+        step = speed * rng.uniform(0.7, 1.3)
+        lat += step * math.cos(heading) / 111320
+        lon += step * math.sin(heading) / (111320 * math.cos(math.radians(lat)))
+        ele += rng.gauss(0, 0.3)
+    return track
+
+
+def track_to_gpx(name, track, start: datetime.datetime):
+    parts = [GPX_HEADER.format(name=name)]
+    for index, (lat, lon, ele) in enumerate(track):
+        time = (start + datetime.timedelta(seconds=index)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        parts.append(GPX_POINT.format(lat=lat, lon=lon, ele=ele, time=time))
+    parts.append(GPX_FOOTER)
+    return "".join(parts)
+
+
+def fit_crc(data):
+    crc = 0
+    for byte in data:
+        for nibble in (byte & 0x0F, byte >> 4):
+            tmp = FIT_CRC_TABLE[crc & 0x0F]
+            crc = (crc >> 4) & 0x0FFF
+            crc = crc ^ tmp ^ FIT_CRC_TABLE[nibble]
+    return crc
+
+
+def track_to_fit(track, start: datetime.datetime):
+    """FIT file with the track the way a device records it - file id message and a record message (position, altitude) per second"""
+    start_timestamp = int((start.replace(tzinfo=datetime.timezone.utc) - FIT_EPOCH).total_seconds())
+    records = [
+        # definition of local message 0 - file_id (type, manufacturer, time_created)
+        struct.pack('<BBBHB', 0x40, 0, 0, 0, 3) + bytes([0, 1, 0x00, 1, 2, 0x84, 4, 4, 0x86]),
+        struct.pack('<BBHI', 0x00, 4, 1, start_timestamp),
+        # definition of local message 1 - record (timestamp, position_lat, position_long, altitude)
+        struct.pack('<BBBHB', 0x41, 0, 0, 20, 4) + bytes([253, 4, 0x86, 0, 4, 0x85, 1, 4, 0x85, 2, 2, 0x84]),
+    ]
+    for index, (lat, lon, ele) in enumerate(track):
+        records.append(struct.pack('<BIiiH', 0x01, start_timestamp + index, round(lat * 2 ** 31 / 180), round(lon * 2 ** 31 / 180),
+                                   round((ele + 500) * 5)))
+    data = b''.join(records)
+    header = struct.pack('<BBHI4s', 14, 0x20, 2132, len(data), b'.FIT')
+    header += struct.pack('<H', fit_crc(header))
+    return header + data + struct.pack('<H', fit_crc(header + data))
+
+
+def fit_to_original_download(activity_id, fit_data):
+    """FIT file packed the way Garmin Connect serves the ORIGINAL download format"""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zip_file:
+        zip_file.writestr(f"{activity_id}_ACTIVITY.fit", fit_data)
+    return buffer.getvalue()
+
+
+def generate_activities(count, seed=42):
+    """Generate activity records (without any files) spread over ten years since 2015, sorted by date"""
+    rng = random.Random(seed)
+    first_day = datetime.datetime(2015, 1, 1, 6, 0)
+    activities = []
+    for index in range(count):
+        activity_type, speed = rng.choice(ACTIVITY_TYPES)
+        start = first_day + datetime.timedelta(seconds=int(index * 10 * 365 * 86400 / max(count, 1)) + rng.randint(0, 3600))
+        activity_id = 10_000_000_000 + index
+        date = start.strftime("%Y-%m-%d")
+        activity = storage.Activity(activity_id=activity_id,
+                                    distance=0,
+                                    duration=0,
+                                    date=date,
+                                    time=start.strftime("%H:%M"),
+                                    filename=f"{date}_{activity_id}_{activity_type}",
+                                    has_gps_data=True,
+                                    activity_type=activity_type,
+                                    name=f"Synthetic {activity_type} {index}")
+        activities.append(SyntheticActivity(activity, start, speed))
+    return activities
+
+
+def generate_dataset(count, points, gpx_sample, seed=42):
+    """
+    Generate a complete local storage into directories configured in [storage] (the caller points them to a scratch directory):
+    database CSV, a coordinates file for every activity and GPX and FIT files of the same track for the first gpx_sample activities.
+    Coordinates are simplified the same way the downloader would do it, approximated by taking every tenth point.
+    Returns the list of activities.
+    """
+    storage.init_directories()
+    rng = random.Random(seed)
+    synthetic_activities = generate_activities(count, seed)
+    decimal_places = config['activities']['coords-decimal-places']
+
+    for index, synthetic in enumerate(synthetic_activities):
+        activity = synthetic.activity
+        track = generate_track(rng, points, synthetic.speed)
+        activity.duration = round(points / 60, 1)
+        activity.distance = round(points * synthetic.speed / 1000, 2)
+        activity.coordinates = [[round(lat, decimal_places), round(lon, decimal_places)] for lat, lon, _ in track[::10]]
+        activity.update_geometry()
+
+        with open(activity.coords_filename, "w", newline='') as coords_file:
+            writer = csv.writer(coords_file)
+            writer.writerow(['latitude', 'longitude'])
+            writer.writerows(activity.coordinates)
+
+        if index < gpx_sample:
+            with open(activity.gpx_filename, "w") as gpx_file:
+                gpx_file.write(track_to_gpx(activity.name, track, synthetic.start))
+            with open(activity.fit_filename, "wb") as fit_file:
+                fit_file.write(track_to_fit(track, synthetic.start))
+
+    activities = [synthetic.activity for synthetic in synthetic_activities]
+    storage.write_database(activities, config['storage']['activities-database'])
+    for activity in activities:
+        activity.coordinates = []
+    return activities
+
+
+def generate_api_recording(activities, store, latency):
+    """
+    Store responses of Garmin Connect for the activities having a GPX file the way apicache records them, so that the downloader
+    can download them from the REPLAY stand-in. Each call is recorded as taking latency seconds. Returns number of activities.
+    """
+    api_activities = []
+    for activity in activities:
+        if not os.path.exists(activity.gpx_filename):
+            continue
+        api_activities.append({
+            'activityId': activity.activity_id,
+            'activityName': activity.name,
+            'startTimeLocal': f"{activity.date} {activity.time}:00",
+            'activityType': {'typeKey': activity.activity_type},
+            'distance': activity.distance * 1000,
+            'duration': activity.duration * 60
+        })
+        store.save("get_activity", [str(activity.activity_id)], api_activities[-1], latency)
+        with open(activity.gpx_filename, 'rb') as gpx_file:
+            store.save("download_activity", [str(activity.activity_id), "GPX"], gpx_file.read(), latency)
+        with open(activity.fit_filename, 'rb') as fit_file:
+            store.save("download_activity", [str(activity.activity_id), "ORIGINAL"],
+                       fit_to_original_download(activity.activity_id, fit_file.read()), latency)
+    store.save("get_activities_by_date", ["1970-01-01", None, None, "asc"], api_activities, latency)
+    return len(api_activities)
+
+
+def generate_folium_html(activities, polylines_per_group=None):
+    """
+    Generate html resembling what Folium produces when activities are rendered directly as polylines (the format minifier works with)
+    """
+    colors = ["magenta", "dodgerblue", "red", "blueviolet", "orange", "brown", "deeppink"]
+    parts = ["<!DOCTYPE html>\n<html>\n<head></head>\n<body>\n</body>\n<script>\n",
+             "    var map_0123456789abcdef = L.map(\"map_0123456789abcdef\", {});\n"]
+    for index, activity in enumerate(activities):
+        group = index % len(colors) if polylines_per_group is None else index // polylines_per_group
+        color = colors[group % len(colors)]
+        coordinates = ", ".join(f"[{lat}, {lon}]" for lat, lon in activity.coordinates)
+        parts.append(
+            f"            var poly_line_{index:08x} = L.polyline(\n"
+            f"                [{coordinates}],\n"
+            f"                {{\"bubblingMouseEvents\": true, \"color\": \"{color}\", \"dashArray\": null, \"dashOffset\": null, "
+            f"\"fill\": false, \"fillColor\": \"{color}\", \"fillOpacity\": 0.2, \"fillRule\": \"evenodd\", \"lineCap\": \"round\", "
+            f"\"lineJoin\": \"round\", \"noClip\": false, \"opacity\": 0.8, \"smoothFactor\": 3, \"stroke\": true, \"weight\": 3}}\n"
+            f"            ).addTo(feature_group_{group:032x});\n"
+            f"            var popup_{index:08x} = L.popup({{\"maxWidth\": 500}});\n"
+            f"            var html_{index:08x} = $(`<div id=\"html_{index:08x}\" style=\"width: 100.0%; height: 100.0%;\">"
+            f"{activity.name}</div>`)[0];\n"
+            f"            popup_{index:08x}.setContent(html_{index:08x});\n"
+            f"            poly_line_{index:08x}.bindPopup(popup_{index:08x});\n"
+            f"            poly_line_{index:08x}.on({{mouseover: function(e) {{}}, mouseout: function(e) {{}}}});\n")
+    parts.append("</script>\n</html>\n")
+    return "".join(parts)
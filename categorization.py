@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+Assigns activities to categories of the map.
+
+Category of an activity is determined by [activities][rules] first. Rules are evaluated in the order they are defined and the first
+matching one wins. Activities not matched by any rule fall back to [activities][mapping] by their type_key and to the first
+category if their type_key is not mapped at all.
+
+Rules are compiled once into lookups so that categorizing does not get slower with number of rules and categories:
+ - type_key -> ordered list of rules which can apply to it (rules without type-keys condition apply to every type_key)
+ - a single trie (Aho-Corasick automaton) of all name-contains patterns finding all matching patterns in one pass over the name
+ - type_key -> category dict for the fallback mapping
+"""
+from typing import List
+
+from common import logger, config
+
+
+class TypeMapping:
+    def __init__(self, name: str, color: str, type_keys: List[str], show_on_load: bool):
+        self.name = name
+        self.color = color
+        self.type_keys = type_keys
+        self.show_on_load = show_on_load
+
+    def contains_key(self, type_key):
+        return type_key in self.type_keys
+
+
+uncategorized_activity_types = set()
+
+
+def get_type_mappings():
+    mappings = []
+    for mapping in config['activities']['mapping']:
+        show_on_load = mapping.get('name') in config['activities']['display-mapping-on-load']
+        mappings.append(TypeMapping(mapping.get('name'), mapping.get('color'), mapping.get('type_keys'), show_on_load))
+    if len(mappings) == 0:
+        raise ValueError("No type mappings found. Cannot continue. Fix [activities][mapping] config")
+    return mappings
+
+
+class PatternTrie:
+    """Aho-Corasick automaton. Finds all the patterns contained in a text in a single pass over the text."""
+    def __init__(self):
+        # node = index into the lists below
+        self.children = [{}]
+        self.fail = [0]
+        self.outputs = [set()]
+
+    def add(self, pattern, value):
+        node = 0
+        for character in pattern:
+            next_node = self.children[node].get(character)
+            if next_node is None:
+                next_node = len(self.children)
+                self.children[node][character] = next_node
+                self.children.append({})
+                self.fail.append(0)
+                self.outputs.append(set())
+            node = next_node
+        self.outputs[node].add(value)
+
+    def build(self):
+        """Compute failure links. Needs to be called after all patterns are added."""
+        queue = list(self.children[0].values())
+        for node in queue:
+            for character, child in self.children[node].items():
+                queue.append(child)
+                fail = self.fail[node]
+                while fail and character not in self.children[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.children[fail].get(character, 0)
+                self.outputs[child] |= self.outputs[self.fail[child]]
+
+    def find(self, text):
+        """Returns values of all patterns contained in the text"""
+        found = set()
+        node = 0
+        for character in text:
+            while node and character not in self.children[node]:
+                node = self.fail[node]
+            node = self.children[node].get(character, 0)
+            if self.outputs[node]:
+                found |= self.outputs[node]
+        return found
+
+
+class Rule:
+    def __init__(self, index, mapping: TypeMapping, rule_config):
+        self.index = index
+        self.mapping = mapping
+        self.type_keys = rule_config.get('type-keys')
+        self.name_patterns = [pattern.lower() for pattern in rule_config.get('name-contains', [])]
+        self.date_from = rule_config.get('date-from')
+        self.date_to = rule_config.get('date-to')
+        self.months = set(rule_config['months']) if 'months' in rule_config else None
+        self.min_distance = rule_config.get('min-distance')
+        self.max_distance = rule_config.get('max-distance')
+        self.min_speed = rule_config.get('min-speed')
+        self.max_speed = rule_config.get('max-speed')
+
+    def matches_values(self, activity):
+        """Check all conditions except type-keys and name-contains which are resolved by the lookups"""
+        if self.date_from and activity.date < self.date_from:
+            return False
+        if self.date_to and activity.date > self.date_to:
+            return False
+        if self.months is not None and int(activity.date[5:7]) not in self.months:
+            return False
+        if self.min_distance is not None and activity.distance < self.min_distance:
+            return False
+        if self.max_distance is not None and activity.distance > self.max_distance:
+            return False
+        if self.min_speed is not None or self.max_speed is not None:
+            speed = get_speed(activity)
+            if self.min_speed is not None and speed < self.min_speed:
+                return False
+            if self.max_speed is not None and speed > self.max_speed:
+                return False
+        return True
+
+
+def get_speed(activity):
+    """Average speed in km/h"""
+    return activity.distance / (activity.duration / 60) if activity.duration > 0 else 0
+
+
+class Categorizer:
+    def __init__(self, mappings: List[TypeMapping], rules_config):
+        self.mappings = mappings
+        self.default_mapping = mappings[0]
+        mappings_by_name = {mapping.name: mapping for mapping in mappings}
+
+        # the first mapping containing a type_key wins
+        self.type_key_lookup = {}
+        for mapping in mappings:
+            for type_key in mapping.type_keys:
+                self.type_key_lookup.setdefault(type_key, mapping)
+
+        self.rules = []
+        for index, rule_config in enumerate(rules_config):
+            category = rule_config.get('category')
+            if category not in mappings_by_name:
+                raise ValueError(f"Rule {index + 1} in [activities][rules] refers to unknown category '{category}'")
+            self.rules.append(Rule(index, mappings_by_name[category], rule_config))
+
+        generic_rules = [rule for rule in self.rules if rule.type_keys is None]
+        self.rules_by_type_key = {}
+        for rule in self.rules:
+            for type_key in rule.type_keys or []:
+                self.rules_by_type_key.setdefault(type_key, []).append(rule)
+        for type_key, rules in self.rules_by_type_key.items():
+            self.rules_by_type_key[type_key] = sorted(set(rules) | set(generic_rules), key=lambda rule: rule.index)
+        self.generic_rules = generic_rules
+
+        self.name_trie = PatternTrie()
+        for rule in self.rules:
+            for pattern in rule.name_patterns:
+                self.name_trie.add(pattern, rule.index)
+        self.name_trie.build()
+
+    def categorize(self, activity) -> TypeMapping:
+        type_key = activity.activity_type
+        candidates = self.rules_by_type_key.get(type_key, self.generic_rules)
+        if candidates:
+            matched_names = None
+            for rule in candidates:
+                if rule.name_patterns:
+                    if matched_names is None:
+                        matched_names = self.name_trie.find((activity.name or "").lower())
+                    if rule.index not in matched_names:
+                        continue
+                if rule.matches_values(activity):
+                    return rule.mapping
+
+        mapping = self.type_key_lookup.get(type_key)
+        if mapping is not None:
+            return mapping
+
+        if type_key not in uncategorized_activity_types:
+            logger.debug(f"Unmapped activity type: {type_key}. Putting it into '{self.default_mapping.name}' category")
+            uncategorized_activity_types.add(type_key)
+        return self.default_mapping
+
+    def categorize_all(self, activities):
+        """
+        Categorize the whole activity table, yields (activity, mapping) while the activities are iterated so that a stream of them
+        is not held in memory. Category of a type_key no rule can apply to is looked up once for the whole table.
+        """
+        type_key_mappings = {}
+        for activity in activities:
+            type_key = activity.activity_type
+            mapping = type_key_mappings.get(type_key)
+            if mapping is None:
+                mapping = self.categorize(activity)
+                if not self.rules_by_type_key.get(type_key, self.generic_rules):
+                    type_key_mappings[type_key] = mapping
+            yield activity, mapping
+
+
+# (mapping config, rules config) -> compiled categorizer
+categorizer_cache = {}
+
+
+def get_categorizer() -> Categorizer:
+    """Categorizer compiled from the current config. It is compiled only once as long as the config does not change."""
+    activities_config = config['activities']
+    key = repr((activities_config['mapping'], activities_config['display-mapping-on-load'], activities_config.get('rules', [])))
+    categorizer = categorizer_cache.get(key)
+    if categorizer is None:
+        categorizer_cache.clear()
+        categorizer = Categorizer(get_type_mappings(), activities_config.get('rules', []))
+        categorizer_cache[key] = categorizer
+    return categorizer
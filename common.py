@@ -2,20 +2,43 @@
 import logging
 import os.path
 from getpass import getpass
-
-import requests
-from garminconnect import (Garmin, GarminConnectAuthenticationError)
-from garth.exc import GarthHTTPError
+from typing import TYPE_CHECKING
 import tomllib
 import json
 
+if TYPE_CHECKING:
+    from garminconnect import Garmin
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 logger = logging.getLogger(__name__)
+# Populated by load_config(). The dict is updated in place so that modules can import it before the config is loaded.
 config = {}
 
 
-def init_api() -> Garmin:
-    """Initialize Garmin API with your credentials."""
+def init_api() -> "Garmin":
+    """
+    Initialize Garmin API with your credentials.
+    The client is wrapped by the cache of API responses unless [api-cache][mode] is OFF, in REPLAY mode there is no login at all.
+    """
+    cache_mode = config["api-cache"]["mode"]
+    if cache_mode == "OFF":
+        return login()
+
+    # imported here as apicache depends on common
+    import apicache
+    if cache_mode == "REPLAY":
+        return apicache.create_cached_api(None)
+    garmin = login()
+    return apicache.create_cached_api(garmin) if garmin else None
+
+
+def login() -> "Garmin":
+    """Log in to Garmin Connect using the stored tokens or your credentials."""
+    # Garmin client libraries are slow to import, only the processors talking to Garmin Connect need them
+    import requests
+    from garminconnect import (Garmin, GarminConnectAuthenticationError)
+    from garth.exc import GarthHTTPError
+
     token_store = config["storage"]["directory-token-store"]
 
     try:
@@ -70,19 +93,22 @@ def recursive_update(dict1, dict2):
 
 
 def load_config():
-    global config
+    """
+    Load config-default.toml and config-local.toml into the shared config dict.
+    To be called once by the entry point (activities-map.py, consolidation.py, benchmarks) before any processor is used.
+    """
     with open("config-default.toml", "rb") as default_file:
-        config = tomllib.load(default_file)
+        loaded_config = tomllib.load(default_file)
 
     if os.path.exists("config-local.toml"):
         with open("config-local.toml", "rb") as local_file:
-            recursive_update(config, tomllib.load(local_file))
+            recursive_update(loaded_config, tomllib.load(local_file))
     else:
         logger.info("Local config file not found. Creating an empty config-local.toml")
         with open("config-local.toml", "w") as local_file:
             local_file.write("# Put your personal configuration and overrides of default config into this file")
 
+    config.clear()
+    config.update(loaded_config)
     logger.debug("Config values:\n" + json.dumps(config, indent=2))
-
-
-load_config()
+    return config
@@ -27,7 +27,7 @@ import json
 import time
 import xml.etree.ElementTree as ET
 
-from common import logger, init_api
+from common import logger, init_api, load_config
 
 #
 # GARMIN ACTIVITY TYPES
@@ -279,43 +279,134 @@ def upload_manual_activities(api):
     return None
 
 
+def split_gpx(input_filename):
+    """
+    Write each track of the GPX file into its own GPX file, in a single pass over the input.
+    The file is parsed incrementally and every track is released once written, so even large exports do not need to fit in memory.
+    Yields (output filename, timestamp of the first point of the track)
+    """
+    output_prefix = input_filename[:-len(".gpx")] if input_filename.endswith(".gpx") else input_filename
+    root = None
+    depth = 0
+    for event, element in ET.iterparse(input_filename, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = element
+            depth += 1
+            continue
+        depth -= 1
+        if depth != 1:
+            continue
+
+        # a direct child of the root is complete
+        time_element = element.find(".//{*}trkpt/{*}time")
+        if time_element is None:
+            print("Skipping " + element.tag + " without timestamped points")
+        else:
+            output_root = ET.Element(root.tag, root.attrib)
+            output_root.append(element)
+            output_xml = ET.tostring(output_root, encoding="unicode").replace("ns0:", "").replace(":ns0", "")
+            timestamp = time_element.text
+            output_filename = output_prefix + "_" + timestamp + ".gpx"
+            print("Writing into " + output_filename)
+            with open(output_filename, "w") as output_file:
+                output_file.write(output_xml)
+            yield output_filename, timestamp
+        root.remove(element)
+
+
+def find_activity_id(activities, timestamp):
+    """Id of the activity starting at the timestamp (GMT, as in GPX), None if there is none"""
+    for activity in activities:
+        if activity.get("startTimeGMT").replace(" ", "T") + "Z" == timestamp:
+            return activity.get("activityId")
+    return None
+
+
+class UploadQueue:
+    """
+    Uploads files to GarminConnect and polls for the uploaded activities instead of waiting a fixed time after each upload.
+    GarminConnect processes uploads asynchronously, an activity shows up in the list of activities a while after its upload.
+    Up to max_pending uploads are processed at once. Pass a throttled api (see downloader.RateLimitedApi) to limit the request rate.
+    on_uploaded(filename, timestamp, activity_id) is called once an uploaded activity shows up.
+    """
+
+    def __init__(self, api, on_uploaded, max_pending=5, poll_interval=2.0, timeout=180.0):
+        self.api = api
+        self.on_uploaded = on_uploaded
+        self.max_pending = max_pending
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        # timestamp -> (filename, time of the upload)
+        self.pending = {}
+
+    def submit(self, filename, timestamp):
+        while len(self.pending) >= self.max_pending:
+            self.poll()
+        print(" - Uploading " + filename)
+        response = self.api.upload_activity(filename)
+        print(" - " + str(response))
+        self.pending[timestamp] = (filename, time.monotonic())
+
+    def poll(self):
+        """Wait poll_interval and look for the pending uploads, one request per day they start on"""
+        time.sleep(self.poll_interval)
+        for day in sorted({timestamp[:10] for timestamp in self.pending}):
+            # the list is by local dates, the timestamps are in GMT
+            date = datetime.date.fromisoformat(day)
+            activities = self.api.get_activities_by_date((date - datetime.timedelta(days=1)).isoformat(),
+                                                         (date + datetime.timedelta(days=1)).isoformat())
+            for timestamp in [timestamp for timestamp in self.pending if timestamp[:10] == day]:
+                filename, uploaded = self.pending[timestamp]
+                activity_id = find_activity_id(activities, timestamp)
+                if activity_id:
+                    del self.pending[timestamp]
+                    self.on_uploaded(filename, timestamp, activity_id)
+                elif time.monotonic() - uploaded > self.timeout:
+                    del self.pending[timestamp]
+                    print(" - ERROR - " + filename + " did not show up in GarminConnect within " + str(self.timeout) +
+                          "s - check it and adjust activity type manually")
+
+    def finish(self):
+        while self.pending:
+            self.poll()
+
+
 def split_and_upload(api):
     """
     Split GPX file and upload activities
 
     STEPS
       - Load a local GPX file
-      - Extract segments (write into new local GPX files)
+      - Extract segments (write into new local GPX files) in a single pass over the file
           (Forerunners use 1 segment per activity but older GPS devices would put multiple activities into one file which is not handled correctly by Garmin, Strava, etc.
           The behavior is sort of inconsistent, but it often leads to situation where the activity contains even the distance between the individual activities, e.g. spanning half of the republic)
       - For each segment
          - Search and list activities in GarminConnect on the same day
          - If "delete==True", delete the existing activity from GarminConnect
-         - If "upload==True", upload the segment as a new activity to GarminConnect
-            - change type of the uploaded activity based on the specified "activityType"
+      - If "upload==True", upload the segments as new activities to GarminConnect through a throttled queue (see UploadQueue)
+         - change type of the uploaded activity based on the specified "activityType" once it shows up in GarminConnect
+      Existing activities are deleted before anything is uploaded, so an uploaded activity does not get deleted as an existing
+      activity of the next segment on the same day.
     """
+    from downloader import RateLimiter, RateLimitedApi
 
     # INPUT PARAMETERS
     input_file = "data/export"
     activity_type = "inline"
     delete = False  # use with CAUTION! Deletes from GarminConnect
     upload = False
+    requests_per_second = 1  # max number of requests to GarminConnect per second
     # #################
-    content = ET.parse(input_file + '.gpx')
-    item_count = len(content.getroot())
-
-    for index_to_keep in range(item_count):
-        root = ET.parse(input_file + '.gpx').getroot()
-        for i in reversed(range(len(root))):
-            if i != index_to_keep:
-                del root[i]
-        output_xml = ET.tostring(root, encoding="unicode").replace("ns0:", "").replace(":ns0", "")
-        timestamp = root[0][0][0][1].text
-        output_filename = input_file + "_" + timestamp + ".gpx"
-        print("Writing into " + output_filename)
-        with open(output_filename, "w") as output_file:
-            output_file.write(output_xml)
+    api = RateLimitedApi(api, RateLimiter(requests_per_second))
+    new_type_values = ACTIVITY_TYPES.get(activity_type)
 
+    def set_activity_type(filename, timestamp, activity_id):
+        print(" - " + filename + " is activity " + str(activity_id) + ", setting type " + activity_type)
+        api.set_activity_type(activity_id, new_type_values[0], new_type_values[1], new_type_values[2])
+
+    segments = []
+    for output_filename, timestamp in split_gpx(input_file + '.gpx'):
         existing_activities = api.get_activities_by_date(datetime.datetime.fromisoformat(timestamp),
                                                          datetime.datetime.fromisoformat(timestamp))
         for activity in existing_activities:
@@ -325,34 +416,27 @@ def split_and_upload(api):
                 print(" - deleted")
 
         if len(existing_activities) > 1:
-            print(
-                "WARN - multiple activities in one day. This will likely need manual adjustment. Uploaded activity may get deleted by the next activity")
-
-        if upload:
-            print(" - Uploading")
-            response = api.upload_activity(output_filename)
-            print(" - " + str(response))
-            time.sleep(3)
-
-        existing_activities = api.get_activities_by_date(datetime.datetime.fromisoformat(timestamp),
-                                                         datetime.datetime.fromisoformat(timestamp))
-        activity_id = None
-        for activity in existing_activities:
-            if activity.get("startTimeGMT").replace(" ", "T") + "Z" == timestamp:
-                activity_id = activity.get("activityId")
-                break
-
-        if activity_id:
-            new_type_values = ACTIVITY_TYPES.get(activity_type)
-            api.set_activity_type(activity_id, new_type_values[0], new_type_values[1], new_type_values[2])
-        else:
-            print(
-                " - ERROR - did not find activityId of the newly uploaded activity - you need to adjust activity type manually")
+            print("WARN - multiple activities in one day. This will likely need manual adjustment.")
+
+        if not upload and not delete:
+            activity_id = find_activity_id(existing_activities, timestamp)
+            if activity_id:
+                set_activity_type(output_filename, timestamp, activity_id)
+            else:
+                print(" - ERROR - did not find activityId of the activity - you need to adjust activity type manually")
+        segments.append((output_filename, timestamp))
+
+    if upload:
+        upload_queue = UploadQueue(api, set_activity_type)
+        for output_filename, timestamp in segments:
+            upload_queue.submit(output_filename, timestamp)
+        upload_queue.finish()
 
     return None
 
 
 # Main program
+load_config()
 api = init_api()
 
 # Pick one function you want to process, comment out everything else
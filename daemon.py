@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Long-running alternative to running activities-map.py from cron.
+
+The Garmin Connect session and all activities (including their coordinates) are kept in memory between polls. Every poll only asks
+Garmin Connect for activities newer than the last known one. When there are new activities, data files are rewritten only for the
+categories they belong to and only the files actually written are uploaded.
+
+Failed polls are retried with exponential backoff (starting at [daemon][poll-interval-minutes], capped by
+[daemon][max-backoff-minutes]). Categories of a poll which failed to update the map are kept and updated by the next poll, which
+uploads every file differing from the remote site. State of the daemon is written into [daemon][status-file] after every poll so
+that it can be checked by monitoring without parsing logs.
+"""
+import datetime
+import json
+import os
+import time
+
+import downloader
+import ftpuploader
+import instrumentation
+import mapgenerator
+import minifier
+import storage
+from common import logger, config, init_api
+
+
+class DaemonStatus:
+    def __init__(self, filename):
+        self.filename = filename
+        self.values = {
+            'state': 'starting',
+            'pid': os.getpid(),
+            'started': now(),
+            'last_poll': None,
+            'last_success': None,
+            'last_error': None,
+            'consecutive_failures': 0,
+            'activities': 0,
+            'new_activities_last_poll': 0,
+            'next_poll': None,
+        }
+
+    def update(self, **values):
+        self.values.update(values)
+        directory = os.path.dirname(self.filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # write into a temporary file first so that readers never see a partially written status
+        temp_filename = self.filename + ".tmp"
+        with open(temp_filename, 'w') as status_file:
+            json.dump(self.values, status_file, indent=2)
+        os.replace(temp_filename, self.filename)
+
+
+class Daemon:
+    def __init__(self):
+        daemon_config = config['daemon']
+        self.poll_interval = daemon_config['poll-interval-minutes'] * 60
+        self.max_backoff = daemon_config['max-backoff-minutes'] * 60
+        self.status = DaemonStatus(daemon_config['status-file'])
+        self.map_filename = config["output"]["map-filename"]
+        self.map_minified_filename = config["output"]["map-minified-filename"]
+        self.api = None
+        self.activities = None
+        self.synced = False
+        # categories with new activities not applied to the remote site yet, kept when a poll fails so that the next one retries
+        self.pending_categories = set()
+
+    def get_api(self):
+        if self.api is None:
+            self.api = init_api()
+        return self.api
+
+    def load(self):
+        with instrumentation.span("daemon-load"):
+            self.activities = storage.load_activities_from_csv()
+        logger.info(f"Loaded {len(self.activities)} activities")
+
+    def generate_and_upload(self, categories_to_write=None, compare_with_remote=False):
+        """
+        Regenerate data files of the given categories (all by default) and upload the written files
+        compare_with_remote - upload every file differing from the remote site, not only the written ones. Files written by a failed
+                              attempt are not written again, so a retry has to find them by comparing.
+        """
+        mode = config["mode"]
+        written_files = []
+        if mode["map-creator"] == "ON":
+            written_files = mapgenerator.create_map_with_activities(self.activities, self.map_filename, categories_to_write)
+        upload_filename = self.map_filename
+        if mode["minifier"] == "ON":
+            upload_filename = self.map_minified_filename
+            if self.map_filename in written_files or compare_with_remote or not os.path.exists(self.map_minified_filename):
+                minifier.minify(self.map_filename, self.map_minified_filename)
+                written_files.append(self.map_minified_filename)
+        if mode["uploader"] == "ON":
+            # the first upload compares everything with the remote site, later ones send only what was written
+            changed_files = written_files if categories_to_write is not None and not compare_with_remote else None
+            if not ftpuploader.upload_map_with_data_to_ftp_incremental(upload_filename, changed_files):
+                raise RuntimeError("Upload to FTP failed")
+
+    def download(self):
+        new_activities = downloader.download_activities(self.get_api(), existing_activities=self.activities)
+        if new_activities:
+            logger.info(f"Downloaded {len(new_activities)} new activities")
+            self.activities.extend(new_activities)
+        else:
+            logger.info("No new activities")
+        return new_activities
+
+    def poll(self):
+        """Download new activities and apply them to the generated map. Returns number of new activities."""
+        retry = bool(self.pending_categories)
+        new_activities = self.download()
+        self.pending_categories.update(mapgenerator.get_activity_categories(new_activities))
+        if not self.pending_categories:
+            return 0
+
+        if retry:
+            logger.info(f"Retrying update of categories {', '.join(sorted(self.pending_categories))}")
+        self.generate_and_upload(self.pending_categories, compare_with_remote=retry)
+        self.pending_categories = set()
+        return len(new_activities)
+
+    def run(self):
+        logger.info(f"Starting daemon. Polling every {self.poll_interval / 60:.0f} minutes")
+        failures = 0 if self.run_instrumented("daemon-initial-sync", self.initial_sync) else 1
+        while True:
+            delay = self.poll_interval if failures == 0 else min(self.poll_interval * 2 ** failures, self.max_backoff)
+            next_poll = datetime.datetime.now() + datetime.timedelta(seconds=delay)
+            self.status.update(state='waiting' if failures == 0 else 'backoff', next_poll=next_poll.isoformat(timespec='seconds'))
+            time.sleep(delay)
+
+            if self.run_instrumented("daemon-poll", self.poll_once):
+                failures = 0
+            else:
+                failures += 1
+
+    def initial_sync(self):
+        self.load()
+        new_activities = self.download()
+        self.generate_and_upload()
+        self.synced = True
+        self.status.update(new_activities_last_poll=len(new_activities))
+
+    def poll_once(self):
+        if not self.synced:
+            # initial sync failed, the whole map needs to be generated and compared with the remote site
+            self.initial_sync()
+            return
+        new_activities = self.poll()
+        self.status.update(new_activities_last_poll=new_activities)
+
+    def run_instrumented(self, name, action):
+        """Run action as a separate instrumented run and record its outcome in the status file. Returns True on success."""
+        instrumentation.start_run()
+        self.status.update(state='running', last_poll=now())
+        try:
+            with instrumentation.span(name):
+                action()
+        except Exception as e:
+            logger.exception(f"{name} failed")
+            # the session may have expired, login again on the next poll
+            self.api = None
+            failures = self.status.values['consecutive_failures'] + 1
+            self.status.update(last_error=f"{now()} {type(e).__name__}: {e}", consecutive_failures=failures)
+            return False
+        finally:
+            instrumentation.finish_run()
+
+        self.status.update(last_success=now(), consecutive_failures=0, activities=len(self.activities or []))
+        return True
+
+
+def now():
+    return datetime.datetime.now().isoformat(timespec='seconds')
+
+
+def run_daemon():
+    daemon = Daemon()
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        logger.info("Daemon stopped")
+        daemon.status.update(state='stopped', next_poll=None)
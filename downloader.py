@@ -1,21 +1,30 @@
+import concurrent.futures
+import contextlib
 import csv
 import datetime
 import json
 import os.path
-from typing import List
-
-import gpxpy
-from garminconnect import Garmin
-from simplification.cutil import simplify_coords
-
+import threading
+import time
+from typing import List, TYPE_CHECKING
+
+import archive
+import fitfile
+import simplifier
+import spatialindex
 import storage
+import trackcleaner
+from apicache import ACTIVITIES_SEARCH_PATH
 from common import logger, init_api, config
 
+if TYPE_CHECKING:
+    from garminconnect import Garmin
+
 
-def download_activities(api: Garmin, from_date=None, to_date=None):
+def download_activities(api: "Garmin", from_date=None, to_date=None, existing_activities=None):
     """
     Get activities from GarminConnect within a specified date range and save them to files.
-    Appends to a CSV file which is stored as a database of all activities with some basic information about them.
+    Adds them to the database of all activities with some basic information about them (through its journal of changes).
     Exports activity GPS data info into a GPX file.
     Exports other activity fields into a JSON file.
     These two files are not needed for the map but can be used for additional processing without having to re-download
@@ -24,43 +33,128 @@ def download_activities(api: Garmin, from_date=None, to_date=None):
 
     from_date - optional. Date of last activity in DB is used by default
     to_date - optional. Now used by default
+    existing_activities - optional. Activities already in the DB if the caller has them loaded, they are read from the DB otherwise
+
+    Returns the newly downloaded activities (with their coordinates)
     """
 
     storage.init_directories()
-    existing_activities = storage.load_activities_from_csv(False)
-
-    if not from_date:
+    storage.migrate_database()
+    if existing_activities is None:
+        existing_activities = storage.load_activities_from_csv(False)
+
+    cursor = load_listing_cursor()
+    if not from_date and cursor and cursor['to_date'] == format_optional_date(to_date):
+        # the date of the last stored activity moved with the interrupted run, the listing continues in the range it started with
+        from_date = cursor['from_date']
+        logger.info(f"From date not specified. Continuing listing of activities since {from_date}")
+    elif not from_date:
         if len(existing_activities) == 0:
             from_date = "1970-01-01"
         else:
             from_date = existing_activities[len(existing_activities) - 1].date
         logger.info(f"From date not specified. Using date from last stored activity: {from_date}")
 
-    api_activities = api.get_activities_by_date(from_date, to_date, None, "asc")
-
     max_number_of_activities = config["activities"]["max-number-of-activities"]
-    if len(api_activities) > max_number_of_activities:
-        logger.warn(
-            f"Too many activities to process ({len(api_activities)}). Going to process only the first {max_number_of_activities}. Consider using from_date and to_date.")
-        api_activities = api_activities[0:max_number_of_activities]
-
-    logger.info(f"Going to process {len(api_activities)} activities")
-    processed_activity_ids = get_processed_activity_ids(existing_activities)
-
-    with storage.create_appender() as appender:
-        writer = storage.create_writer(appender)
-        if len(processed_activity_ids) == 0:
-            writer.writeheader()
-
-        for api_activity in api_activities:
+    start = get_listing_start(cursor, from_date, to_date)
+    # the next page of the listing is requested from another thread while activities are downloaded over the same session
+    api = SerializedApi(api)
+    processed_activity_ids = set(get_processed_activity_ids(existing_activities))
+    new_activities = []
+
+    with contextlib.closing(iter_api_activities(api, from_date, to_date, start)) as listing:
+        for position, api_activity in listing:
             activity_id = api_activity.get('activityId')
             if activity_id in processed_activity_ids:
                 logger.info(f"Skipping {activity_id} - already in the CSV, i.e. processed in the past")
                 continue
+            if len(new_activities) >= max_number_of_activities:
+                logger.warning(f"Downloaded maximum number of activities ({max_number_of_activities}). The rest is going to be "
+                               f"downloaded by the next run.")
+                save_listing_cursor(from_date, to_date, position)
+                break
 
             activity = map_to_object(api_activity)
             save_json_and_gpx(api, activity, api_activity)
-            storage.write_activity(writer, activity)
+            storage.insert_activity(activity)
+            new_activities.append(activity)
+        else:
+            # listing of another date range leaves the cursor where it is
+            if is_cursor_of(cursor, from_date, to_date):
+                save_listing_cursor(from_date, to_date, None)
+
+    logger.info(f"Downloaded {len(new_activities)} new activities")
+
+    if new_activities:
+        storage.update_derived_data(new_activities)
+    return new_activities
+
+
+def get_activities_page(api: "Garmin", from_date, to_date, start, limit):
+    """One page of activities sorted from the oldest, requested the same way as the Garmin Connect web interface loads them"""
+    params = {"startDate": str(from_date), "start": str(start), "limit": str(limit), "sortOrder": "asc"}
+    if to_date:
+        params["endDate"] = str(to_date)
+    logger.info(f"Listing activities {start} to {start + limit} since {from_date}")
+    return api.connectapi(ACTIVITIES_SEARCH_PATH, params=params) or []
+
+
+def iter_api_activities(api: "Garmin", from_date, to_date, start=0):
+    """
+    Activities from Garmin Connect sorted from the oldest, yielded as (position, activity) while the pages arrive.
+    The next page is requested in the background while the caller processes the current one.
+    """
+    page_size = config["activities"]["listing-page-size"]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        next_page = executor.submit(get_activities_page, api, from_date, to_date, start, page_size)
+        while next_page is not None:
+            page = next_page.result()
+            # a short page is the last one
+            next_page = executor.submit(get_activities_page, api, from_date, to_date, start + len(page), page_size) \
+                if len(page) == page_size else None
+            for api_activity in page:
+                yield start, api_activity
+                start += 1
+
+
+def load_listing_cursor():
+    """Where a previous run stopped listing activities - {'from_date', 'to_date', 'start'}, None when there is no such run"""
+    filename = config["storage"]["download-cursor"]
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'r') as cursor_file:
+        return json.load(cursor_file)
+
+
+def format_optional_date(date):
+    return str(date) if date else None
+
+
+def is_cursor_of(cursor, from_date, to_date):
+    return cursor is not None and cursor['from_date'] == str(from_date) and cursor['to_date'] == format_optional_date(to_date)
+
+
+def get_listing_start(cursor, from_date, to_date):
+    """Position in the listing to continue from, 0 unless the previous run stopped listing the same date range"""
+    if not is_cursor_of(cursor, from_date, to_date):
+        return 0
+    # step back by a page in case some of the listed activities were deleted in Garmin Connect in the meantime,
+    # activities listed twice are skipped as they are in the database already
+    start = max(0, cursor['start'] - config["activities"]["listing-page-size"])
+    logger.info(f"Continuing listing of activities since {from_date} from position {start}")
+    return start
+
+
+def save_listing_cursor(from_date, to_date, start):
+    """Remember where to continue listing the date range, start None means the listing is complete"""
+    filename = config["storage"]["download-cursor"]
+    if start is None:
+        if os.path.exists(filename):
+            os.remove(filename)
+        return
+    with open(filename + ".tmp", 'w') as cursor_file:
+        json.dump({'from_date': str(from_date), 'to_date': format_optional_date(to_date), 'start': start}, cursor_file)
+    os.replace(filename + ".tmp", filename)
 
 
 def map_to_object(api_activity):
@@ -85,30 +179,51 @@ def map_to_object(api_activity):
                             name=api_activity.get('activityName'))
 
 
-def save_json_and_gpx(api: Garmin, activity: storage.Activity, api_activity):
-    logger.info(f"Writing {activity.json_filename}")
-    with open(activity.json_filename, 'w') as json_file:
-        json.dump(api_activity, json_file)
+def save_json_and_gpx(api: "Garmin", activity: storage.Activity, api_activity):
+    archive.save(activity, 'json', json.dumps(api_activity).encode())
 
-    gpx_data = api.download_activity(activity.activity_id, dl_fmt=api.ActivityDownloadFormat.GPX)
-    if len(gpx_data) > 0:
-        coordinates = simplify_coordinates(gpx_data)
+    for track_kind in get_track_kinds():
+        track_data = download_track(api, activity, track_kind)
+        if not track_data:
+            logger.warning(f"No GPS data in {track_kind.upper()} of {activity.activity_id}")
+            continue
+        coordinates, breaks, _ = simplify_coordinates(track_data, track_kind, activity.activity_type)
         if len(coordinates) > 0:
-            logger.info(f"Writing {activity.gpx_filename}")
-            with open(activity.gpx_filename, "wb") as gpx_file:
-                gpx_file.write(gpx_data)
+            archive.save(activity, track_kind, track_data)
+            # a track of the other format from a previous download is outdated
+            for other_kind in archive.TRACK_KINDS:
+                if other_kind != track_kind:
+                    archive.delete(activity, other_kind)
             activity.coordinates = coordinates
+            activity.breaks = breaks
             write_coordinates(activity)
             activity.has_gps_data = True
-        else:
-            logger.warning(f"No coordinates for {activity.activity_id}")
-    else:
-        logger.warning(f"No GPS data for {activity.activity_id}")
+            break
+        logger.warning(f"No coordinates in {track_kind.upper()} of {activity.activity_id}")
 
     return activity
 
 
+def get_track_kinds():
+    """Formats of the track to try in order - the configured one first, GPX is the fallback"""
+    if config["activities"]["track-format"] == "FIT":
+        return ['fit', 'gpx']
+    return ['gpx']
+
+
+def download_track(api: "Garmin", activity: storage.Activity, track_kind):
+    if track_kind == 'gpx':
+        return api.download_activity(activity.activity_id, dl_fmt=api.ActivityDownloadFormat.GPX)
+    original_data = api.download_activity(activity.activity_id, dl_fmt=api.ActivityDownloadFormat.ORIGINAL)
+    try:
+        return fitfile.extract_fit(original_data) if original_data else None
+    except fitfile.FitError as error:
+        logger.warning(f"Original file of {activity.activity_id} is not a FIT file: {error}")
+        return None
+
+
 def write_coordinates(activity: storage.Activity):
+    activity.update_geometry()
     logger.info(f"Writing {activity.coords_filename}")
     with open(activity.coords_filename, "w", newline='') as coords_file:
         coords_writer = csv.writer(coords_file)
@@ -120,42 +235,231 @@ def get_processed_activity_ids(activities: List[storage.Activity]):
     return [activity.activity_id for activity in activities]
 
 
-def simplify_coordinates(gpx_data):
+def simplify_coordinates(track_data, track_kind='gpx', activity_type=None, vertex_budget=None, measure=False):
+    """
+    Clean the track of GPS glitches (see trackcleaner) and simplify it (see simplifier)
+    track_data - content of the GPX or FIT file or a stream of it (e.g. from the archive)
+    Returns (coordinates, indices where parts of the track start except the first one, SimplificationResult)
+    """
+    return simplify_track(read_track_points(track_data, track_kind), activity_type, vertex_budget, measure)
+
+
+def simplify_track(track, activity_type=None, vertex_budget=None, measure=False):
+    parts, cleaning = trackcleaner.clean(track, activity_type)
+    coordinates, breaks, result = simplifier.simplify(parts, vertex_budget, measure)
+    result.removed_points = cleaning.removed_points
+    result.parts = cleaning.parts
+    return coordinates, breaks, result
+
+
+def read_track_points(track_data, track_kind='gpx'):
+    """Full resolution track as a list of (latitude, longitude, timestamp in seconds or None)"""
+    if track_kind == 'fit':
+        return fitfile.read_positions(track_data)
+    return read_gpx_points(track_data)
+
+
+def read_gpx_points(gpx_data):
+    import gpxpy
+
     gpx = gpxpy.parse(gpx_data)
-    coordinates = []
+    points = []
     for track in gpx.tracks:
         for segment in track.segments:
             for point in segment.points:
-                coordinates.append((point.latitude, point.longitude))
-    return simplify_coords(coordinates, config["activities"]["coords-simplification-factor"])
-
-
-def regenerate_simplified_coordinates(activity: storage.Activity):
-    with open(activity.gpx_filename, 'r') as gpx_file:
-        gpx_data = gpx_file.read()
-
-    activity.coordinates = simplify_coordinates(gpx_data)
+                points.append((point.latitude, point.longitude, point.time.timestamp() if point.time else None))
+    return points
+
+
+def read_activity_track(activity: storage.Activity):
+    """Full resolution track of the activity from its GPX or FIT file (see read_track_points), None when there is no such file"""
+    track_kind, track_stream = archive.open_track(activity)
+    if track_stream is None:
+        logger.warning(f"No GPX or FIT file of {activity.activity_id}")
+        return None
+    with track_stream:
+        return read_track_points(track_stream, track_kind)
+
+
+def regenerate_simplified_coordinates(activity: storage.Activity, vertex_budget=None):
+    """Returns measurements of the simplification (SimplificationResult), None when there is no track to simplify"""
+    track = read_activity_track(activity)
+    if track is None:
+        return None
+    activity.coordinates, activity.breaks, result = simplify_track(track, activity.activity_type, vertex_budget, measure=True)
+    result.activity_id = activity.activity_id
     write_coordinates(activity)
+    return result
 
 
 # Regenerate all coordinate files from locally stored activity files
-#  - To be used e.g. when you change format of the coordinate files or when you experiment with simplification factor
+#  - To be used e.g. when you change format of the coordinate files or when you experiment with [simplification]
+#  - Effect of the simplification is written into [storage][simplification-report]
 def regenerate_coordinates():
     activities = storage.load_activities_from_csv()
+    vertex_budget = None
+    if config['simplification']['mode'] == "SIZE_BUDGET":
+        # the budget depends on all the tracks, they are read twice rather than kept in memory
+        vertex_counts = []
+        for activity in activities:
+            track = read_activity_track(activity) if activity.has_gps_data else None
+            if track is not None:
+                parts, _ = trackcleaner.clean(track, activity.activity_type)
+                vertex_counts.append(simplifier.count_vertices(parts))
+        vertex_budget = simplifier.choose_vertex_budget(vertex_counts)
+
+    results = []
     for activity in activities:
         if activity.has_gps_data:
-            regenerate_simplified_coordinates(activity)
+            result = regenerate_simplified_coordinates(activity, vertex_budget)
+            if result is not None:
+                results.append(result)
+    simplifier.write_report(results, vertex_budget)
+    # geometry of the activities changed along with the coordinates
+    storage.rewrite_database(activities)
+    spatialindex.build_index(activities)
 
 
-def reload_activity(api: Garmin, activity_id):
+def reload_activity(api: "Garmin", activity_id):
+    reload_activities(api, [activity_id])
+
+
+def fetch_activity(api: "Garmin", activity_id):
+    """Download the activity and its files. Returns the activity, None when there is no such activity in Garmin Connect."""
     logger.info(f"Re-downloading activity {activity_id}")
     api_activity = api.get_activity(activity_id)
     if not api_activity:
         logger.warning(f"No activity {activity_id} found")
-        return
+        return None
     activity = map_to_object(api_activity)
     save_json_and_gpx(api, activity, api_activity)
-    storage.update_activity(activity)
+    return activity
+
+
+def reload_activities(api: "Garmin", activity_ids):
+    """
+    Re-download activities already in the database and overwrite them locally. Activities are downloaded concurrently by
+    [redownload][max-workers] threads sharing the session and the [redownload][requests-per-second] limit. All the new versions
+    are stored in the database at once.
+    """
+    redownload_config = config['redownload']
+    existing_activities = {activity.activity_id: activity for activity in storage.iter_activities_from_csv()}
+    activity_ids = [int(activity_id) for activity_id in activity_ids]
+    for activity_id in [activity_id for activity_id in activity_ids if activity_id not in existing_activities]:
+        logger.warning(f"Activity {activity_id} not found in the database. It is not going to be re-downloaded")
+    activity_ids = [activity_id for activity_id in dict.fromkeys(activity_ids) if activity_id in existing_activities]
+
+    limited_api = RateLimitedApi(api, RateLimiter(redownload_config['requests-per-second']))
+    activities = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=redownload_config['max-workers']) as executor:
+        futures = {executor.submit(fetch_activity, limited_api, activity_id): activity_id for activity_id in activity_ids}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                activity = future.result()
+            except Exception as error:
+                logger.error(f"Re-downloading activity {futures[future]} failed: {error}")
+                continue
+            if activity:
+                activities.append(activity)
+
+    for activity in activities:
+        old_activity = existing_activities[activity.activity_id]
+        # date and type are part of filename, if they differ, the old files need to be deleted
+        if old_activity.date != activity.date or old_activity.activity_type != activity.activity_type:
+            storage.delete_activity_files(old_activity)
+    logger.info(f"Re-downloaded {len(activities)} of {len(activity_ids)} activities")
+    if not activities:
+        return activities
+
+    storage.update_activities(activities)
+    # previous versions of the activities are replaced, e.g. their contribution is subtracted from the heatmap
+    storage.update_derived_data(activities)
+    return activities
+
+
+def get_activities_to_redownload(api: "Garmin"):
+    """Ids of activities selected by [redownload] - listed ids, activities within the date range and activities changed since"""
+    redownload_config = config['redownload']
+    activity_ids = [int(activity_id) for activity_id in redownload_config['activity-ids']]
+
+    date_from = redownload_config['date-from']
+    if date_from:
+        date_to = redownload_config['date-to'] or datetime.date.today().isoformat()
+        activity_ids += [activity.activity_id for activity in storage.iter_activities_from_csv()
+                         if date_from <= activity.date <= date_to]
+
+    changed_since = redownload_config['changed-since']
+    if changed_since:
+        # Garmin Connect does not tell when an activity was modified, the listing is compared with the database instead
+        existing_activities = {activity.activity_id: activity for activity in storage.iter_activities_from_csv()
+                               if activity.date >= changed_since}
+        with contextlib.closing(iter_api_activities(api, changed_since, None)) as listing:
+            for _, api_activity in listing:
+                existing_activity = existing_activities.get(api_activity.get('activityId'))
+                if existing_activity and is_changed(existing_activity, map_to_object(api_activity)):
+                    activity_ids.append(existing_activity.activity_id)
+
+    return list(dict.fromkeys(activity_ids))
+
+
+def is_changed(stored: storage.Activity, listed: storage.Activity):
+    return ((stored.name, stored.activity_type, stored.date, stored.time, stored.distance, stored.duration) !=
+            (listed.name, listed.activity_type, listed.date, listed.time, listed.distance, listed.duration))
+
+
+class RateLimiter:
+    """Spaces calls evenly so that there are at most requests_per_second of them, shared by threads"""
+
+    def __init__(self, requests_per_second):
+        self.interval = 1 / requests_per_second if requests_per_second > 0 else 0
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class RateLimitedApi:
+    """Garmin client whose every call waits for the rate limiter"""
+
+    def __init__(self, api: "Garmin", limiter: RateLimiter):
+        self.api = api
+        self.limiter = limiter
+
+    def __getattr__(self, name):
+        attribute = getattr(self.api, name)
+        # classes (e.g. ActivityDownloadFormat) and values are passed as they are
+        if not callable(attribute) or isinstance(attribute, type):
+            return attribute
+
+        def call(*args, **kwargs):
+            self.limiter.wait()
+            return attribute(*args, **kwargs)
+        return call
+
+
+class SerializedApi:
+    """Garmin client whose calls are made one at a time - its session (and refresh of its tokens) must not be used by two threads"""
+
+    def __init__(self, api: "Garmin"):
+        self.api = api
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attribute = getattr(self.api, name)
+        # classes (e.g. ActivityDownloadFormat) and values are passed as they are
+        if not callable(attribute) or isinstance(attribute, type):
+            return attribute
+
+        def call(*args, **kwargs):
+            with self.lock:
+                return attribute(*args, **kwargs)
+        return call
 
 
 def get_datetime_from_activity(activity_json: json):
@@ -169,19 +473,20 @@ def get_datetime_from_activity(activity_json: json):
 # Regenerate the CSV file by reading it and writing it again
 # - To be used e.g. when you change format of the data or add a column
 def regenerate_csv():
-    existing_activities = storage.load_and_backup()
+    existing_activities = storage.load_activities_from_csv(False)
     for activity in existing_activities:
-        if not os.path.exists(activity.json_filename):
+        json_stream = archive.open_json(activity)
+        if json_stream is None:
             print(f"{activity.json_filename} does not exist")
             exit(1)
-        with open(activity.json_filename, mode='r') as json_file:
-            activity_json = json.load(json_file)
+        with json_stream:
+            activity_json = json.load(json_stream)
         # this piece of code was used to add a time field to the CSV database
         # change it to whatever operation is needed
         time_object = get_datetime_from_activity(activity_json)
         activity.time = time_object.strftime("%H:%M")
 
-    storage.write_database(existing_activities)
+    storage.rewrite_database(existing_activities)
 
 
 # Download recent activities from GarminConnect to update local state to latest
@@ -195,3 +500,12 @@ def download_new_activities():
 def redownload_activity(activity_id):
     api = init_api()
     reload_activity(api, activity_id)
+
+
+# Redownload activities selected in [redownload] using a single session
+# - To be used when many activities were modified in GC
+def redownload_activities():
+    api = init_api()
+    activity_ids = get_activities_to_redownload(api)
+    logger.info(f"Going to re-download {len(activity_ids)} activities")
+    reload_activities(api, activity_ids)
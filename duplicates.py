@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Detection of duplicate activities in the local database - the same activity recorded by several devices at once, uploaded more
+than once, or uploaded from my device as well as from a partner's device (see consolidation.categorize_activities).
+
+1. candidates   .. activities overlapping in time. Activities sorted by their start are swept once while keeping those still in
+                   progress, so only activities overlapping in time are ever compared, not all the pairs. Pairs overlapping by less
+                   than [duplicates][min-time-overlap] of the shorter activity or with disjoint bounding boxes are dropped.
+2. confirmation .. discrete Fréchet distance of the simplified tracks (coordinates files, resampled to at most frechet-points).
+                   Pairs within max-frechet-distance-m are duplicates. Candidates without GPS data are reported as unconfirmed.
+3. groups       .. duplicates are grouped, the activity with the most detailed track is kept, the others are excluded.
+
+Utility mode FIND_DUPLICATES writes the ranked pairs and the groups into [storage][duplicates-report]. With
+[duplicates][exclude-from-map] the excluded activities of the last report are left out of the map.
+"""
+import datetime
+import heapq
+import json
+import math
+import os
+
+import storage
+from common import logger, config
+
+METRES_PER_DEGREE = 111320
+# excluded activity ids of the report, read once
+excluded_ids = {}
+
+
+class Candidate:
+    def __init__(self, first: storage.Activity, second: storage.Activity, time_overlap):
+        self.first = first
+        self.second = second
+        self.time_overlap = time_overlap
+        self.frechet_distance = None
+
+    @property
+    def confirmed(self):
+        return self.frechet_distance is not None and self.frechet_distance <= config['duplicates']['max-frechet-distance-m']
+
+    def to_dict(self):
+        return {
+            'activity_ids': [self.first.activity_id, self.second.activity_id],
+            'names': [self.first.name, self.second.name],
+            'types': [self.first.activity_type, self.second.activity_type],
+            'start': [f"{self.first.date} {self.first.time}", f"{self.second.date} {self.second.time}"],
+            'distance': [self.first.distance, self.second.distance],
+            'time_overlap': round(self.time_overlap, 3),
+            'frechet_distance_m': round(self.frechet_distance, 1) if self.frechet_distance is not None else None,
+            'confirmed': self.confirmed,
+        }
+
+
+def get_interval(activity: storage.Activity):
+    """Start and end of the activity in minutes (local time), activities are at least a minute long"""
+    start = datetime.datetime.fromisoformat(f"{activity.date}T{activity.time or '00:00'}")
+    start_minutes = start.timestamp() / 60
+    return start_minutes, start_minutes + max(activity.duration, 1.0)
+
+
+def iter_time_overlaps(activities):
+    """Pairs of activities overlapping in time with the overlap as a fraction of the shorter one, by a single sweep over the starts"""
+    intervals = sorted((get_interval(activity) + (index,) for index, activity in enumerate(activities)))
+    # (end, start, index) of activities in progress at the start of the current one
+    in_progress = []
+    for start, end, index in intervals:
+        while in_progress and in_progress[0][0] <= start:
+            heapq.heappop(in_progress)
+        for other_end, other_start, other_index in in_progress:
+            overlap = min(end, other_end) - start
+            yield activities[other_index], activities[index], overlap / min(end - start, other_end - other_start)
+        heapq.heappush(in_progress, (end, start, index))
+
+
+def bboxes_intersect(first: storage.Activity, second: storage.Activity):
+    if first.bbox is None or second.bbox is None:
+        return True
+    return not (first.bbox[2] < second.bbox[0] or second.bbox[2] < first.bbox[0] or
+                first.bbox[3] < second.bbox[1] or second.bbox[3] < first.bbox[1])
+
+
+def find_candidates(activities):
+    min_overlap = config['duplicates']['min-time-overlap']
+    return [Candidate(first, second, overlap) for first, second, overlap in iter_time_overlaps(activities)
+            if overlap >= min_overlap and bboxes_intersect(first, second)]
+
+
+def resample(coordinates, max_points):
+    """Track as NumPy array of (latitude, longitude) with at most max_points points"""
+    import numpy as np
+
+    points = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+    if len(points) > max_points:
+        points = points[np.linspace(0, len(points) - 1, max_points).round().astype(int)]
+    return points
+
+
+def frechet_distance(first, second):
+    """
+    Discrete Fréchet distance in metres of two tracks (NumPy arrays of (latitude, longitude)), computed by anti-diagonals of the
+    coupling table
+    """
+    import numpy as np
+
+    # both tracks in the same local projection
+    scale = np.array([METRES_PER_DEGREE, METRES_PER_DEGREE * math.cos(math.radians(float(first[:, 0].mean())))])
+    distances = np.linalg.norm((first * scale)[:, None, :] - (second * scale)[None, :, :], axis=2)
+    rows, columns = distances.shape
+    coupling = np.full((rows, columns), np.inf)
+    coupling[0, 0] = distances[0, 0]
+    for diagonal in range(1, rows + columns - 1):
+        i = np.arange(max(0, diagonal - columns + 1), min(rows, diagonal + 1))
+        j = diagonal - i
+        previous = np.full(len(i), np.inf)
+        # cells of the previous diagonals (i-1, j), (i, j-1) and (i-1, j-1)
+        for d_i, d_j in ((1, 0), (0, 1), (1, 1)):
+            valid = (i >= d_i) & (j >= d_j)
+            previous[valid] = np.minimum(previous[valid], coupling[i[valid] - d_i, j[valid] - d_j])
+        coupling[i, j] = np.maximum(distances[i, j], previous)
+    return float(coupling[-1, -1])
+
+
+def confirm_candidates(candidates):
+    """Compute Fréchet distance of the candidates having GPS data, each coordinates file is read once"""
+    max_points = config['duplicates']['frechet-points']
+    tracks = {}
+
+    def get_track(activity):
+        if activity.activity_id not in tracks:
+            coordinates = storage.read_coordinates(activity.coords_filename) if activity.has_gps_data else []
+            tracks[activity.activity_id] = resample(coordinates, max_points) if coordinates else None
+        return tracks[activity.activity_id]
+
+    for candidate in candidates:
+        first = get_track(candidate.first)
+        second = get_track(candidate.second)
+        if first is not None and second is not None:
+            candidate.frechet_distance = frechet_distance(first, second)
+
+
+def group_duplicates(candidates):
+    """Groups of confirmed duplicates as (kept activity, excluded activities). The most detailed (then the longest) track is kept."""
+    parents = {}
+
+    def find(activity_id):
+        while parents.setdefault(activity_id, activity_id) != activity_id:
+            parents[activity_id] = parents[parents[activity_id]]
+            activity_id = parents[activity_id]
+        return activity_id
+
+    activities = {}
+    for candidate in candidates:
+        if candidate.confirmed:
+            activities[candidate.first.activity_id] = candidate.first
+            activities[candidate.second.activity_id] = candidate.second
+            parents[find(candidate.first.activity_id)] = find(candidate.second.activity_id)
+
+    groups = {}
+    for activity_id, activity in activities.items():
+        groups.setdefault(find(activity_id), []).append(activity)
+    result = []
+    for members in groups.values():
+        members.sort(key=lambda activity: (-activity.point_count, -activity.distance, activity.activity_id))
+        result.append((members[0], members[1:]))
+    return result
+
+
+def find_duplicates(activities=None):
+    """
+    Utility mode FIND_DUPLICATES - detect duplicates and write the report into [storage][duplicates-report]
+    activities - optional. All activities of the database by default
+    """
+    activities = list(activities if activities is not None else storage.iter_activities_from_csv())
+    candidates = find_candidates(activities)
+    logger.info(f"{len(candidates)} pairs of {len(activities)} activities overlap in time")
+    confirm_candidates(candidates)
+    # confirmed first, the most similar tracks on top
+    candidates.sort(key=lambda candidate: (not candidate.confirmed,
+                                           candidate.frechet_distance if candidate.frechet_distance is not None else math.inf,
+                                           -candidate.time_overlap))
+    groups = group_duplicates(candidates)
+    excluded = sorted(activity.activity_id for _, group_excluded in groups for activity in group_excluded)
+    report = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'activities': len(activities),
+        'candidates': len(candidates),
+        'confirmed': sum(1 for candidate in candidates if candidate.confirmed),
+        'excluded': excluded,
+        'groups': [{'keep': kept.activity_id, 'exclude': [activity.activity_id for activity in group_excluded]}
+                   for kept, group_excluded in groups],
+        'pairs': [candidate.to_dict() for candidate in candidates],
+    }
+    filename = config['storage']['duplicates-report']
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    with open(filename + ".tmp", 'w') as report_file:
+        json.dump(report, report_file, indent=1, ensure_ascii=False)
+    os.replace(filename + ".tmp", filename)
+    excluded_ids[filename] = set(excluded)
+
+    for candidate in candidates:
+        if candidate.confirmed:
+            logger.info(f"Duplicate: {candidate.first} and {candidate.second}, time overlap {candidate.time_overlap:.0%}, "
+                        f"tracks {candidate.frechet_distance:.0f} m apart")
+    logger.info(f"{report['confirmed']} duplicates in {len(groups)} groups, {len(excluded)} activities to exclude. "
+                f"Report written into {filename}")
+    return report
+
+
+def get_excluded_ids():
+    """Ids of activities excluded from the map by the last report, empty unless [duplicates][exclude-from-map]"""
+    if not config['duplicates']['exclude-from-map']:
+        return set()
+    filename = config['storage']['duplicates-report']
+    if filename not in excluded_ids:
+        excluded_ids[filename] = set()
+        if os.path.exists(filename):
+            with open(filename, 'r') as report_file:
+                excluded_ids[filename] = set(json.load(report_file)['excluded'])
+    return excluded_ids[filename]
+
+
+def filter_excluded(activities):
+    """Activities without those excluded from the map as duplicates"""
+    excluded = get_excluded_ids()
+    if not excluded:
+        return activities
+    return (activity for activity in activities if activity.activity_id not in excluded)
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+Explored tiles (aka visited squares) - slippy map tiles of [explorer-tiles][zoom] touched by the activities.
+
+Tiles of an activity are computed from its full resolution track (GPX or FIT file, coordinates file when there is no GPX) with NumPy and
+stored per activity in [storage][explored-tiles]. The downloader adds tiles of every new or re-downloaded activity, so a new
+activity costs only its own tiles. The store is built from all the local activities when it does not exist.
+
+From the union of the tiles the map creator computes
+ - max cluster .. the largest 4-connected group of tiles whose all four neighbours are explored
+ - max square  .. the largest square of explored tiles
+and exports them as an overlay of the map.
+"""
+import json
+import math
+import os
+import re
+
+import archive
+import fitfile
+import storage
+from common import logger, config
+
+STORE_VERSION = 1
+# consecutive points further apart than this (in tiles) are considered a gap in recording, tiles in between are not explored
+MAX_INTERPOLATED_GAP = 4
+TRKPT_PATTERN = re.compile(r'<(?:\w+:)?trkpt\b([^>]*)>')
+LAT_PATTERN = re.compile(r'\blat="([^"]+)"')
+LON_PATTERN = re.compile(r'\blon="([^"]+)"')
+
+
+def read_track(activity: storage.Activity):
+    """Full resolution track of the activity as (latitudes, longitudes) NumPy arrays"""
+    import numpy as np
+
+    track_kind, track_stream = archive.open_track(activity)
+    if track_kind == 'fit':
+        with track_stream:
+            positions = fitfile.read_positions(track_stream)
+        points = np.array([(lat, lon) for lat, lon, _ in positions], dtype=np.float64).reshape(-1, 2)
+        return points[:, 0], points[:, 1]
+    if track_kind == 'gpx':
+        with track_stream:
+            gpx_data = track_stream.read().decode('utf-8')
+        latitudes = []
+        longitudes = []
+        for match in TRKPT_PATTERN.finditer(gpx_data):
+            attributes = match.group(1)
+            latitudes.append(LAT_PATTERN.search(attributes).group(1))
+            longitudes.append(LON_PATTERN.search(attributes).group(1))
+        return np.array(latitudes, dtype=np.float64), np.array(longitudes, dtype=np.float64)
+
+    coordinates = storage.read_coordinates(activity.coords_filename) if activity.has_gps_data else []
+    points = np.array(coordinates, dtype=np.float64).reshape(-1, 2)
+    return points[:, 0], points[:, 1]
+
+
+def get_tiles(latitudes, longitudes, zoom):
+    """Sorted unique codes (x * 2^zoom + y) of tiles touched by the track"""
+    import numpy as np
+
+    if len(latitudes) == 0:
+        return np.empty(0, dtype=np.int64)
+    n = 2 ** zoom
+    x = (longitudes + 180.0) / 360.0 * n
+    y = (1.0 - np.arcsinh(np.tan(np.radians(np.clip(latitudes, -85.0511, 85.0511)))) / math.pi) / 2.0 * n
+
+    if len(x) > 1:
+        # add points along segments longer than half of a tile, so that no tile the track passes through is skipped
+        d_x = np.diff(x)
+        d_y = np.diff(y)
+        distance = np.maximum(np.abs(d_x), np.abs(d_y))
+        extra = np.where(distance <= MAX_INTERPOLATED_GAP, np.ceil(distance * 2).astype(np.int64) - 1, 0).clip(min=0)
+        total = int(extra.sum())
+        if total:
+            segments = np.repeat(np.arange(len(d_x)), extra)
+            # position of each added point within its segment: 1 .. extra
+            position = np.arange(total) - np.repeat(np.cumsum(extra) - extra, extra) + 1
+            fraction = position / np.repeat(extra + 1, extra)
+            x = np.concatenate([x, x[segments] + d_x[segments] * fraction])
+            y = np.concatenate([y, y[segments] + d_y[segments] * fraction])
+
+    tile_x = np.clip(np.floor(x).astype(np.int64), 0, n - 1)
+    tile_y = np.clip(np.floor(y).astype(np.int64), 0, n - 1)
+    return np.unique(tile_x * n + tile_y)
+
+
+class TileStore:
+    def __init__(self, zoom):
+        self.zoom = zoom
+        # activity id -> list of tile codes
+        self.activities = {}
+
+    def add(self, activity: storage.Activity):
+        latitudes, longitudes = read_track(activity)
+        tiles = get_tiles(latitudes, longitudes, self.zoom)
+        if len(tiles):
+            self.activities[activity.activity_id] = tiles.tolist()
+        else:
+            self.activities.pop(activity.activity_id, None)
+
+    def get_all_tiles(self):
+        import numpy as np
+
+        if not self.activities:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate([np.array(tiles, dtype=np.int64) for tiles in self.activities.values()]))
+
+
+def get_store_filename():
+    return config['storage']['explored-tiles']
+
+
+def load_store():
+    """Load tiles of activities, build them from the local activities if they do not exist or were computed for a different zoom"""
+    filename = get_store_filename()
+    zoom = config['explorer-tiles']['zoom']
+    if os.path.exists(filename):
+        with open(filename, 'r') as store_file:
+            values = json.load(store_file)
+        if values.get('version') == STORE_VERSION and values['zoom'] == zoom:
+            store = TileStore(zoom)
+            store.activities = {int(activity_id): tiles for activity_id, tiles in values['activities'].items()}
+            return store
+        logger.info(f"Explored tiles {filename} are outdated")
+    return build_store()
+
+
+def save_store(store: TileStore):
+    filename = get_store_filename()
+    temp_filename = filename + ".tmp"
+    values = {'version': STORE_VERSION, 'zoom': store.zoom,
+              'activities': {str(activity_id): tiles for activity_id, tiles in store.activities.items()}}
+    with open(temp_filename, 'w') as store_file:
+        store_file.write(json.dumps(values, separators=(',', ':')))
+    os.replace(temp_filename, filename)
+
+
+def build_store():
+    logger.info("Computing explored tiles of all activities")
+    store = TileStore(config['explorer-tiles']['zoom'])
+    for activity in storage.iter_activities_from_csv():
+        if activity.has_gps_data:
+            store.add(activity)
+    save_store(store)
+    logger.info(f"Explored tiles computed for {len(store.activities)} activities")
+    return store
+
+
+def update_store(activities, existing_ids=None):
+    """
+    Compute tiles of new or re-downloaded activities. Activities no longer in the database are dropped.
+    existing_ids - optional. Ids of the activities in the database, read from it by default
+    """
+    if not config['explorer-tiles']['enabled']:
+        return
+    if not os.path.exists(get_store_filename()):
+        # the activities are already in the storage, a fresh store contains them
+        build_store()
+        return
+
+    store = load_store()
+    if existing_ids is None:
+        existing_ids = {activity.activity_id for activity in storage.iter_activities_from_csv()}
+    for activity_id in [activity_id for activity_id in store.activities if activity_id not in existing_ids]:
+        del store.activities[activity_id]
+    for activity in activities:
+        store.add(activity)
+    save_store(store)
+    logger.info(f"Explored tiles updated with {len(activities)} activities")
+
+
+def get_max_cluster(tiles, zoom):
+    """Largest 4-connected group of tiles having all four neighbours explored. Returns array of tile codes."""
+    import numpy as np
+
+    n = 2 ** zoom
+    surrounded = (np.isin(tiles - n, tiles) & np.isin(tiles + n, tiles) &
+                  np.isin(tiles - 1, tiles) & np.isin(tiles + 1, tiles))
+    remaining = set(tiles[surrounded].tolist())
+    largest = []
+    while remaining:
+        start = remaining.pop()
+        cluster = [start]
+        queue = [start]
+        while queue:
+            tile = queue.pop()
+            for neighbour in (tile - n, tile + n, tile - 1, tile + 1):
+                if neighbour in remaining:
+                    remaining.remove(neighbour)
+                    cluster.append(neighbour)
+                    queue.append(neighbour)
+        if len(cluster) > len(largest):
+            largest = cluster
+    return np.array(sorted(largest), dtype=np.int64)
+
+
+def get_max_square(tiles, zoom):
+    """Largest square of explored tiles. Returns (x, y, size) of its top left tile, or None when there are no tiles."""
+    n = 2 ** zoom
+    # size of the largest square having the tile as its bottom right corner
+    sizes = {}
+    best = None
+    for tile in sorted(tiles.tolist(), key=lambda code: (code % n, code // n)):
+        size = 1 + min(sizes.get(tile - n, 0), sizes.get(tile - 1, 0), sizes.get(tile - n - 1, 0))
+        sizes[tile] = size
+        if best is None or size > best[2]:
+            best = (tile // n - size + 1, tile % n - size + 1, size)
+    return best
+
+
+def encode_rows(tiles, zoom):
+    """Tiles as runs of consecutive x per row: {y: [x1, length1, x2, length2, ...]}"""
+    n = 2 ** zoom
+    rows = {}
+    for x, y in sorted(((code // n, code % n) for code in tiles.tolist()), key=lambda tile: (tile[1], tile[0])):
+        runs = rows.setdefault(str(y), [])
+        if runs and runs[-2] + runs[-1] == x:
+            runs[-1] += 1
+        else:
+            runs.extend([x, 1])
+    return rows
+
+
+def get_map_export():
+    """Overlay data for the map: explored tiles, the max cluster and the max square"""
+    store = load_store()
+    zoom = store.zoom
+    tiles = store.get_all_tiles()
+    cluster = get_max_cluster(tiles, zoom)
+    square = get_max_square(tiles, zoom)
+    logger.info(f"Explored tiles: {len(tiles)}, max cluster: {len(cluster)}, max square: {square[2] if square else 0}")
+    return {
+        'zoom': zoom,
+        'tile_count': len(tiles),
+        'tiles': encode_rows(tiles, zoom),
+        'max_cluster_size': len(cluster),
+        'max_cluster': encode_rows(cluster, zoom),
+        'max_square': {'x': square[0], 'y': square[1], 'size': square[2]} if square else None
+    }
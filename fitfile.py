@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Minimal decoder of FIT files (the binary format Garmin devices record activities in), see the FIT protocol description at
+https://developer.garmin.com/fit/protocol/
+
+Only what the map needs is decoded - position and timestamp of record messages. The rest of the file (laps, sessions, heart rate,
+developer fields, ...) is skipped without being parsed. Garmin Connect serves the original file in a ZIP archive, extract_fit gets
+the FIT file out of it.
+"""
+import io
+import struct
+import zipfile
+
+RECORD_MESSAGE = 20
+FIELD_POSITION_LAT = 0
+FIELD_POSITION_LONG = 1
+FIELD_TIMESTAMP = 253
+INVALID_POSITION = 0x7FFFFFFF
+SEMICIRCLES_TO_DEGREES = 180 / 2 ** 31
+# FIT timestamps are seconds since 1989-12-31 00:00 UTC
+FIT_EPOCH = 631065600
+
+
+class FitError(Exception):
+    pass
+
+
+class MessageDefinition:
+    """Layout of data messages of a local message type, compiled into a struct reading just the fields needed"""
+
+    def __init__(self, global_message, fields, developer_size, big_endian):
+        self.global_message = global_message
+        formats = ['>' if big_endian else '<']
+        names = []
+        for number, size in fields:
+            if global_message == RECORD_MESSAGE and size == 4 and number in (FIELD_POSITION_LAT, FIELD_POSITION_LONG):
+                formats.append('i')
+                names.append(number)
+            elif size == 4 and number == FIELD_TIMESTAMP:
+                formats.append('I')
+                names.append(number)
+            else:
+                formats.append(f'{size}x')
+        formats.append(f'{developer_size}x')
+        self.struct = struct.Struct(''.join(formats))
+        self.names = names
+
+
+def extract_fit(data: bytes):
+    """The FIT file as downloaded in the ORIGINAL format (a ZIP archive) or the FIT file itself"""
+    if not data.startswith(b'PK'):
+        return data
+    try:
+        with zipfile.ZipFile(io.BytesIO(data)) as zip_file:
+            names = [name for name in zip_file.namelist() if name.lower().endswith('.fit')]
+            if not names:
+                raise FitError("No FIT file in the downloaded archive")
+            return zip_file.read(names[0])
+    except zipfile.BadZipFile as error:
+        raise FitError(f"Corrupt archive with the FIT file: {error}")
+
+
+def read_positions(fit_data):
+    """
+    Positions of the track as a list of (latitude, longitude, timestamp) tuples, timestamp in seconds since the Unix epoch
+    (None when the record has none). fit_data - content of the FIT file or a binary stream of it.
+    """
+    data = fit_data if isinstance(fit_data, (bytes, bytearray)) else fit_data.read()
+    positions = []
+    offset = 0
+    # a FIT file may be a chain of several FIT files
+    try:
+        while offset + 12 <= len(data):
+            offset = read_file(data, offset, positions)
+    except (struct.error, IndexError) as error:
+        raise FitError(f"Corrupt FIT file: {error}")
+    return positions
+
+
+def read_file(data, offset, positions):
+    header_size = data[offset]
+    if header_size < 12 or data[offset + 8:offset + 12] != b'.FIT':
+        raise FitError(f"Not a FIT file (offset {offset})")
+    data_size, = struct.unpack_from('<I', data, offset + 4)
+    position = offset + header_size
+    end = position + data_size
+    if end > len(data):
+        raise FitError("Truncated FIT file")
+
+    definitions = {}
+    last_timestamp = None
+    while position < end:
+        record_header = data[position]
+        position += 1
+        if record_header & 0x80:
+            # compressed timestamp header - a data message with time offset from the last timestamp
+            local_message = (record_header >> 5) & 0x03
+            time_offset = record_header & 0x1F
+            if last_timestamp is not None:
+                timestamp = (last_timestamp & ~0x1F) + time_offset
+                if time_offset < (last_timestamp & 0x1F):
+                    timestamp += 0x20
+                last_timestamp = timestamp
+        elif record_header & 0x40:
+            position = read_definition(data, position, record_header, definitions)
+            continue
+        else:
+            local_message = record_header & 0x0F
+
+        definition = definitions.get(local_message)
+        if definition is None:
+            raise FitError(f"Data message without definition (offset {position - 1})")
+        values = dict(zip(definition.names, definition.struct.unpack_from(data, position)))
+        position += definition.struct.size
+        if FIELD_TIMESTAMP in values:
+            last_timestamp = values[FIELD_TIMESTAMP]
+        if definition.global_message == RECORD_MESSAGE:
+            lat = values.get(FIELD_POSITION_LAT, INVALID_POSITION)
+            lon = values.get(FIELD_POSITION_LONG, INVALID_POSITION)
+            if lat != INVALID_POSITION and lon != INVALID_POSITION:
+                positions.append((lat * SEMICIRCLES_TO_DEGREES, lon * SEMICIRCLES_TO_DEGREES,
+                                  last_timestamp + FIT_EPOCH if last_timestamp is not None else None))
+    # data is followed by 2 bytes of CRC
+    return end + 2
+
+
+def read_definition(data, position, record_header, definitions):
+    big_endian = data[position + 1] == 1
+    global_message, = struct.unpack_from('>H' if big_endian else '<H', data, position + 2)
+    fields_count = data[position + 4]
+    position += 5
+    fields = [(data[position + index * 3], data[position + index * 3 + 1]) for index in range(fields_count)]
+    position += fields_count * 3
+    developer_size = 0
+    if record_header & 0x20:
+        developer_fields_count = data[position]
+        position += 1
+        developer_size = sum(data[position + index * 3 + 1] for index in range(developer_fields_count))
+        position += developer_fields_count * 3
+    definitions[record_header & 0x0F] = MessageDefinition(global_message, fields, developer_size, big_endian)
+    return position
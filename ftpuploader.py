@@ -3,8 +3,7 @@ import os
 from pathlib import Path
 from datetime import datetime
 
-from cryptography.fernet import Fernet
-
+import instrumentation
 from common import logger, config
 
 # random key used to encrypt/decrypt FTP password
@@ -12,8 +11,9 @@ CRYPTO_KEY = 'mMF32hspwbAhawquFRC070fczdWLb0nF3dX4fHd7R_k='
 
 
 class FtpConfig:
-    def __init__(self, ftp_host, ftp_user, ftp_pass, remote_path, remote_filename):
+    def __init__(self, ftp_host, ftp_user, ftp_pass, remote_path, remote_filename, ftp_port=21):
         self.host = ftp_host
+        self.port = ftp_port
         self.user = ftp_user
         self.password = ftp_pass
         self.remote_path = remote_path
@@ -26,10 +26,31 @@ class FtpConfig:
             ftp_user=config_dict['ftp']['user'],
             ftp_pass=decrypt(config_dict['ftp']['pass']),
             remote_path=config_dict['ftp']['remote-path'],
-            remote_filename=config_dict['ftp']['remote-filename']
+            remote_filename=config_dict['ftp']['remote-filename'],
+            ftp_port=config_dict['ftp'].get('port', 21)
         )
 
 
+def connect(ftp_config: FtpConfig):
+    logger.info(f"Connecting to {ftp_config.host} as {ftp_config.user}")
+    ftp = ftplib.FTP()
+    ftp.connect(ftp_config.host, ftp_config.port)
+    ftp.login(user=ftp_config.user, passwd=ftp_config.password)
+    ftp.cwd(ftp_config.remote_path)
+    return ftp
+
+
+def quit_ftp(ftp):
+    """Close the connection if there is one, a failure to close it does not fail the upload"""
+    if ftp is None:
+        return
+    try:
+        ftp.quit()
+    except ftplib.all_errors as e:
+        logger.debug(f"Could not close the FTP connection: {e}")
+        ftp.close()
+
+
 def get_remote_file_info(ftp, filename):
     """Get remote file modification time and size"""
     try:
@@ -68,11 +89,16 @@ def should_upload_file(local_file_path, remote_file_info):
     return False
 
 
-def upload_map_with_data_to_ftp_incremental(html_filename: str):
-    """Upload HTML file and JSON data files to FTP, only uploading changed files"""
+def upload_map_with_data_to_ftp_incremental(html_filename: str, changed_files=None):
+    """
+    Upload HTML file and JSON data files to FTP, only uploading changed files
+    changed_files - optional. Local paths of the files known to be changed. Only these are uploaded, without comparing them with
+                    the remote files first. All files are compared with the remote ones by default.
+    Returns False if the upload failed, True otherwise
+    """
     if not config["ftp"]["host"]:
         logger.info(f"Skipping upload to FTP - no FTP config provided")
-        return
+        return True
 
     ftp_config = FtpConfig.create_config(config)
 
@@ -83,32 +109,42 @@ def upload_map_with_data_to_ftp_incremental(html_filename: str):
 
     if not html_path.exists():
         logger.error(f"HTML file not found: {html_filename}")
-        return
+        return False
 
     if not data_dir.exists():
         logger.error(f"Data directory not found: {data_dir}")
-        return
+        return False
+
+    if changed_files is not None:
+        changed_files = {os.path.normpath(filename) for filename in changed_files}
+        if not changed_files:
+            logger.info("No files changed, nothing to upload")
+            return True
+
+    def needs_upload(local_path: Path, remote_filename):
+        if changed_files is not None:
+            return os.path.normpath(local_path) in changed_files
+        return should_upload_file(local_path, get_remote_file_info(ftp, remote_filename))
 
     files_uploaded = 0
     files_skipped = 0
     total_size_uploaded = 0
 
+    ftp = None
     try:
-        logger.info(f"Connecting to {ftp_config.host} as {ftp_config.user}")
-        ftp = ftplib.FTP(ftp_config.host)
-        ftp.login(user=ftp_config.user, passwd=ftp_config.password)
-        ftp.cwd(ftp_config.remote_path)
+        ftp = connect(ftp_config)
 
         # Check and upload the main HTML file
         logger.info(f"Checking main HTML file: {html_filename}")
-        remote_html_info = get_remote_file_info(ftp, ftp_config.remote_filename)
 
-        if should_upload_file(html_path, remote_html_info):
+        if needs_upload(html_path, ftp_config.remote_filename):
             logger.info(f"Uploading main HTML file: {html_filename}")
             with open(html_filename, 'rb') as file:
                 ftp.storbinary(f'STOR {ftp_config.remote_filename}', file)
             logger.info(f"Uploaded {html_filename} as {ftp_config.remote_filename}")
             files_uploaded += 1
+            instrumentation.count("files_uploaded")
+            instrumentation.count("bytes_uploaded", html_path.stat().st_size)
             total_size_uploaded += html_path.stat().st_size
         else:
             logger.info(f"HTML file {html_filename} is up to date, skipping")
@@ -135,14 +171,14 @@ def upload_map_with_data_to_ftp_incremental(html_filename: str):
             logger.info(f"Checking {len(json_files)} JSON files for changes")
 
             for json_file in json_files:
-                remote_json_info = get_remote_file_info(ftp, json_file.name)
-
-                if should_upload_file(json_file, remote_json_info):
+                if needs_upload(json_file, json_file.name):
                     logger.info(f"Uploading JSON file: {json_file.name}")
                     with open(json_file, 'rb') as file:
                         ftp.storbinary(f'STOR {json_file.name}', file)
                     logger.info(f"Uploaded {json_file.name}")
                     files_uploaded += 1
+                    instrumentation.count("files_uploaded")
+                    instrumentation.count("bytes_uploaded", json_file.stat().st_size)
                     total_size_uploaded += json_file.stat().st_size
                 else:
                     logger.debug(f"JSON file {json_file.name} is up to date, skipping")
@@ -156,9 +192,12 @@ def upload_map_with_data_to_ftp_incremental(html_filename: str):
             logger.info("No files needed uploading - all files are up to date")
 
     except ftplib.all_errors as e:
-        logger.error("Failed to FTP the files. {0}", e)
+        logger.error(f"Failed to FTP the files. {e}")
+        return False
     finally:
-        ftp.quit()
+        quit_ftp(ftp)
+
+    return True
 
 
 def upload_map_with_data_to_ftp(html_filename: str):
@@ -182,11 +221,9 @@ def upload_map_with_data_to_ftp(html_filename: str):
         logger.error(f"Data directory not found: {data_dir}")
         return
 
+    ftp = None
     try:
-        logger.info(f"Connecting to {ftp_config.host} as {ftp_config.user}")
-        ftp = ftplib.FTP(ftp_config.host)
-        ftp.login(user=ftp_config.user, passwd=ftp_config.password)
-        ftp.cwd(ftp_config.remote_path)
+        ftp = connect(ftp_config)
 
         # Upload the main HTML file
         logger.info(f"Uploading main HTML file: {html_filename}")
@@ -232,17 +269,15 @@ def upload_map_with_data_to_ftp(html_filename: str):
             logger.info(f"  - {ftp_config.remote_path}/data/{json_file.name}")
 
     except ftplib.all_errors as e:
-        logger.error("Failed to FTP the files. {0}", e)
+        logger.error(f"Failed to FTP the files. {e}")
     finally:
-        ftp.quit()
+        quit_ftp(ftp)
 
 
 def clean_remote_data_directory(ftp_config):
     """Clean old JSON files from the remote data directory before uploading new ones"""
     try:
-        ftp = ftplib.FTP(ftp_config.host)
-        ftp.login(user=ftp_config.user, passwd=ftp_config.password)
-        ftp.cwd(ftp_config.remote_path)
+        ftp = connect(ftp_config)
 
         # Try to change to data directory
         try:
@@ -298,12 +333,16 @@ def upload_map_with_data_to_ftp_clean(html_filename: str):
 
 
 def decrypt(encrypted_text):
+    from cryptography.fernet import Fernet
+
     cipher_suite = Fernet(CRYPTO_KEY)
     decrypted_text = cipher_suite.decrypt(encrypted_text).decode()
     return decrypted_text
 
 
 def encrypt_password():
+    from cryptography.fernet import Fernet
+
     cipher_suite = Fernet(CRYPTO_KEY)
     encrypted_text = cipher_suite.encrypt(config['ftp']['pass'].encode())
     print(encrypted_text.decode())
\ No newline at end of file
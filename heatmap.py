@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Density heatmap - how many activities passed through each cell of the map.
+
+Cells are slippy map tiles of [heatmap][zoom]. Counts are kept in NumPy arrays, one per region (tile of [heatmap][region-zoom]),
+stored in [storage][directory-heatmap]. Tracks are rasterized and added to the grid only once, when an activity is downloaded.
+Cells added by each activity are remembered, so a re-downloaded or deleted activity is subtracted without its old track.
+The grid is built from all the local activities when it does not exist.
+
+The map creator exports non-empty cells per region as an overlay of the map, the loader draws it on canvas tiles.
+"""
+import json
+import os
+
+import storage
+from common import logger, config
+from explorertiles import read_track, get_tiles
+
+CONTRIBUTIONS_VERSION = 1
+
+
+class Heatmap:
+    def __init__(self, directory, zoom, region_zoom):
+        self.directory = directory
+        self.zoom = zoom
+        self.region_zoom = region_zoom
+        self.region_size = 2 ** (zoom - region_zoom)
+        # (region x, region y) -> array of counts indexed [y, x] within the region, loaded when needed
+        self.regions = {}
+        self.modified_regions = set()
+        # activity id -> list of cell codes (x * 2^zoom + y) added by the activity
+        self.contributions = {}
+
+    def get_region_filename(self, region):
+        return os.path.join(self.directory, f"region_{region[0]}_{region[1]}.npy")
+
+    def get_region(self, region):
+        import numpy as np
+
+        counts = self.regions.get(region)
+        if counts is None:
+            filename = self.get_region_filename(region)
+            if os.path.exists(filename):
+                counts = np.load(filename)
+            else:
+                counts = np.zeros((self.region_size, self.region_size), dtype=np.uint32)
+            self.regions[region] = counts
+        return counts
+
+    def apply(self, cells, delta):
+        """Add delta (1 or -1) to the cells given by their unique codes"""
+        import numpy as np
+
+        if len(cells) == 0:
+            return
+        n = 2 ** self.zoom
+        x = cells // n
+        y = cells % n
+        shift = self.zoom - self.region_zoom
+        region_x = x >> shift
+        region_y = y >> shift
+        region_codes = region_x * (2 ** self.region_zoom) + region_y
+        for region_code in np.unique(region_codes):
+            in_region = region_codes == region_code
+            region = (int(region_code // (2 ** self.region_zoom)), int(region_code % (2 ** self.region_zoom)))
+            counts = self.get_region(region)
+            local_x = x[in_region] - (region[0] << shift)
+            local_y = y[in_region] - (region[1] << shift)
+            # cells of an activity are unique, so plain fancy indexing does not lose any increments
+            if delta > 0:
+                counts[local_y, local_x] += 1
+            else:
+                counts[local_y, local_x] -= counts[local_y, local_x] > 0
+            self.modified_regions.add(region)
+
+    def add(self, activity: storage.Activity):
+        """Add activity to the grid. Contribution of a previous version of the activity is subtracted first."""
+        self.remove(activity.activity_id)
+        latitudes, longitudes = read_track(activity)
+        cells = get_tiles(latitudes, longitudes, self.zoom)
+        if len(cells):
+            self.apply(cells, 1)
+            self.contributions[activity.activity_id] = cells.tolist()
+
+    def remove(self, activity_id):
+        import numpy as np
+
+        cells = self.contributions.pop(activity_id, None)
+        if cells:
+            self.apply(np.array(cells, dtype=np.int64), -1)
+
+    def save(self):
+        import numpy as np
+
+        os.makedirs(self.directory, exist_ok=True)
+        for region in self.modified_regions:
+            counts = self.regions[region]
+            filename = self.get_region_filename(region)
+            if counts.any():
+                np.save(filename, counts)
+            elif os.path.exists(filename):
+                os.remove(filename)
+        self.modified_regions.clear()
+
+        contributions_filename = os.path.join(self.directory, 'contributions.json')
+        values = {'version': CONTRIBUTIONS_VERSION, 'zoom': self.zoom, 'region_zoom': self.region_zoom,
+                  'activities': {str(activity_id): cells for activity_id, cells in self.contributions.items()}}
+        with open(contributions_filename + ".tmp", 'w') as contributions_file:
+            contributions_file.write(json.dumps(values, separators=(',', ':')))
+        os.replace(contributions_filename + ".tmp", contributions_filename)
+
+    def get_region_list(self):
+        regions = []
+        for filename in os.listdir(self.directory):
+            if filename.startswith('region_') and filename.endswith('.npy'):
+                _, region_x, region_y = filename[:-4].split('_')
+                regions.append((int(region_x), int(region_y)))
+        return sorted(regions)
+
+
+def create_heatmap():
+    heatmap_config = config['heatmap']
+    return Heatmap(config['storage']['directory-heatmap'], heatmap_config['zoom'], heatmap_config['region-zoom'])
+
+
+def load_heatmap():
+    """Load the heatmap, build it from the local activities if it does not exist or was built with different zoom levels"""
+    heatmap = create_heatmap()
+    contributions_filename = os.path.join(heatmap.directory, 'contributions.json')
+    if os.path.exists(contributions_filename):
+        with open(contributions_filename, 'r') as contributions_file:
+            values = json.load(contributions_file)
+        if (values.get('version') == CONTRIBUTIONS_VERSION and values['zoom'] == heatmap.zoom and
+                values['region_zoom'] == heatmap.region_zoom):
+            heatmap.contributions = {int(activity_id): cells for activity_id, cells in values['activities'].items()}
+            return heatmap
+        logger.info(f"Heatmap in {heatmap.directory} is outdated")
+    return build_heatmap()
+
+
+def build_heatmap():
+    heatmap = create_heatmap()
+    logger.info(f"Building heatmap in {heatmap.directory}")
+    # start from scratch, old regions may have been computed for different zoom levels
+    if os.path.isdir(heatmap.directory):
+        for filename in os.listdir(heatmap.directory):
+            os.remove(os.path.join(heatmap.directory, filename))
+    for activity in storage.iter_activities_from_csv():
+        if activity.has_gps_data:
+            heatmap.add(activity)
+    heatmap.save()
+    logger.info(f"Heatmap built from {len(heatmap.contributions)} activities")
+    return heatmap
+
+
+def update_heatmap(activities, existing_ids=None):
+    """
+    Add new or re-downloaded activities to the heatmap. Activities no longer in the database are subtracted.
+    existing_ids - optional. Ids of the activities in the database, read from it by default
+    """
+    if not config['heatmap']['enabled']:
+        return
+    if not os.path.exists(os.path.join(config['storage']['directory-heatmap'], 'contributions.json')):
+        # the activities are already in the storage, a fresh heatmap contains them
+        build_heatmap()
+        return
+
+    heatmap = load_heatmap()
+    if existing_ids is None:
+        existing_ids = {activity.activity_id for activity in storage.iter_activities_from_csv()}
+    for activity_id in [activity_id for activity_id in heatmap.contributions if activity_id not in existing_ids]:
+        heatmap.remove(activity_id)
+    for activity in activities:
+        heatmap.add(activity)
+    heatmap.save()
+    logger.info(f"Heatmap updated with {len(activities)} activities")
+
+
+def get_map_export():
+    """Overlay data for the map: non-empty cells of each region as flat list [x, y, count, x, y, count, ...] (x, y within the region)"""
+    import numpy as np
+
+    heatmap = load_heatmap()
+    regions = {}
+    max_count = 0
+    for region in heatmap.get_region_list():
+        counts = heatmap.get_region(region)
+        local_y, local_x = np.nonzero(counts)
+        values = counts[local_y, local_x]
+        regions[f"{region[0]}:{region[1]}"] = np.column_stack([local_x, local_y, values]).ravel().tolist()
+        max_count = max(max_count, int(values.max()))
+    return {
+        'zoom': heatmap.zoom,
+        'region_zoom': heatmap.region_zoom,
+        'max_count': max_count,
+        'regions': regions
+    }
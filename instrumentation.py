@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Measures where a run spends its time and memory.
+
+Code is wrapped into named spans (with instrumentation.span("csv-load"): ...). Spans can be nested. Each span records its duration
+and the change of the process RSS from its start to its end (rss_delta_mb, cheap, Linux only). Peak of memory allocated by Python
+within the span (peak_traced_mb) is recorded only with [instrumentation][trace-memory] as tracemalloc slows the run down. Peak RSS
+of the process is reported only for the whole run - it is a high-water mark, measured at the end of a span it would repeat the peak
+of the heaviest stage so far. Counters (activities, points, bytes written, ...) are attributed to the innermost open span as well as
+to the run totals. Parts of a loop too fine-grained for spans (e.g. loading coordinates of each activity while the map data are
+streamed) accumulate their time into a counter instead (with instrumentation.timed("coordinates_load"): ...).
+
+At the end of the run a JSON report is written into [instrumentation][report-directory]. Optionally a cProfile dump is written next
+to it - open it e.g. with snakeviz or python -m pstats.
+"""
+import cProfile
+import datetime
+import json
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from common import logger, config
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def get_current_rss_mb():
+    """Current (not peak) RSS of the process, None where /proc is not available"""
+    try:
+        with open('/proc/self/statm', 'r') as statm_file:
+            resident_pages = int(statm_file.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return round(resident_pages * os.sysconf('SC_PAGE_SIZE') / 1048576, 1)
+
+
+class Span:
+    def __init__(self, name):
+        self.name = name
+        self.start = time.perf_counter()
+        self.duration = None
+        self.start_rss_mb = get_current_rss_mb()
+        self.rss_delta_mb = None
+        self.peak_traced_mb = None
+        self.traced_peak_bytes = 0
+        self.counters = {}
+        self.attributes = {}
+        self.children = []
+
+    def to_dict(self):
+        duration = self.duration if self.duration is not None else time.perf_counter() - self.start
+        result = {'name': self.name, 'duration_s': round(duration, 4)}
+        if self.rss_delta_mb is not None:
+            result['rss_delta_mb'] = self.rss_delta_mb
+        if self.peak_traced_mb is not None:
+            result['peak_traced_mb'] = self.peak_traced_mb
+        if self.counters:
+            result['counters'] = round_counters(self.counters)
+        if self.attributes:
+            result['attributes'] = self.attributes
+        if self.children:
+            result['children'] = [child.to_dict() for child in self.children]
+        return result
+
+
+class RunReport:
+    def __init__(self):
+        self.started = datetime.datetime.now()
+        self.root = Span("run")
+        self.stack = [self.root]
+        self.counters = {}
+        self.profiler = None
+
+
+_report = RunReport()
+
+
+def get_peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    divisor = 1048576 if sys.platform == 'darwin' else 1024
+    return round(peak / divisor, 1)
+
+
+def round_counters(counters):
+    """Counters with accumulated times (floats) rounded"""
+    return {name: round(value, 4) if isinstance(value, float) else value for name, value in counters.items()}
+
+
+def start_run():
+    """Start a new run report. Enables tracemalloc and cProfile if configured."""
+    global _report
+    _report = RunReport()
+    instrumentation_config = config['instrumentation']
+    if instrumentation_config['trace-memory'] and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if instrumentation_config['cprofile']:
+        _report.profiler = cProfile.Profile()
+        _report.profiler.enable()
+
+
+@contextmanager
+def span(name):
+    parent = _report.stack[-1]
+    if tracemalloc.is_tracing():
+        # keep the peak of the parent before resetting it for the child
+        parent.traced_peak_bytes = max(parent.traced_peak_bytes, tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+
+    current = Span(name)
+    parent.children.append(current)
+    _report.stack.append(current)
+    try:
+        yield current
+    finally:
+        current.duration = time.perf_counter() - current.start
+        end_rss_mb = get_current_rss_mb()
+        if end_rss_mb is not None and current.start_rss_mb is not None:
+            current.rss_delta_mb = round(end_rss_mb - current.start_rss_mb, 1)
+        if tracemalloc.is_tracing():
+            current.traced_peak_bytes = max(current.traced_peak_bytes, tracemalloc.get_traced_memory()[1])
+            current.peak_traced_mb = round(current.traced_peak_bytes / 1048576, 2)
+            parent.traced_peak_bytes = max(parent.traced_peak_bytes, current.traced_peak_bytes)
+        _report.stack.pop()
+
+
+def count(name, value=1):
+    """Increase a counter both in the innermost open span and in the run totals"""
+    current = _report.stack[-1]
+    current.counters[name] = current.counters.get(name, 0) + value
+    _report.counters[name] = _report.counters.get(name, 0) + value
+
+
+@contextmanager
+def timed(name):
+    """Add the time spent within the block (in seconds) to the counter name_s of the innermost open span and of the run totals"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        count(f"{name}_s", time.perf_counter() - start)
+
+
+def timed_iter(iterable, name):
+    """Items of the iterable, time spent producing them (e.g. reading a stream of activities) is added to the counter name_s"""
+    iterator = iter(iterable)
+    while True:
+        with timed(name):
+            item = next(iterator, StopIteration)
+        if item is StopIteration:
+            return
+        yield item
+
+
+def annotate(name, value):
+    """Attach an attribute (e.g. stage status) to the innermost open span"""
+    _report.stack[-1].attributes[name] = value
+
+
+def finish_run():
+    """Close the run and write the report. Returns the report filename or None if reports are disabled."""
+    root = _report.root
+    root.duration = time.perf_counter() - root.start
+    peak_rss_mb = get_peak_rss_mb()
+    if tracemalloc.is_tracing():
+        root.traced_peak_bytes = max(root.traced_peak_bytes, tracemalloc.get_traced_memory()[1])
+        root.peak_traced_mb = round(root.traced_peak_bytes / 1048576, 2)
+    if _report.profiler:
+        _report.profiler.disable()
+
+    instrumentation_config = config['instrumentation']
+    if not instrumentation_config['enabled']:
+        return None
+
+    report_directory = instrumentation_config['report-directory']
+    os.makedirs(report_directory, exist_ok=True)
+    basename = os.path.join(report_directory, f"run_{_report.started.strftime('%Y%m%d_%H%M%S')}")
+
+    report = {
+        'started': _report.started.isoformat(timespec='seconds'),
+        'duration_s': round(root.duration, 4),
+        'peak_rss_mb': peak_rss_mb,
+        'peak_traced_mb': root.peak_traced_mb,
+        # per-span peak_traced_mb is measured only with trace-memory
+        'trace_memory': tracemalloc.is_tracing(),
+        'counters': round_counters(_report.counters),
+        'spans': [child.to_dict() for child in root.children],
+    }
+    if _report.profiler:
+        profile_filename = basename + ".prof"
+        _report.profiler.dump_stats(profile_filename)
+        report['cprofile'] = profile_filename
+
+    report_filename = basename + ".json"
+    with open(report_filename, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+
+    logger.info(f"Run report written into {report_filename}. Duration: {root.duration:.2f}s, peak RSS: {peak_rss_mb} MB")
+    for child in root.children:
+        logger.info(f"  - {child.name}: {child.duration:.2f}s")
+    return report_filename
@@ -1,75 +1,92 @@
 #!/usr/bin/env python3
-from typing import List
+import hashlib
 import re
 import json
 import os
-import folium
-import folium.plugins
 
+import duplicates
+import explorertiles
+import heatmap
+import instrumentation
+import spatialindex
+from activitystats import ActivityStats
+from categorization import get_categorizer
 from common import logger, config
 
 
-class TypeMapping:
-    def __init__(self, name: str, color: str, type_keys: List[str], show_on_load: bool):
+class Overlay:
+    """Additional layer of the map (e.g. explored tiles). Its data are exported into a file and drawn by the loader."""
+    def __init__(self, name, overlay_type, filename, export):
         self.name = name
-        self.color = color
-        self.type_keys = type_keys
-        self.show_on_load = show_on_load
-
-    def contains_key(self, type_key):
-        return type_key in self.type_keys
-
-
-uncategorized_activity_types = set()
-
-
-def get_type_mappings():
-    mappings = []
-    for mapping in config['activities']['mapping']:
-        show_on_load = mapping.get('name') in config['activities']['display-mapping-on-load']
-        mappings.append(TypeMapping(mapping.get('name'), mapping.get('color'), mapping.get('type_keys'), show_on_load))
-    if len(mappings) == 0:
-        raise ValueError("No type mappings found. Cannot continue. Fix [map-tiles][tiles] config")
-    return mappings
-
-
-def get_type_mapping(mappings: [], type_key: str) -> TypeMapping:
-    for mapping in mappings:
-        if mapping.contains_key(type_key):
-            return mapping
-
-    if type_key not in uncategorized_activity_types:
-        logger.debug(f"Unmapped activity type: {type_key}. Putting it into '{mappings[0]}' category")
-        uncategorized_activity_types.add(type_key)
-    return mappings[0]
-
-
-def calculate_map_center(activities):
-    """Calculate the center point of all activities"""
-    if not activities:
-        return [0, 0]
-
-    total_lat = 0
-    total_lon = 0
-    count = 0
-
-    for activity in activities:
-        if activity.coordinates and len(activity.coordinates) > 0:
-            # Use first coordinate as representative point
-            first_coord = activity.coordinates[0]
-            if len(first_coord) >= 2:
-                total_lat += first_coord[0]  # latitude
-                total_lon += first_coord[1]  # longitude
-                count += 1
-
-    if count == 0:
-        return [0, 0]
-
-    return [total_lat / count, total_lon / count]
+        self.type = overlay_type
+        self.filename = filename
+        self.export = export
+
+
+def get_overlays():
+    overlays = []
+    if config['explorer-tiles']['enabled']:
+        overlays.append(Overlay("Explored tiles", "explored-tiles", "explored_tiles.json", explorertiles.get_map_export))
+    if config['heatmap']['enabled']:
+        overlays.append(Overlay("Heatmap", "heatmap", "heatmap.json", heatmap.get_map_export))
+    return overlays
+
+
+def create_overlay_files(data_dir, overlays):
+    """Export data of the overlays. Returns the manifest entries and list of files whose content changed."""
+    manifest_overlays = {}
+    written_files = []
+    for overlay in overlays:
+        with instrumentation.span(f"overlay-export:{overlay.name}"):
+            filepath = os.path.join(data_dir, overlay.filename)
+            if write_if_changed(filepath, json.dumps(overlay.export(), separators=(',', ':'))):
+                written_files.append(filepath)
+        manifest_overlays[overlay.name] = {'type': overlay.type, 'data_file': f'data/{overlay.filename}'}
+    return manifest_overlays, written_files
+
+
+class MapCenter:
+    """Average of start points of the activities, accumulated while activities are being processed"""
+    def __init__(self):
+        self.total_lat = 0
+        self.total_lon = 0
+        self.count = 0
+
+    def add(self, activity):
+        if activity.start:
+            self.total_lat += activity.start[0]
+            self.total_lon += activity.start[1]
+            self.count += 1
+
+    def get(self):
+        if config['map-tiles']['center-point']:
+            return config['map-tiles']['center-point']
+
+        if self.count == 0:
+            return [0, 0]
+
+        return [self.total_lat / self.count, self.total_lon / self.count]
+
+
+class Bounds:
+    """Union of bounding boxes of activities"""
+    def __init__(self):
+        self.bbox = None
+
+    def add(self, bbox):
+        if not bbox:
+            return
+        if self.bbox is None:
+            self.bbox = list(bbox)
+        else:
+            self.bbox = [min(self.bbox[0], bbox[0]), min(self.bbox[1], bbox[1]), max(self.bbox[2], bbox[2]), max(self.bbox[3], bbox[3])]
 
 
 def create_map(center):
     """Create a basic Folium map"""
+    # Folium is slow to import, only the map-creator needs it
+    import folium
+
     tiles = config['map-tiles']['tiles']
 
     activities_map = folium.Map(
@@ -187,8 +204,67 @@ def create_activity_popup_html(activity):
     return popup_html
 
 
-def create_activity_data_files(activities, output_dir):
-    """Create separate JSON files for each activity category and a manifest"""
+def get_category_data_filename(category_name):
+    return f"{category_name.lower().replace(' ', '_')}_activities.json"
+
+
+class CategoryDataWriter:
+    """
+    Writes JSON array of activities of a category one activity at a time, so that the whole category never needs to be in memory.
+    Data go into a temporary file which replaces the target file only if the content differs.
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.temp_filepath = filepath + '.tmp'
+        self.file = open(self.temp_filepath, 'w', encoding='utf-8')
+        self.file.write('[')
+        self.count = 0
+
+    def add(self, activity_data):
+        if self.count > 0:
+            self.file.write(',')
+        self.file.write(json.dumps(activity_data, separators=(',', ':')))
+        self.count += 1
+
+    def close(self):
+        """Returns True if the target file was written"""
+        self.file.write(']')
+        self.file.close()
+        if self.count == 0 or files_equal(self.temp_filepath, self.filepath):
+            os.remove(self.temp_filepath)
+            return False
+        os.replace(self.temp_filepath, self.filepath)
+        instrumentation.count("bytes_written", os.path.getsize(self.filepath))
+        return True
+
+    def discard(self):
+        self.file.close()
+        os.remove(self.temp_filepath)
+
+
+def files_equal(filename1, filename2):
+    if not os.path.exists(filename2) or os.path.getsize(filename1) != os.path.getsize(filename2):
+        return False
+    with open(filename1, 'rb') as file1, open(filename2, 'rb') as file2:
+        while True:
+            chunk1 = file1.read(1048576)
+            if chunk1 != file2.read(1048576):
+                return False
+            if not chunk1:
+                return True
+
+
+def create_activity_data_files(activities, output_dir, categories_to_write=None):
+    """
+    Create separate JSON files for each activity category and a manifest
+    activities - any iterable, e.g. storage.iter_activities_from_csv(). Activities are processed one by one. Coordinates of activities
+                 which do not have them loaded yet are read just for writing the activity and released right after, so peak memory
+                 does not grow with number of activities. Activities of categories which are not written are not read at all, their
+                 geometry from the database is enough.
+    categories_to_write - optional. Names of categories whose data files need to be written, e.g. only those with new activities.
+                          Data files of all categories are written by default. Manifest is always written.
+    Returns the manifest and list of files whose content changed
+    """
 
     # Ensure output directory exists
     os.makedirs(output_dir, exist_ok=True)
@@ -197,70 +273,106 @@ def create_activity_data_files(activities, output_dir):
     data_dir = os.path.join(output_dir, 'data')
     os.makedirs(data_dir, exist_ok=True)
 
-    # Group activities by category
-    mappings = get_type_mappings()
-    categories = {}
-
-    for mapping in mappings:
-        categories[mapping.name] = {
-            'activities': [],
-            'color': mapping.color,
-            'show_on_load': mapping.show_on_load
-        }
+    categorizer = get_categorizer()
+    mappings = categorizer.mappings
+    activity_counts = {mapping.name: 0 for mapping in mappings}
+    writers = {}
+    written_files = []
+    center = MapCenter()
+    bounds = Bounds()
+    category_bounds = {mapping.name: Bounds() for mapping in mappings}
+    stats = ActivityStats()
 
     # Process activities
     min_date = None
     max_date = None
 
-    for activity in activities:
-        # Use activity_type instead of type_key
-        mapping = get_type_mapping(mappings, activity.activity_type)
+    with instrumentation.span("category-serialization"):
+        try:
+            # the database is streamed, reading it and loading coordinates are timed within the loop rather than as spans
+            for activity, mapping in categorizer.categorize_all(instrumentation.timed_iter(activities, "activities_read")):
+                activity_counts[mapping.name] += 1
+                stats.add(mapping.name, activity)
+
+                release_coordinates = not activity.coordinates
+                if activity.bbox is None and activity.has_gps_data:
+                    # database not migrated yet, geometry needs to be computed from the coordinates
+                    if release_coordinates:
+                        with instrumentation.timed("coordinates_load"):
+                            activity.load_coordinates()
+                    activity.update_geometry()
+                center.add(activity)
+                bounds.add(activity.bbox)
+                category_bounds[mapping.name].add(activity.bbox)
+
+                if categories_to_write is None or mapping.name in categories_to_write:
+                    if release_coordinates and not activity.coordinates:
+                        with instrumentation.timed("coordinates_load"):
+                            activity.load_coordinates()
+                    if mapping.name not in writers:
+                        writers[mapping.name] = CategoryDataWriter(os.path.join(data_dir, get_category_data_filename(mapping.name)))
+                    # Store minimal activity data - popup HTML will be generated in JavaScript
+                    activity_data = {
+                        'coordinates': activity.coordinates,
+                        'color': mapping.color,
+                        'date': activity.date,
+                        'name': activity.name,
+                        'activity_type': activity.activity_type,
+                        'distance': activity.distance,
+                        'duration': activity.duration,
+                        'activity_id': activity.activity_id,
+                        'bbox': activity.bbox
+                    }
+                    # only tracks split at gaps have breaks, the others do not carry the key
+                    if activity.breaks:
+                        activity_data['breaks'] = activity.breaks
+                    with instrumentation.timed("data_write"):
+                        writers[mapping.name].add(activity_data)
+                    instrumentation.count("activities_serialized")
+                    instrumentation.count("points", len(activity.coordinates))
+
+                if release_coordinates:
+                    activity.coordinates = []
+
+                # Track date range using activity.date
+                activity_date = activity.date
+                if min_date is None or activity_date < min_date:
+                    min_date = activity_date
+                if max_date is None or activity_date > max_date:
+                    max_date = activity_date
+        except BaseException:
+            # never replace a data file with a partial one
+            for writer in writers.values():
+                writer.discard()
+            raise
+
+        for writer in writers.values():
+            if writer.close():
+                written_files.append(writer.filepath)
+
+    # Create manifest entry for each category
+    manifest_categories = {}
 
-        # Store minimal activity data - popup HTML will be generated in JavaScript
-        activity_data = {
-            'coordinates': activity.coordinates,
+    for mapping in mappings:
+        activity_count = activity_counts[mapping.name]
+        manifest_categories[mapping.name] = {
+            'data_file': f'data/{get_category_data_filename(mapping.name)}' if activity_count > 0 else None,
+            'activity_count': activity_count,
             'color': mapping.color,
-            'date': activity.date,
-            'name': activity.name,
-            'activity_type': activity.activity_type,
-            'distance': activity.distance,
-            'duration': activity.duration,
-            'activity_id': activity.activity_id
+            'show_on_load': mapping.show_on_load,
+            'bounds': category_bounds[mapping.name].bbox
         }
 
-        categories[mapping.name]['activities'].append(activity_data)
-
-        # Track date range using activity.date
-        activity_date = activity.date
-        if min_date is None or activity_date < min_date:
-            min_date = activity_date
-        if max_date is None or activity_date > max_date:
-            max_date = activity_date
-
-    # Create data files for each category
-    manifest_categories = {}
-
-    for category_name, category_data in categories.items():
-        if category_data['activities']:
-            filename = f"{category_name.lower().replace(' ', '_')}_activities.json"
-            filepath = os.path.join(data_dir, filename)
+    spatial_index_file = None
+    if config['spatial-index']['export-to-map']:
+        with instrumentation.span("spatial-index-export"):
+            spatial_index_path = os.path.join(data_dir, 'spatial_index.json')
+            if write_if_changed(spatial_index_path, json.dumps(spatialindex.get_map_export(), separators=(',', ':'))):
+                written_files.append(spatial_index_path)
+        spatial_index_file = 'data/spatial_index.json'
 
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(category_data['activities'], f, separators=(',', ':'))
-
-            manifest_categories[category_name] = {
-                'data_file': f'data/{filename}',
-                'activity_count': len(category_data['activities']),
-                'color': category_data['color'],
-                'show_on_load': category_data['show_on_load']
-            }
-        else:
-            manifest_categories[category_name] = {
-                'data_file': None,
-                'activity_count': 0,
-                'color': category_data['color'],
-                'show_on_load': category_data['show_on_load']
-            }
+    manifest_overlays, overlay_files = create_overlay_files(data_dir, get_overlays())
+    written_files.extend(overlay_files)
 
     # Create manifest
     manifest = {
@@ -269,98 +381,119 @@ def create_activity_data_files(activities, output_dir):
             'min_date': min_date or '1970-01-01',
             'max_date': max_date or '1970-01-01'
         },
+        # [south, west, north, east] of all activities
+        'bounds': bounds.bbox,
+        'stats': stats.to_dict(),
+        'spatial_index': spatial_index_file,
+        'overlays': manifest_overlays,
         'config': {
             'enable_highlighting': config['activities']['enable-activity-highlighting'],
+            'fit_bounds': config['map-tiles']['fit-bounds'],
             'garmin_connect_url': config.get('garmin-connect-activity-url', 'https://connect.garmin.com/modern/activity/')
         }
     }
 
     manifest_path = os.path.join(data_dir, 'manifest.json')
-    with open(manifest_path, 'w', encoding='utf-8') as f:
-        json.dump(manifest, f, indent=2)
+    if write_if_changed(manifest_path, json.dumps(manifest, indent=2)):
+        written_files.append(manifest_path)
 
-    logger.info(
-        f"Created manifest and {len([c for c in manifest_categories.values() if c['activity_count'] > 0])} category data files in {output_dir}")
+    totals = stats.get_totals()
+    logger.info(f"Processed {totals.count} activities ({totals.distance:.0f} km, {totals.duration / 60:.0f} h). "
+                f"Written {len(written_files)} changed data files in {output_dir}")
 
-    return manifest
+    return manifest, center.get(), written_files
+
+
+NOUISLIDER_CSS = '<link href="https://cdnjs.cloudflare.com/ajax/libs/noUiSlider/15.7.1/nouislider.min.css" rel="stylesheet">'
+NOUISLIDER_JS = '<script src="https://cdnjs.cloudflare.com/ajax/libs/noUiSlider/15.7.1/nouislider.min.js"></script>'
+
+# template path -> (modification time, script split by the map variable placeholder)
+loader_script_cache = {}
 
 
 def load_activity_loader_template():
-    """Load the HTML template containing JavaScript for activity loading"""
+    """
+    Load the HTML template containing JavaScript for activity loading
+    Returns the script split into parts around the {{MAP_VAR_NAME}} placeholder. The parsed template is cached until the file changes.
+    """
     template_path = os.path.join(os.path.dirname(__file__), 'templates', 'activity_loader_template.html')
 
     try:
+        modification_time = os.stat(template_path).st_mtime_ns
+        cached = loader_script_cache.get(template_path)
+        if cached and cached[0] == modification_time:
+            return cached[1]
+
         with open(template_path, 'r', encoding='utf-8') as f:
             template_content = f.read()
 
         logger.debug(f"Template file loaded, length: {len(template_content)} characters")
-        logger.debug(f"Template content preview: {template_content[:200]}...")
 
         # Extract JavaScript from template (between <script> tags)
         script_match = re.search(r'<script>(.*?)</script>', template_content, re.DOTALL)
         if script_match:
             script_content = script_match.group(1).strip()
             logger.debug(f"Extracted JavaScript, length: {len(script_content)} characters")
-            logger.debug(f"JavaScript preview: {script_content[:200]}...")
-            logger.debug(f"JavaScript ending: ...{script_content[-200:]}")
-            return script_content
+            script_parts = script_content.split('{{MAP_VAR_NAME}}')
+            loader_script_cache[template_path] = (modification_time, script_parts)
+            return script_parts
         else:
             logger.error("No <script> tags found in activity loader template")
             logger.debug(f"Template content: {template_content}")
-            return ""
+            return []
 
     except FileNotFoundError:
         logger.error(f"Activity loader template not found at: {template_path}")
         logger.error("Please create the templates/activity_loader_template.html file")
-        return ""
+        return []
     except Exception as e:
         logger.error(f"Error loading activity loader template: {e}")
-        return ""
+        return []
 
 
-def inject_activity_loader_script(html_content, map_var_name):
-    """Inject JavaScript to load activities dynamically with date filtering"""
+def create_activity_loader_script(map_var_name):
+    """Create the script tag with JavaScript to load activities dynamically with date filtering"""
+    script_parts = load_activity_loader_template()
 
-    # Load JavaScript from template
-    script_content = load_activity_loader_template()
-
-    if not script_content:
+    if not script_parts:
         logger.error("Failed to load activity loader template, map will not have dynamic loading")
-        return html_content
+        return ""
 
     # Replace placeholder with actual map variable name
-    script_content = script_content.replace('{{MAP_VAR_NAME}}', map_var_name)
-    logger.debug(f"Replaced {{{{MAP_VAR_NAME}}}} with {map_var_name}")
+    script_content = map_var_name.join(script_parts)
 
-    script = f"""
+    return f"""
     <script>
     {script_content}
     </script>
     """
 
-    logger.debug(f"Final script length: {len(script)} characters")
-    logger.debug(f"Script preview: {script[:300]}...")
 
-    # Inject script before closing body tag
-    html_content = html_content.replace('</body>', script + '\n</body>')
-    logger.debug("Script injected into HTML")
+# center of the map in the Folium page - L.map("map_...", {center: [lat, lon], ...
+MAP_CENTER_PATTERN = re.compile(r'(L\.map\(\s*"map_\w+",\s*\{\s*center: )\[[^\]]*\]')
 
-    return html_content
 
+def get_skeleton_cache_key(mappings, overlays):
+    """
+    Hash of everything the Folium part of the page depends on except the center of the map. Unless it is configured, the center
+    is the mean of the activity starts and moves with every new activity, so it is set into the cached page (see set_map_center).
+    """
+    skeleton_config = {
+        'map-tiles': config['map-tiles'],
+        'categories': [[mapping.name, mapping.show_on_load] for mapping in mappings],
+        'overlays': [overlay.name for overlay in overlays],
+    }
+    return hashlib.sha256(json.dumps(skeleton_config, sort_keys=True).encode()).hexdigest()
 
-def create_map_with_activities(activities, filename):
-    output_dir = os.path.dirname(filename)
 
-    # Create activity data files
-    manifest = create_activity_data_files(activities, output_dir)
+def render_map_skeleton(center, mappings, overlays):
+    """Render the Folium map with tiles, empty category and overlay layers and layer control into an HTML string"""
+    import folium
 
-    # Create basic map without activities
-    center = calculate_map_center(activities)
     activities_map = create_map(center)
 
     # Add empty feature groups for ALL categories (not just ones with activities)
     # This ensures JavaScript can find all expected layers
-    mappings = get_type_mappings()
     for mapping in mappings:
         # Create FeatureGroup for every category, regardless of activity count
         feature_group = folium.FeatureGroup(
@@ -368,7 +501,11 @@ def create_map_with_activities(activities, filename):
             show=mapping.show_on_load
         )
         feature_group.add_to(activities_map)
-        logger.debug(f"Created FeatureGroup for category: {mapping.name} (activity_count: {manifest['categories'][mapping.name]['activity_count']})")
+        logger.debug(f"Created FeatureGroup for category: {mapping.name}")
+
+    # overlays are hidden until the user turns them on, their data are loaded only then
+    for overlay in overlays:
+        folium.FeatureGroup(name=overlay.name, show=False).add_to(activities_map)
 
     # Add layer control - this is crucial for JavaScript to find layers
     layer_control = folium.LayerControl(
@@ -379,38 +516,111 @@ def create_map_with_activities(activities, filename):
     layer_control.add_to(activities_map)
     logger.debug("Added LayerControl to map")
 
-    # Save the basic map
-    activities_map.save(filename)
-    logger.debug(f"Saved basic map to {filename}")
-
-    # Read the generated HTML and inject our activity loader
-    with open(filename, 'r', encoding='utf-8') as f:
-        html_content = f.read()
+    return activities_map.get_root().render()
 
-    # Add noUiSlider CSS and JS for date range slider
-    nouislider_css = '<link href="https://cdnjs.cloudflare.com/ajax/libs/noUiSlider/15.7.1/nouislider.min.css" rel="stylesheet">'
-    nouislider_js = '<script src="https://cdnjs.cloudflare.com/ajax/libs/noUiSlider/15.7.1/nouislider.min.js"></script>'
 
-    # Inject CSS in head
-    html_content = html_content.replace('</head>', nouislider_css + '\n</head>')
+def get_map_skeleton(center, mappings, overlays):
+    """
+    Get the Folium part of the page. It only depends on tiles, categories and center of the map so it is cached in
+    [storage][directory-cache]. That also keeps IDs generated by Folium stable and the page byte-identical between runs.
+    """
+    cache_directory = os.path.join(config['storage']['directory-cache'], 'map')
+    cache_filename = os.path.join(cache_directory, f"skeleton_{get_skeleton_cache_key(mappings, overlays)}.html")
+    if os.path.exists(cache_filename):
+        logger.debug(f"Using cached map skeleton {cache_filename}")
+        with open(cache_filename, 'r', encoding='utf-8') as f:
+            return set_map_center(f.read(), center)
+
+    skeleton = render_map_skeleton(center, mappings, overlays)
+
+    # only the latest skeleton is worth keeping
+    if os.path.isdir(cache_directory):
+        for old_filename in os.listdir(cache_directory):
+            os.remove(os.path.join(cache_directory, old_filename))
+    os.makedirs(cache_directory, exist_ok=True)
+    with open(cache_filename, 'w', encoding='utf-8') as f:
+        f.write(skeleton)
+    return skeleton
+
+
+def set_map_center(skeleton, center):
+    """The Folium page with the given center of the map"""
+    skeleton, count = MAP_CENTER_PATTERN.subn(lambda match: f"{match.group(1)}{json.dumps([float(value) for value in center])}",
+                                              skeleton, count=1)
+    if count == 0:
+        logger.warning("Could not find center of the map in the cached skeleton, the map keeps its previous center")
+    return skeleton
 
-    # Inject JS before our script
-    html_content = html_content.replace('</body>', nouislider_js + '\n</body>')
 
+def assemble_map_html(skeleton):
+    """Inject noUiSlider and the activity loader into the Folium page"""
     # Find the map variable name in the HTML
-    map_var_match = re.search(r'var (map_\w+) = L\.map', html_content)
-    if map_var_match:
-        map_var_name = map_var_match.group(1)
-        logger.debug(f"Found map variable name: {map_var_name}")
-        # Inject the activity loading script with the correct map variable name
-        html_content = inject_activity_loader_script(html_content, map_var_name)
-    else:
+    map_var_match = re.search(r'var (map_\w+) = L\.map', skeleton)
+    if not map_var_match:
         logger.error("Could not find map variable name in generated HTML")
-        return
+        return None
+    map_var_name = map_var_match.group(1)
+    logger.debug(f"Found map variable name: {map_var_name}")
+
+    head_end = skeleton.rfind('</head>')
+    body_end = skeleton.rfind('</body>')
+    return "".join([
+        skeleton[:head_end],
+        # noUiSlider CSS and JS for date range slider
+        NOUISLIDER_CSS, '\n',
+        skeleton[head_end:body_end],
+        NOUISLIDER_JS, '\n',
+        # the activity loading script with the correct map variable name
+        create_activity_loader_script(map_var_name), '\n',
+        skeleton[body_end:]
+    ])
+
+
+def write_if_changed(filename, content):
+    """Write the content into the file unless the file already contains exactly the same. Returns True if the file was written."""
+    data = content.encode('utf-8')
+    if os.path.exists(filename) and os.path.getsize(filename) == len(data):
+        with open(filename, 'rb') as f:
+            if f.read() == data:
+                return False
+    with open(filename, 'wb') as f:
+        f.write(data)
+    return True
+
+
+def get_activity_categories(activities):
+    """Names of categories whose data files and counts in the manifest change with the activities, see create_map_with_activities"""
+    return {mapping.name for _, mapping in get_categorizer().categorize_all(duplicates.filter_excluded(activities))}
+
+
+def create_map_with_activities(activities, filename, categories_to_write=None):
+    """
+    Create the data files and the HTML map
+    activities - any iterable of activities, see create_activity_data_files
+    categories_to_write - optional. Names of categories whose data files need to be written, all of them by default
+    Returns list of the files whose content changed
+    """
+    output_dir = os.path.dirname(filename)
 
-    # Write the modified HTML back
-    with open(filename, 'w', encoding='utf-8') as f:
-        f.write(html_content)
+    # Create activity data files
+    activities = duplicates.filter_excluded(activities)
+    _, center, written_files = create_activity_data_files(activities, output_dir, categories_to_write)
 
-    logger.info(f"Created lightweight HTML map ({os.path.getsize(filename) / 1024 / 1024:.1f} MB) with separate data files")
+    # Create basic map without activities
+    mappings = get_categorizer().mappings
+    with instrumentation.span("folium-render"):
+        skeleton = get_map_skeleton(center, mappings, get_overlays())
+
+    with instrumentation.span("template-injection"):
+        html_content = assemble_map_html(skeleton)
+    if html_content is None:
+        return written_files
+
+    if write_if_changed(filename, html_content):
+        instrumentation.count("bytes_written", os.path.getsize(filename))
+        written_files.append(filename)
+        logger.info(f"Created lightweight HTML map ({os.path.getsize(filename) / 1024 / 1024:.1f} MB) with separate data files")
+    else:
+        logger.info(f"HTML map {filename} is up to date, not written")
     logger.info(f"Created FeatureGroups for {len(mappings)} categories")
+    return written_files
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
+import hashlib
 import os.path
 import re
 import subprocess
 
-from common import logger
+import instrumentation
+from common import logger, config
 
 # Update June 2025 - not using this feature anymore
 # Browser compression does a good job and makes minification not that beneficial.
@@ -30,90 +32,187 @@ def minify(original_filename: str, output_filename: str) -> str:
     with open(original_filename, "r") as map_file:
         html = map_file.read()
 
+    with instrumentation.span("minify-rewrite"):
+        html_match, js_chunks = rewrite_html(html)
+
+    with instrumentation.span("closure-compiler"):
+        js = compile_js(js_chunks)
+
+    with open(output_filename, "w") as min_map_file:
+        min_map_file.write(html_match[1])
+        min_map_file.write(js)
+        min_map_file.write(html_match[3])
+    instrumentation.count("bytes_written", os.path.getsize(output_filename))
+
+
+# Definition of Polylines is too verbose. Each instance has its parameters explicitly defined even though all instances in one group
+# have the same set of parameters. Therefore, introducing a new function per group to create a Polyline to avoid duplication.
+#
+# L.polyline([[50.02206, 14.52665], [50.02196, 14.52708], [50.02143, 14.5274], [50.01971, 14.53054]],
+#            {"bubblingMouseEvents": true, "color": "magenta", "dashArray": null, "dashOffset": null, "fill": false, "fillColor": "magenta", "fillOpacity": 0.2, "fillRule": "evenodd", "lineCap": "round", "lineJoin": "round", "noClip": false, "opacity": 0.8, "smoothFactor": 3, "stroke": true, "weight": 3}
+#             ).addTo(feature_group_f39c438cc69f387c393faa4bab0135ef);
+#
+# becomes single definition of a function:
+# function polyLine5(coords) {
+#   return L.polyline(coords, {"bubblingMouseEvents": true, "color": "magenta", "dashArray": null, "dashOffset": null, "fill": false, "fillColor": "magenta", "fillOpacity": 0.2, "fillRule": "evenodd", "lineCap": "round", "lineJoin": "round", "noClip": false, "opacity": 0.8, "smoothFactor": 3, "stroke": true, "weight": 3})
+#       .addTo(feature_group_8f5528b1ae80f23917ad9b1df567802e)}
+#
+# and each polyline then has simplified definition:
+# polyline5([[50.02206, 14.52665], [50.02196, 14.52708], [50.02143, 14.5274], [50.01971, 14.53054]])
+class Group:
+    def __init__(self, id, name, style):
+        self.id = id
+        self.name = name
+        self.style = style
+        self.method_name = f"polyLine{id}"
+        self.method_def = f"function {self.method_name}(coords) {{ return L.polyline(coords, {style}).addTo({self.name})}}"
+
+
+# All the rewrites are done in a single pass over the script. Tokens are tried in this order at each position:
+#  - polyline definition, replaced by a call of the function of its group
+#  - maxWidth of a popup. There does not seem to be any effect and it can be removed.
+#    Note that you can see this property explicitly in Python code when creating the popup. However, if you remove it from there, the
+#    popups do not work.
+#  - unique ID and explicit style of a popup. None of this is needed.
+#  - event names. When generating elements that are highlighted on mouse hover events, they need to be quoted to avoid Closure compiler
+#    replacing them with generated placeholders
+TOKEN_PATTERN = re.compile(
+    r"(?P<polyline>L\.polyline\(\s+(?P<coords>\[\[.+\]\]),\s+(?P<style>{.+})\s+\)\.addTo\((?P<group>\w+)\);)"
+    r"|(?P<max_width>\{\"maxWidth\": 500\})"
+    r"|(?P<popup> id=\"html_\w+\" style=\"width: 100.0%; height: 100.0%;\")"
+    r"|(?P<event>mouseout|mouseover|popupopen|popupclose):")
+# Same rewrites except polylines, applied on the parts of a polyline definition which are kept
+INNER_TOKEN_PATTERN = re.compile(
+    r"(?P<max_width>\{\"maxWidth\": 500\})"
+    r"|(?P<popup> id=\"html_\w+\" style=\"width: 100.0%; height: 100.0%;\")"
+    r"|(?P<event>mouseout|mouseover|popupopen|popupclose):")
+
+
+def rewrite_token(match):
+    if match["event"]:
+        return f"'{match['event']}':"
+    # maxWidth and popup attributes are removed
+    return ""
+
+
+def rewrite_html(html):
+    """
+    Split the html into parts and apply the size optimizations on the javascript part
+    Returns the html match (the javascript is its second group) and the optimized javascript as a list of chunks
+    """
+
     html_match = re.match(r"^(.+</body>\s*<script>)(.*)(</script>.*)$", html, re.DOTALL)
-    js = html_match[2]
-
-    # Each popup is initialized with maxWidth. There does not seem to be any effect and it can be removed.
-    # Note that you can see this property explicitly in Python code when creating the popup. However, if you remove it from there, the
-    # popups do not work.
-    js = js.replace("{\"maxWidth\": 500}", "")
-    # Popups have unique IDs and explicit style. None of this is needed.
-    js = re.sub(" id=\"html_\\w+\" style=\"width: 100.0%; height: 100.0%;\"", "", js)
-
-    # Definition of Polylines is too verbose. Each instance has its parameters explicitly defined even though all instances in one group
-    # have the same set of parameters. Therefore, introducing a new function per group to create a Polyline to avoid duplication.
-    #
-    # L.polyline([[50.02206, 14.52665], [50.02196, 14.52708], [50.02143, 14.5274], [50.01971, 14.53054]],
-    #            {"bubblingMouseEvents": true, "color": "magenta", "dashArray": null, "dashOffset": null, "fill": false, "fillColor": "magenta", "fillOpacity": 0.2, "fillRule": "evenodd", "lineCap": "round", "lineJoin": "round", "noClip": false, "opacity": 0.8, "smoothFactor": 3, "stroke": true, "weight": 3}
-    #             ).addTo(feature_group_f39c438cc69f387c393faa4bab0135ef);
-    #
-    # becomes single definition of a function:
-    # function polyLine5(coords) {
-    #   return L.polyline(coords, {"bubblingMouseEvents": true, "color": "magenta", "dashArray": null, "dashOffset": null, "fill": false, "fillColor": "magenta", "fillOpacity": 0.2, "fillRule": "evenodd", "lineCap": "round", "lineJoin": "round", "noClip": false, "opacity": 0.8, "smoothFactor": 3, "stroke": true, "weight": 3})
-    #       .addTo(feature_group_8f5528b1ae80f23917ad9b1df567802e)}
-    #
-    # and each polyline then has simplified definition:
-    # polyline5([[50.02206, 14.52665], [50.02196, 14.52708], [50.02143, 14.5274], [50.01971, 14.53054]])
-    class Group:
-        def __init__(self, id, name, style):
-            self.id = id
-            self.name = name
-            self.style = style
-            self.method_name = f"polyLine{id}"
-            self.method_def = f"function {self.method_name}(coords) {{ return L.polyline(coords, {style}).addTo({self.name})}}"
-
-    groups = []
-    pattern = re.compile(r"(L\.polyline\(\s+(\[\[.+\]\]),\s+({.+})\s+\)\.addTo\((\w+)\);)")
-    for match in re.findall(pattern, js):
-        whole = match[0]
-        coords = match[1]
-        style = match[2]
-        group_name = match[3]
-
-        group = None
-        for g in groups:
-            if g.name == group_name:
-                group = g
+    return html_match, rewrite_js(html_match[2])
+
+
+def rewrite_js(js):
+    """Apply all the size optimizations in a single pass over the javascript. Returns the result as a list of chunks."""
+    groups = {}
+    chunks = []
+    position = 0
+    for match in TOKEN_PATTERN.finditer(js):
+        chunks.append(js[position:match.start()])
+        position = match.end()
+        if not match["polyline"]:
+            chunks.append(rewrite_token(match))
+            continue
+
+        group = groups.get(match["group"])
         if not group:
-            index = len(groups)
-            group = Group(index, group_name, style)
-            groups.append(group)
-        js = js.replace(whole, f"{group.method_name}({coords});")
+            style = INNER_TOKEN_PATTERN.sub(rewrite_token, match["style"])
+            group = Group(len(groups), match["group"], style)
+            groups[group.name] = group
+        chunks.append(f"{group.method_name}({INNER_TOKEN_PATTERN.sub(rewrite_token, match['coords'])});")
+    chunks.append(js[position:])
 
-    for group in groups:
-        js = group.method_def + js + "\n"
+    # function definitions go first, the last group first
+    definitions = [group.method_def for group in reversed(groups.values())]
+    return definitions + chunks + ["\n" * len(groups)]
 
-    # When generating elements that are highlighted on mouse hover events, following is required to avoid Closure compiler replacing
-    # event names with generated placeholders
-    js = js.replace("mouseout:", "'mouseout':")
-    js = js.replace("mouseover:", "'mouseover':")
-    js = js.replace("popupopen:", "'popupopen':")
-    js = js.replace("popupclose:", "'popupclose':")
 
-    # Write javascript to a separate file, run it through Google Closure Compiler and read it back to a variable
-    with open("data/map.js", "w") as js_file:
-        js_file.write(js)
+CLOSURE_COMPILER_JAR = "closure-compiler-v20240317.jar"
+# Add "--formatting=PRETTY_PRINT" to make the output a bit more readable
+CLOSURE_COMPILER_ARGUMENTS = "externs.js data/map.js --compilation_level ADVANCED --js_output_file data/map.min.js"
+
+
+def get_compiler_command():
+    """Command starting the compiler. Either a fresh JVM for each run or a client of an already running compiler process."""
+    command = config['minifier']['compiler-command']
+    if command:
+        return command
 
     # See https://github.com/google/closure-compiler to learn more about the compiler
-    if not os.path.exists("closure-compiler-v20240317.jar"):
+    if not os.path.exists(CLOSURE_COMPILER_JAR):
         logger.info("Closure compiler jar file not found. Going to download it from Maven central")
         subprocess.run(
-            "curl -LO https://repo1.maven.org/maven2/com/google/javascript/closure-compiler/v20240317/closure-compiler-v20240317.jar",
+            f"curl -LO https://repo1.maven.org/maven2/com/google/javascript/closure-compiler/v20240317/{CLOSURE_COMPILER_JAR}",
             shell=True)
+    return f"java -jar {CLOSURE_COMPILER_JAR}"
+
+
+def get_cache_key(js_chunks):
+    """
+    Hash of everything the compiled output depends on - the javascript, the externs file and the compiler and its flags. A configured
+    [minifier][compiler-command] may run another version of the compiler than the jar, so it is a part of the key as well.
+    """
+    digest = hashlib.sha256()
+    digest.update(f"{CLOSURE_COMPILER_JAR}\n{config['minifier']['compiler-command']}\n{CLOSURE_COMPILER_ARGUMENTS}\n".encode())
+    with open("externs.js", "rb") as externs_file:
+        digest.update(externs_file.read())
+    for chunk in js_chunks:
+        digest.update(chunk.encode())
+    return digest.hexdigest()
+
+
+def evict_cache(cache_directory, max_size_bytes):
+    """Remove the least recently used entries until the cache fits into its size limit"""
+    entries = []
+    with os.scandir(cache_directory) as iterator:
+        for entry in iterator:
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= max_size_bytes:
+            break
+        logger.debug(f"Evicting {path} from the closure compiler cache")
+        os.remove(path)
+        total_size -= size
+
+
+def compile_js(js_chunks):
+    """
+    Run the javascript through Google Closure Compiler. The compiled output is cached by a hash of its inputs. Running the compiler
+    takes many seconds so it is skipped entirely when the same javascript was already compiled before.
+    """
+    cache_directory = os.path.join(config['storage']['directory-cache'], 'closure')
+    os.makedirs(cache_directory, exist_ok=True)
+    cache_filename = os.path.join(cache_directory, get_cache_key(js_chunks) + ".js")
+    if os.path.exists(cache_filename):
+        logger.info(f"Using compiled javascript from cache {cache_filename}")
+        instrumentation.count("closure_cache_hits")
+        # mark the entry as recently used
+        os.utime(cache_filename)
+        with open(cache_filename, "r") as js_file:
+            return js_file.read()
+
+    # Write javascript to a separate file, run it through Google Closure Compiler and read it back to a variable
+    with open("data/map.js", "w") as js_file:
+        js_file.writelines(js_chunks)
 
     min_js_filename = "data/map.min.js"
     if os.path.exists(min_js_filename):
         os.remove(min_js_filename)
     logger.debug("Running closure compiler on the data/map.js")
-    # Add "--formatting=PRETTY_PRINT" to make the output a bit more readable
-    subprocess.run(
-        "java -jar closure-compiler-v20240317.jar externs.js data/map.js --compilation_level ADVANCED --js_output_file data/map.min.js",
-        shell=True)
+    subprocess.run(f"{get_compiler_command()} {CLOSURE_COMPILER_ARGUMENTS}", shell=True, check=True)
 
     with open(min_js_filename, "r") as js_file:
         js = js_file.read()
 
-    with open(output_filename, "w") as min_map_file:
-        min_map_file.write(html_match[1])
-        min_map_file.write(js)
-        min_map_file.write(html_match[3])
+    # write under a temporary name first so that an interrupted run does not leave a truncated cache entry
+    with open(cache_filename + ".tmp", "w") as cache_file:
+        cache_file.write(js)
+    os.replace(cache_filename + ".tmp", cache_filename)
+    evict_cache(cache_directory, config['minifier']['cache-max-size-mb'] * 1048576)
+    return js
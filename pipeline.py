@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Runs the processors (downloader, map-creator, minifier, uploader) as a sequence of stages.
+
+Each stage declares its inputs (local files, directories, config sections). A fingerprint of the inputs is recorded after the stage
+finishes successfully. On the next run the stage is skipped if its inputs have not changed and its outputs still exist. That way
+a scheduled run with no new activities does not regenerate the map or talk to the FTP server.
+
+Fingerprints of files and directories are based on file sizes and modification times, not on their content. It is cheap to calculate
+even for thousands of coordinate files. Code of a stage is one of its inputs - its module and all the modules of this project it
+imports (see fingerprint_code).
+"""
+import ast
+import hashlib
+import json
+import os
+import time
+
+import instrumentation
+from common import logger, config
+
+
+class Stage:
+    def __init__(self, name, action, inputs=None, outputs=None):
+        """
+        name - name of the stage used in logs and in the state file
+        action - function to run. It can return False to signal a failure, the fingerprint is not recorded then
+        inputs - function returning a dict of input name -> fingerprint. None means the stage always runs (e.g. remote inputs)
+        outputs - list of files which need to exist to allow skipping the stage
+        """
+        self.name = name
+        self.action = action
+        self.inputs = inputs
+        self.outputs = outputs or []
+
+
+class StageResult:
+    def __init__(self, name, status, reason, duration=0.0):
+        self.name = name
+        self.status = status
+        self.reason = reason
+        self.duration = duration
+
+    def __str__(self):
+        return f"{self.name}: {self.status} ({self.reason}) in {self.duration:.2f}s"
+
+
+def fingerprint_file(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return "missing"
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def fingerprint_directory(path, suffix=""):
+    """Fingerprint of all files in a directory (not recursive) based on their names, sizes and modification times"""
+    if not os.path.isdir(path):
+        return "missing"
+    entries = []
+    with os.scandir(path) as iterator:
+        for entry in iterator:
+            if entry.is_file() and entry.name.endswith(suffix):
+                stat = entry.stat()
+                entries.append(f"{entry.name}:{stat.st_size}:{stat.st_mtime_ns}")
+    entries.sort()
+    return hashlib.sha256("\n".join(entries).encode()).hexdigest()
+
+
+def get_local_imports(path):
+    """Names of the modules of this project (next to the file) imported by the file, including imports within functions"""
+    with open(path, 'r', encoding='utf-8') as source_file:
+        tree = ast.parse(source_file.read(), path)
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+            names.add(node.module.split('.')[0])
+    directory = os.path.dirname(path)
+    return {name for name in names if os.path.exists(os.path.join(directory, f"{name}.py"))}
+
+
+def fingerprint_code(*modules):
+    """
+    Fingerprint of the source files of the modules and of all the modules of this project they import, directly or indirectly.
+    A change of any code the stage runs makes it run again.
+    """
+    paths = [os.path.abspath(module.__file__) for module in modules]
+    seen = set()
+    while paths:
+        path = paths.pop()
+        if path in seen:
+            continue
+        seen.add(path)
+        directory = os.path.dirname(path)
+        paths.extend(os.path.join(directory, f"{name}.py") for name in get_local_imports(path))
+    return fingerprint_values(*(f"{os.path.basename(path)}:{fingerprint_file(path)}" for path in sorted(seen)))
+
+
+def fingerprint_config(*section_names):
+    sections = {name: config.get(name) for name in section_names}
+    return hashlib.sha256(json.dumps(sections, sort_keys=True).encode()).hexdigest()
+
+
+def fingerprint_values(*values):
+    return hashlib.sha256(json.dumps(values, sort_keys=True).encode()).hexdigest()
+
+
+def load_state(filename):
+    if not os.path.exists(filename):
+        return {}
+    try:
+        with open(filename, 'r') as state_file:
+            return json.load(state_file)
+    except (ValueError, OSError) as e:
+        logger.warning(f"Cannot read pipeline state from {filename}, all stages will run. {e}")
+        return {}
+
+
+def save_state(filename, state):
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(filename, 'w') as state_file:
+        json.dump(state, state_file, indent=2)
+
+
+def get_run_reason(stage: Stage, inputs, previous_inputs):
+    """Return reason why the stage needs to run or None if it can be skipped"""
+    if inputs is None:
+        return "no local inputs to compare, always runs"
+    if previous_inputs is None:
+        return "no record of a previous run"
+
+    changed = [name for name, value in inputs.items() if previous_inputs.get(name) != value]
+    changed += [name for name in previous_inputs if name not in inputs]
+    if changed:
+        return "changed inputs: " + ", ".join(changed)
+
+    missing_outputs = [output for output in stage.outputs if not os.path.exists(output)]
+    if missing_outputs:
+        return "missing outputs: " + ", ".join(missing_outputs)
+
+    return None
+
+
+def run_pipeline(stages, skip_unchanged=True):
+    """Run the stages in the given order, skipping those whose inputs are unchanged since their last successful run"""
+    state_filename = config['storage']['pipeline-state']
+    state = load_state(state_filename)
+    results = []
+
+    for stage in stages:
+        start = time.perf_counter()
+        inputs = stage.inputs() if stage.inputs else None
+        reason = get_run_reason(stage, inputs, state.get(stage.name))
+        if not reason and not skip_unchanged:
+            reason = "skipping of unchanged stages is disabled"
+
+        if not reason:
+            result = StageResult(stage.name, "skipped", "inputs unchanged", time.perf_counter() - start)
+            logger.info(f"Stage {result}")
+            results.append(result)
+            continue
+
+        logger.info(f"Stage {stage.name}: running ({reason})")
+        with instrumentation.span(stage.name):
+            instrumentation.annotate('reason', reason)
+            success = stage.action() is not False
+            instrumentation.annotate('status', "ran" if success else "failed")
+        if success:
+            if inputs is not None:
+                state[stage.name] = inputs
+                save_state(state_filename, state)
+            result = StageResult(stage.name, "ran", reason, time.perf_counter() - start)
+        else:
+            # forget the fingerprint so that the stage is retried next time
+            if state.pop(stage.name, None) is not None:
+                save_state(state_filename, state)
+            result = StageResult(stage.name, "failed", reason, time.perf_counter() - start)
+        logger.info(f"Stage {result}")
+        results.append(result)
+
+    logger.info("Pipeline summary:\n" + "\n".join(f"  - {result}" for result in results))
+    return results
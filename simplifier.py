@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Simplification of full resolution tracks into the coordinates shown on the map, see [simplification].
+
+Modes ([simplification][mode]):
+ - FIXED         .. the same epsilon ([activities][coords-simplification-factor]) for every activity
+ - VERTEX_BUDGET .. epsilon of each activity is found by binary search - the smallest one (not below min-epsilon) leaving at most
+                    max-vertices vertices. A short run keeps its detail, a long ride gets simplified more.
+ - SIZE_BUDGET   .. like VERTEX_BUDGET with the vertex budget chosen by REGENERATE_COORDINATES so that coordinates of all the
+                    activities fit into total-size-mb. Activities needing fewer vertices leave their share to the others. The budget
+                    is stored in the report and used for activities downloaded later.
+
+Tracks are cleaned of GPS glitches and split into parts first (see trackcleaner), each part is simplified on its own.
+Every simplification can be measured - number of vertices, size of the coordinates in the map data and max deviation (Hausdorff
+distance of the full track from the simplified one, in metres), along with points removed by the cleaning. REGENERATE_COORDINATES writes the measurements per activity and in
+total into [storage][simplification-report].
+"""
+import json
+import math
+import os
+
+import trackcleaner
+from common import logger, config
+
+METRES_PER_DEGREE = 111320
+SEARCH_STEPS = 24
+# vertex budget of the last REGENERATE_COORDINATES in SIZE_BUDGET mode, read from the report once
+stored_budget = {}
+
+
+class SimplificationResult:
+    def __init__(self, epsilon, original_vertices, vertices, size, deviation=None):
+        self.activity_id = None
+        self.epsilon = epsilon
+        self.original_vertices = original_vertices
+        self.vertices = vertices
+        self.size = size
+        self.deviation = deviation
+        # set from trackcleaner.CleaningResult
+        self.removed_points = 0
+        self.parts = 1
+
+    def to_dict(self):
+        return {
+            'activity_id': self.activity_id,
+            'epsilon': self.epsilon,
+            'original_vertices': self.original_vertices,
+            'vertices': self.vertices,
+            'size': self.size,
+            'deviation_m': round(self.deviation, 2) if self.deviation is not None else None,
+            'removed_points': self.removed_points,
+            'parts': self.parts,
+        }
+
+
+def simplify(parts, vertex_budget=None, measure=False):
+    """
+    Simplify parts of the full resolution track (NumPy arrays of (latitude, longitude), see trackcleaner.clean) according to
+    [simplification][mode].
+    vertex_budget - optional. Overrides the budget of the mode, FIXED mode is not affected.
+    Returns (simplified coordinates, indices where the parts start except the first one, SimplificationResult).
+    Deviation is measured only when requested as it costs extra time.
+    """
+    epsilon = get_epsilon(parts, vertex_budget)
+    parts_indices = simplify_parts(parts, epsilon)
+    coordinates, breaks = trackcleaner.join_parts(part[indices].tolist() for part, indices in zip(parts, parts_indices))
+    deviation = None
+    if measure:
+        deviation = max((measure_deviation(part, indices) for part, indices in zip(parts, parts_indices)), default=0.0)
+    result = SimplificationResult(epsilon, sum(len(part) for part in parts), len(coordinates), get_payload_size(coordinates),
+                                  deviation)
+    return coordinates, breaks, result
+
+
+def simplify_parts(parts, epsilon):
+    """Indices of the points of each part kept by the simplification"""
+    from simplification.cutil import simplify_coords_idx
+
+    return [simplify_coords_idx(part, epsilon) if len(part) > 2 else list(range(len(part))) for part in parts]
+
+
+def count_simplified(parts, epsilon):
+    return sum(len(indices) for indices in simplify_parts(parts, epsilon))
+
+
+def get_epsilon(parts, vertex_budget=None):
+    simplification_config = config['simplification']
+    mode = simplification_config['mode']
+    if mode == "FIXED":
+        return config['activities']['coords-simplification-factor']
+    if mode not in ("VERTEX_BUDGET", "SIZE_BUDGET"):
+        raise ValueError(f"Unsupported simplification mode {mode}")
+    if vertex_budget is None:
+        vertex_budget = get_vertex_budget()
+    return find_epsilon(parts, vertex_budget, simplification_config['min-epsilon'], simplification_config['max-epsilon'])
+
+
+def find_epsilon(parts, vertex_budget, min_epsilon, max_epsilon):
+    """Smallest epsilon within the range leaving at most vertex_budget vertices, binary search in logarithmic scale"""
+    if sum(len(part) for part in parts) <= vertex_budget or count_simplified(parts, min_epsilon) <= vertex_budget:
+        return min_epsilon
+    if count_simplified(parts, max_epsilon) > vertex_budget:
+        return max_epsilon
+    low, high = math.log(min_epsilon), math.log(max_epsilon)
+    for _ in range(SEARCH_STEPS):
+        middle = (low + high) / 2
+        if count_simplified(parts, math.exp(middle)) <= vertex_budget:
+            high = middle
+        else:
+            low = middle
+    return math.exp(high)
+
+
+def count_vertices(parts):
+    """Vertices of the track simplified with min-epsilon - more are never needed"""
+    return count_simplified(parts, config['simplification']['min-epsilon'])
+
+
+def get_payload_size(coordinates):
+    """Size of the coordinates in the map data (rounded to [activities][coords-decimal-places], compact JSON)"""
+    decimal_places = config['activities']['coords-decimal-places']
+    return len(json.dumps([[round(lat, decimal_places), round(lon, decimal_places)] for lat, lon in coordinates],
+                          separators=(',', ':')))
+
+
+def measure_deviation(points, indices):
+    """Max distance (in metres) of the points of the full track from the simplified line - the Hausdorff distance between them"""
+    import numpy as np
+
+    if len(indices) < 2:
+        return 0.0
+    scale = np.array([METRES_PER_DEGREE, METRES_PER_DEGREE * math.cos(math.radians(float(points[:, 0].mean())))])
+    xy = points * scale
+    indices = np.asarray(indices)
+    # segment of the simplified line each point of the full track belongs to
+    segments = np.clip(np.searchsorted(indices, np.arange(len(xy)), side='right') - 1, 0, len(indices) - 2)
+    start = xy[indices[segments]]
+    direction = xy[indices[segments + 1]] - start
+    offset = xy - start
+    length_squared = (direction * direction).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        position = np.where(length_squared > 0, (offset * direction).sum(axis=1) / length_squared, 0.0)
+    position = np.clip(position, 0.0, 1.0)
+    return float(np.linalg.norm(offset - position[:, None] * direction, axis=1).max())
+
+
+def choose_vertex_budget(vertex_counts):
+    """
+    Vertex budget per activity fitting coordinates of all the activities into [simplification][total-size-mb].
+    vertex_counts - vertices each activity has at min-epsilon (see count_vertices), activities needing fewer keep all of them.
+    """
+    decimal_places = config['activities']['coords-decimal-places']
+    # "[49.12345,16.12345]," - two digits of the integer part, the decimal point and the separators
+    bytes_per_vertex = 2 * (decimal_places + 3) + 4
+    total_vertices = int(config['simplification']['total-size-mb'] * 1048576 / bytes_per_vertex)
+    if not vertex_counts or sum(vertex_counts) <= total_vertices:
+        return max(vertex_counts, default=2)
+
+    low, high = 2, max(vertex_counts)
+    while low < high:
+        budget = (low + high + 1) // 2
+        if sum(min(count, budget) for count in vertex_counts) <= total_vertices:
+            low = budget
+        else:
+            high = budget - 1
+    logger.info(f"Vertex budget {low} per activity fits {len(vertex_counts)} activities into "
+                f"{config['simplification']['total-size-mb']} MB")
+    return low
+
+
+def get_vertex_budget():
+    simplification_config = config['simplification']
+    if simplification_config['mode'] == "SIZE_BUDGET":
+        filename = config['storage']['simplification-report']
+        if filename not in stored_budget:
+            stored_budget[filename] = None
+            if os.path.exists(filename):
+                with open(filename, 'r') as report_file:
+                    stored_budget[filename] = json.load(report_file)['total'].get('vertex_budget')
+        if stored_budget[filename]:
+            return stored_budget[filename]
+        logger.warning("No vertex budget computed yet, run REGENERATE_COORDINATES. Using [simplification][max-vertices]")
+    return simplification_config['max-vertices']
+
+
+def write_report(results, vertex_budget=None):
+    """Write measurements of the simplified activities with totals into [storage][simplification-report] and log the totals"""
+    filename = config['storage']['simplification-report']
+    deviations = [result.deviation for result in results if result.deviation is not None]
+    total = {
+        'mode': config['simplification']['mode'],
+        'vertex_budget': vertex_budget,
+        'activities': len(results),
+        'original_vertices': sum(result.original_vertices for result in results),
+        'removed_points': sum(result.removed_points for result in results),
+        'split_activities': sum(1 for result in results if result.parts > 1),
+        'vertices': sum(result.vertices for result in results),
+        'size': sum(result.size for result in results),
+        'max_deviation_m': round(max(deviations), 2) if deviations else None,
+        'mean_deviation_m': round(sum(deviations) / len(deviations), 2) if deviations else None,
+    }
+    report = {'total': total, 'activities': sorted((result.to_dict() for result in results),
+                                                   key=lambda result: result['deviation_m'] or 0, reverse=True)}
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    with open(filename + ".tmp", 'w') as report_file:
+        json.dump(report, report_file, indent=1)
+    os.replace(filename + ".tmp", filename)
+    stored_budget[filename] = vertex_budget
+    logger.info(f"Simplified {total['activities']} activities from {total['original_vertices']} to {total['vertices']} vertices "
+                f"({total['removed_points']} points removed by cleaning, {total['split_activities']} activities split), "
+                f"{round(total['size'] / 1048576, 2)} MB of coordinates, deviation max {total['max_deviation_m']} m, "
+                f"mean {total['mean_deviation_m']} m. Report written into {filename}")
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+Spatial index answering which activities passed through an area without reading the coordinate files.
+
+The world is divided into a grid of square cells ([spatial-index][cell-size] degrees). Each segment of an activity track is
+rasterized into the cells it passes through and the index keeps cell -> activity ids along with bounding box and basic fields of
+every activity. A query only looks at the cells covering the queried area. Results are precise to the cell size, utility mode
+FIND_ACTIVITIES refines them by checking coordinates of the few candidate activities.
+
+The index is stored in [storage][spatial-index]. It is built from the coordinate files when it does not exist and the downloader
+updates it with every new or re-downloaded activity. A compact copy is exported next to the map data files (see mapgenerator) to power
+the lookup of activities when clicking on the map.
+"""
+import json
+import math
+import os
+
+import storage
+from categorization import get_categorizer
+from common import logger, config
+
+INDEX_VERSION = 1
+EARTH_RADIUS_KM = 6371.0
+
+
+class SpatialIndex:
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        # activity id -> {name, date, type, distance, duration, filename, bbox: [south, west, north, east]}
+        self.activities = {}
+        # (x, y) -> activity ids. Lists as loaded from the file (converting all of them to sets would slow down loading),
+        # converted to a set once the cell gets modified
+        self.cells = {}
+
+    def get_cell(self, lat, lon):
+        return math.floor(lon / self.cell_size), math.floor(lat / self.cell_size)
+
+    def get_track_cells(self, coordinates, breaks=()):
+        """
+        Cells touched by the track. Segments longer than half of a cell are sampled so that no cell in between is skipped.
+        breaks - optional. Indices where parts of the track start, gaps between the parts are not sampled.
+        """
+        cells = set()
+        step = self.cell_size / 2
+        previous = None
+        breaks = set(breaks)
+        for index, (lat, lon) in enumerate(coordinates):
+            if previous is not None and index not in breaks:
+                d_lat = lat - previous[0]
+                d_lon = lon - previous[1]
+                samples = int(max(abs(d_lat), abs(d_lon)) / step)
+                for sample in range(1, samples + 1):
+                    fraction = sample / (samples + 1)
+                    cells.add(self.get_cell(previous[0] + d_lat * fraction, previous[1] + d_lon * fraction))
+            cells.add(self.get_cell(lat, lon))
+            previous = (lat, lon)
+        return cells
+
+    def add(self, activity: storage.Activity):
+        """Add activity with loaded coordinates. Replaces the activity if it is already indexed."""
+        self.remove(activity.activity_id)
+        if not activity.coordinates:
+            return
+        latitudes = [lat for lat, _ in activity.coordinates]
+        longitudes = [lon for _, lon in activity.coordinates]
+        self.activities[activity.activity_id] = {
+            'name': activity.name,
+            'date': activity.date,
+            'type': activity.activity_type,
+            'distance': activity.distance,
+            'duration': activity.duration,
+            'filename': activity.filename,
+            'bbox': [min(latitudes), min(longitudes), max(latitudes), max(longitudes)]
+        }
+        for cell in self.get_track_cells(activity.coordinates, activity.breaks):
+            self.get_modifiable_cell(cell).add(activity.activity_id)
+
+    def get_modifiable_cell(self, cell):
+        activity_ids = self.cells.get(cell)
+        if not isinstance(activity_ids, set):
+            activity_ids = self.cells[cell] = set(activity_ids or [])
+        return activity_ids
+
+    def remove(self, activity_id):
+        entry = self.activities.pop(activity_id, None)
+        if entry is None:
+            return
+        for cell in self.get_bbox_cells(*entry['bbox']):
+            if cell in self.cells:
+                activity_ids = self.get_modifiable_cell(cell)
+                activity_ids.discard(activity_id)
+                if not activity_ids:
+                    del self.cells[cell]
+
+    def get_bbox_cells(self, south, west, north, east):
+        min_x, min_y = self.get_cell(south, west)
+        max_x, max_y = self.get_cell(north, east)
+        for x in range(min_x, max_x + 1):
+            for y in range(min_y, max_y + 1):
+                yield x, y
+
+    def query_bbox(self, south, west, north, east):
+        """Ids of activities passing through cells intersecting the box"""
+        found = set()
+        for cell in self.get_bbox_cells(south, west, north, east):
+            activity_ids = self.cells.get(cell)
+            if activity_ids:
+                found.update(activity_ids)
+        return found
+
+    def query_radius(self, lat, lon, radius_km):
+        """Ids of activities passing through cells within the radius around the point"""
+        d_lat = math.degrees(radius_km / EARTH_RADIUS_KM)
+        d_lon = d_lat / max(math.cos(math.radians(lat)), 0.01)
+        found = set()
+        for x, y in self.get_bbox_cells(lat - d_lat, lon - d_lon, lat + d_lat, lon + d_lon):
+            activity_ids = self.cells.get((x, y))
+            if not activity_ids:
+                continue
+            # the nearest point of the cell
+            nearest_lat = min(max(lat, y * self.cell_size), (y + 1) * self.cell_size)
+            nearest_lon = min(max(lon, x * self.cell_size), (x + 1) * self.cell_size)
+            if get_distance_km(lat, lon, nearest_lat, nearest_lon) <= radius_km:
+                found.update(activity_ids)
+        return found
+
+    def to_dict(self):
+        return {
+            'version': INDEX_VERSION,
+            'cell_size': self.cell_size,
+            'activities': {str(activity_id): entry for activity_id, entry in self.activities.items()},
+            'cells': {f"{x}:{y}": sorted(activity_ids) for (x, y), activity_ids in self.cells.items()}
+        }
+
+    @staticmethod
+    def from_dict(values):
+        index = SpatialIndex(values['cell_size'])
+        index.activities = {int(activity_id): entry for activity_id, entry in values['activities'].items()}
+        for key, activity_ids in values['cells'].items():
+            x, y = key.split(':')
+            index.cells[(int(x), int(y))] = activity_ids
+        return index
+
+
+def get_distance_km(lat1, lon1, lat2, lon2):
+    """Haversine distance"""
+    d_lat = math.radians(lat2 - lat1)
+    d_lon = math.radians(lon2 - lon1)
+    a = math.sin(d_lat / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(d_lon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def get_segment_distance_km(lat, lon, lat1, lon1, lat2, lon2):
+    """Distance of the point from the segment. Uses equirectangular projection around the point which is fine for short segments."""
+    scale = math.cos(math.radians(lat))
+    x1, y1 = (lon1 - lon) * scale, lat1 - lat
+    x2, y2 = (lon2 - lon) * scale, lat2 - lat
+    d_x, d_y = x2 - x1, y2 - y1
+    length = d_x * d_x + d_y * d_y
+    t = 0 if length == 0 else max(0.0, min(1.0, -(x1 * d_x + y1 * d_y) / length))
+    return math.radians(math.hypot(x1 + t * d_x, y1 + t * d_y)) * EARTH_RADIUS_KM
+
+
+def segment_intersects_bbox(lat1, lon1, lat2, lon2, south, west, north, east):
+    """Liang-Barsky clipping of the segment by the box"""
+    t0, t1 = 0.0, 1.0
+    d_lon, d_lat = lon2 - lon1, lat2 - lat1
+    for p, q in ((-d_lon, lon1 - west), (d_lon, east - lon1), (-d_lat, lat1 - south), (d_lat, north - lat1)):
+        if p == 0:
+            if q < 0:
+                return False
+            continue
+        t = q / p
+        if p < 0:
+            t0 = max(t0, t)
+        else:
+            t1 = min(t1, t)
+        if t0 > t1:
+            return False
+    return True
+
+
+def track_intersects(coordinates, matches_segment):
+    if len(coordinates) == 1:
+        return matches_segment(coordinates[0], coordinates[0])
+    return any(matches_segment(coordinates[index], coordinates[index + 1]) for index in range(len(coordinates) - 1))
+
+
+def get_index_filename():
+    return config['storage']['spatial-index']
+
+
+def load_index():
+    """Load the index, build it from the coordinate files if it does not exist or was built with a different cell size"""
+    filename = get_index_filename()
+    cell_size = config['spatial-index']['cell-size']
+    if os.path.exists(filename):
+        with open(filename, 'r') as index_file:
+            values = json.load(index_file)
+        if values.get('version') == INDEX_VERSION and values['cell_size'] == cell_size:
+            return SpatialIndex.from_dict(values)
+        logger.info(f"Spatial index {filename} is outdated")
+    return build_index()
+
+
+def save_index(index: SpatialIndex):
+    filename = get_index_filename()
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, 'w') as index_file:
+        index_file.write(json.dumps(index.to_dict(), separators=(',', ':')))
+    os.replace(temp_filename, filename)
+
+
+def build_index(activities=None):
+    """
+    Build the index from scratch and save it
+    activities - optional. Activities with loaded coordinates, activities are read one by one from the storage by default
+    """
+    logger.info("Building spatial index")
+    index = SpatialIndex(config['spatial-index']['cell-size'])
+    for activity in activities if activities is not None else storage.iter_activities_from_csv():
+        release_coordinates = not activity.coordinates
+        if release_coordinates:
+            activity.load_coordinates()
+        index.add(activity)
+        if release_coordinates:
+            activity.coordinates = []
+    save_index(index)
+    logger.info(f"Spatial index built: {len(index.activities)} activities in {len(index.cells)} cells")
+    return index
+
+
+def update_index(activities, existing_ids=None):
+    """
+    Add new or re-downloaded activities (with loaded coordinates) to the index. Activities no longer in the database are dropped.
+    existing_ids - optional. Ids of the activities in the database, read from it by default
+    """
+    filename = get_index_filename()
+    if not os.path.exists(filename):
+        # the activities are already in the storage, a fresh index contains them
+        build_index()
+        return
+
+    index = load_index()
+    if existing_ids is None:
+        existing_ids = {activity.activity_id for activity in storage.iter_activities_from_csv()}
+    for activity_id in [activity_id for activity_id in index.activities if activity_id not in existing_ids]:
+        index.remove(activity_id)
+    for activity in activities:
+        index.add(activity)
+    save_index(index)
+    logger.info(f"Spatial index updated with {len(activities)} activities")
+
+
+def find_activities(bbox=None, point=None, radius_km=None, exact=True):
+    """
+    Find activities intersecting the box [south, west, north, east] or passing within radius_km around point [lat, lon]
+    exact - check coordinates of the candidates found in the index, otherwise results are precise to the cell size
+    Returns list of index entries (with activity_id added) sorted by date
+    """
+    index = load_index()
+    if bbox:
+        candidates = index.query_bbox(*bbox)
+        matches_segment = lambda p1, p2: segment_intersects_bbox(p1[0], p1[1], p2[0], p2[1], *bbox)
+    else:
+        candidates = index.query_radius(point[0], point[1], radius_km)
+        matches_segment = lambda p1, p2: get_segment_distance_km(point[0], point[1], p1[0], p1[1], p2[0], p2[1]) <= radius_km
+
+    results = []
+    for activity_id in candidates:
+        entry = index.activities[activity_id]
+        if exact:
+            coordinates = storage.read_coordinates(f"{config['storage']['directory-coordinates']}/{entry['filename']}.csv")
+            if not track_intersects(coordinates, matches_segment):
+                continue
+        results.append(dict(entry, activity_id=activity_id))
+    return sorted(results, key=lambda result: (result['date'], result['activity_id']))
+
+
+def print_activities():
+    """Utility mode FIND_ACTIVITIES"""
+    index_config = config['spatial-index']
+    if index_config['query-bbox']:
+        results = find_activities(bbox=index_config['query-bbox'])
+    elif index_config['query-point']:
+        results = find_activities(point=index_config['query-point'], radius_km=index_config['query-radius-km'])
+    else:
+        logger.error("Specify [spatial-index] query-bbox or query-point to find activities")
+        return
+
+    logger.info(f"Found {len(results)} activities")
+    for result in results:
+        print(f"{result['date']}  {result['activity_id']}  {result['type']:<20} {result['distance']:>7} km  {result['name']}")
+
+
+def get_map_export():
+    """Compact copy of the index for the map page: cells and for each activity [name, date, type, distance, category]"""
+    index = load_index()
+    index_activities = (storage.Activity(activity_id, entry['distance'], entry['duration'], entry['date'], "", entry['filename'],
+                                         True, entry['type'], entry['name']) for activity_id, entry in index.activities.items())
+    activities = {}
+    for activity, mapping in get_categorizer().categorize_all(index_activities):
+        entry = index.activities[activity.activity_id]
+        activities[str(activity.activity_id)] = [entry['name'], entry['date'], entry['type'], entry['distance'], mapping.name]
+    return {
+        'cell_size': index.cell_size,
+        'activities': activities,
+        'cells': {f"{x}:{y}": sorted(activity_ids) for (x, y), activity_ids in sorted(index.cells.items())}
+    }
@@ -1,9 +1,12 @@
 import csv
 import datetime
+import json
 import os
 import shutil
 from typing import List
 
+import archive
+import instrumentation
 from common import logger, config
 
 
@@ -11,6 +14,7 @@ def init_directories():
     activities_config = config['storage']
     os.makedirs(activities_config['directory-json'], exist_ok=True)
     os.makedirs(activities_config['directory-gpx'], exist_ok=True)
+    os.makedirs(activities_config['directory-fit'], exist_ok=True)
     os.makedirs(activities_config['directory-coordinates'], exist_ok=True)
 
 
@@ -26,40 +30,120 @@ class Activity:
         self.coords_filename = f"{activities_config['directory-coordinates']}/{filename}.csv"
         self.json_filename = f"{activities_config['directory-json']}/{filename}.json"
         self.gpx_filename = f"{activities_config['directory-gpx']}/{filename}.gpx"
+        self.fit_filename = f"{activities_config['directory-fit']}/{filename}.fit"
         self.has_gps_data = has_gps_data
         self.activity_type = activity_type
         self.name = name
         self.coordinates = []
+        # geometry is computed from the coordinates when they are written and stored in the database, so that the map can be
+        # positioned and activities culled without reading the coordinates. None when the activity has no coordinates.
+        self.bbox = None  # [south, west, north, east]
+        self.centroid = None  # [latitude, longitude], average of the (simplified) points
+        self.start = None  # [latitude, longitude]
+        self.end = None  # [latitude, longitude]
+        self.point_count = 0
+        # indices of the coordinates where a new part of the track starts, the track is split at gaps (see trackcleaner)
+        self.breaks = []
 
     def load_coordinates(self):
         if self.has_gps_data:
             self.coordinates = read_coordinates(self.coords_filename)
 
+    def update_geometry(self):
+        """Compute bounding box, centroid, start and end point and number of points from the loaded coordinates"""
+        if not self.coordinates:
+            self.bbox = self.centroid = self.start = self.end = None
+            self.point_count = 0
+            return
+        latitudes = [coordinate[0] for coordinate in self.coordinates]
+        longitudes = [coordinate[1] for coordinate in self.coordinates]
+        decimal_places = config['activities']['coords-decimal-places']
+        self.bbox = [min(latitudes), min(longitudes), max(latitudes), max(longitudes)]
+        self.centroid = [round(sum(latitudes) / len(latitudes), decimal_places), round(sum(longitudes) / len(longitudes), decimal_places)]
+        self.start = [latitudes[0], longitudes[0]]
+        self.end = [latitudes[-1], longitudes[-1]]
+        self.point_count = len(self.coordinates)
+
     def __str__(self):
         return f"Activity({self.activity_id}, {self.date} {self.time}, {self.name})"
 
 
+def row_to_activity(row):
+    activity = Activity(
+        activity_id=int(row['activity_id']),
+        distance=float(row['distance']),
+        duration=float(row['duration']),
+        date=row['date'],
+        time=row['time'],
+        has_gps_data=True if row['has_gps_data'] == 'True' else False,
+        filename=row['filename'],
+        activity_type=row['type'],
+        name=row['name']
+    )
+    # databases created before geometry was added do not have the columns
+    if row.get('point_count'):
+        activity.bbox = [float(row['south']), float(row['west']), float(row['north']), float(row['east'])]
+        activity.centroid = [float(row['centroid_lat']), float(row['centroid_lon'])]
+        activity.start = [float(row['start_lat']), float(row['start_lon'])]
+        activity.end = [float(row['end_lat']), float(row['end_lon'])]
+        activity.point_count = int(row['point_count'])
+    if row.get('breaks'):
+        activity.breaks = [int(index) for index in row['breaks'].split()]
+    return activity
+
+
+def activity_to_row(activity: Activity):
+    """Row of the database with all the values as text, exactly as they are written into and read from the CSV"""
+    row = {'name': activity.name,
+           'activity_id': activity.activity_id,
+           'type': activity.activity_type,
+           'date': activity.date,
+           'time': activity.time,
+           'duration': activity.duration,
+           'distance': activity.distance,
+           'filename': activity.filename,
+           'has_gps_data': str(activity.has_gps_data)}
+    if activity.bbox:
+        row.update({'south': activity.bbox[0], 'west': activity.bbox[1], 'north': activity.bbox[2], 'east': activity.bbox[3],
+                    'centroid_lat': activity.centroid[0], 'centroid_lon': activity.centroid[1],
+                    'start_lat': activity.start[0], 'start_lon': activity.start[1],
+                    'end_lat': activity.end[0], 'end_lon': activity.end[1],
+                    'point_count': activity.point_count})
+    if activity.breaks:
+        row['breaks'] = " ".join(str(index) for index in activity.breaks)
+    return {field: '' if row.get(field) is None else str(row[field]) for field in DATABASE_FIELDNAMES}
+
+
+def iter_rows(filename):
+    """Rows of a database file, columns missing in databases of older versions are empty"""
+    if not os.path.exists(filename):
+        return
+    with open(filename, mode='r', newline='') as csv_file:
+        for row in csv.DictReader(csv_file):
+            yield {field: row.get(field) or '' for field in DATABASE_FIELDNAMES}
+
+
+def iter_activities_from_csv(filename=None):
+    """
+    Read activities from the database one by one, without their coordinates
+    filename - optional. Database file to read as it is. By default the database with changes from the journal applied.
+    """
+    rows = iter_rows(filename) if filename else iter_database_rows()
+    logger.info(f"Reading activities from {filename or config['storage']['activities-database']}")
+    for row in rows:
+        yield row_to_activity(row)
+
+
 def load_activities_from_csv(load_coordinates=True):
-    activities = []
-    csv_filename = config['storage']['activities-database']
-    logger.info(f"Reading activities from {csv_filename}")
-    with open(csv_filename, mode='r', newline='') as csv_file:
-        reader = csv.DictReader(csv_file)
-        for row in reader:
-            activity = Activity(
-                activity_id=int(row['activity_id']),
-                distance=float(row['distance']),
-                duration=float(row['duration']),
-                date=row['date'],
-                time=row['time'],
-                has_gps_data=True if row['has_gps_data'] == 'True' else False,
-                filename=row['filename'],
-                activity_type=row['type'],
-                name=row['name']
-            )
-            if load_coordinates:
+    with instrumentation.span("csv-load"):
+        activities = list(iter_activities_from_csv())
+        instrumentation.count("activities", len(activities))
+
+    if load_coordinates:
+        with instrumentation.span("coordinates-load"):
+            for activity in activities:
                 activity.load_coordinates()
-            activities.append(activity)
+                instrumentation.count("points", len(activity.coordinates))
 
     return activities
 
@@ -75,69 +159,310 @@ def read_coordinates(filename):
     return coordinates
 
 
-def write_database(activities: List[Activity], filename=config['storage']['activities-database']):
+def write_database(activities: List[Activity], filename=None):
+    """Write the activities into a database file as they are, the journal is not involved (see replace_database)"""
+    write_rows((activity_to_row(activity) for activity in activities), filename)
+
+
+def write_rows(rows, filename=None):
+    filename = filename or config['storage']['activities-database']
     logger.info(f"Writing into {filename}")
-    with open(filename, mode='w', newline='') as csv_file:
+    with open(filename + ".tmp", mode='w', newline='') as csv_file:
         writer = create_writer(csv_file)
         writer.writeheader()
-        for activity in activities:
-            write_activity(writer, activity)
+        writer.writerows(rows)
+    os.replace(filename + ".tmp", filename)
 
 
-def write_activity(writer, activity: Activity):
-    writer.writerow(
-        {'name': activity.name,
-         'activity_id': activity.activity_id,
-         'type': activity.activity_type,
-         'date': activity.date,
-         'time': activity.time,
-         'duration': activity.duration,
-         'distance': activity.distance,
-         'filename': activity.filename,
-         'has_gps_data': str(activity.has_gps_data)})
-
-
-def create_appender(filename=config['storage']['activities-database']):
-    logger.info(f"Output going into {filename}")
-    return open(filename, mode='a', newline='')
+DATABASE_FIELDNAMES = ['date', 'time', 'type', 'duration', 'distance', 'activity_id', 'name', 'filename', 'has_gps_data',
+                       'south', 'west', 'north', 'east', 'centroid_lat', 'centroid_lon', 'start_lat', 'start_lon', 'end_lat', 'end_lon',
+                       'point_count', 'breaks']
 
 
 def create_writer(file_handler):
-    fieldnames = ['date', 'time', 'type', 'duration', 'distance', 'activity_id', 'name', 'filename', 'has_gps_data']
-    return csv.DictWriter(file_handler, fieldnames=fieldnames)
+    return csv.DictWriter(file_handler, fieldnames=DATABASE_FIELDNAMES)
 
 
-def load_and_backup():
-    # create a backup
+def backup_database():
     timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
     backup_filename = f"{config['storage']['activities-database']}.{timestamp}"
     logger.info(f"Creating a backup - {backup_filename}")
     shutil.copy2(config['storage']['activities-database'], backup_filename)
 
+
+def migrate_database():
+    """
+    Bring database created by an older version to the current format, i.e. add the new columns.
+    Geometry of the activities is computed from their coordinates. Does nothing when the database is up to date.
+    """
+    filename = config['storage']['activities-database']
+    if not os.path.exists(filename):
+        return
+    with open(filename, mode='r', newline='') as csv_file:
+        header = next(csv.reader(csv_file), None)
+    if header is None or header == DATABASE_FIELDNAMES:
+        return
+
+    logger.info(f"Migrating {filename} to the current format")
+    backup_database()
     activities = load_activities_from_csv(False)
-    logger.info(f"Loaded {len(activities)} activities")
-    return activities
+    for activity in activities:
+        if activity.bbox is None and activity.has_gps_data:
+            activity.load_coordinates()
+            activity.update_geometry()
+            activity.coordinates = []
+    replace_database(activities)
+
+
+# #####################################################################
+# Journal of changes
+#
+# Changes of the database (new, updated and deleted activities, re-sorting) are appended to the journal
+# ([storage][activities-journal]), one JSON line per change, so that a change of a single activity costs a single appended line.
+# The database CSV is a materialized view - changes which are not in it yet are applied on top of it whenever it is read.
+# Compaction writes them into the CSV once there are [journal][compact-after-changes] of them. Changes older than
+# [journal][retention-days] are folded into a snapshot ([storage][activities-snapshot]) and removed from the journal, the snapshot
+# plus the retained changes allow restoring the database to any point in time within the retention period.
+#
+# The first line of the journal is a header written by compaction:
+#   seq       .. sequence number of the last change written into the database CSV
+#   base_seq  .. sequence number of the last change contained in the snapshot
+#   base_time .. time of the snapshot, the oldest point the database can be restored to
+# Each other line is a change: {seq, time, op, activity_id, row}. Applying a change twice has the same result as applying it once,
+# so an interrupted compaction does no harm. Regeneration of all the activities is not recorded change by change, the rewritten
+# database starts the journal anew (see rewrite_database).
+
+JOURNAL_INSERT = 'insert'
+JOURNAL_UPDATE = 'update'
+JOURNAL_DELETE = 'delete'
+JOURNAL_SORT = 'sort'
+
+
+class ActivityJournal:
+    def __init__(self, filename):
+        self.filename = filename
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def read(self):
+        """Returns (header, changes)"""
+        if not self.exists():
+            return {'op': 'header', 'seq': 0, 'base_seq': 0, 'base_time': None}, []
+        with open(self.filename, 'r') as journal_file:
+            header = json.loads(journal_file.readline())
+            changes = [json.loads(line) for line in journal_file if line.strip()]
+        return header, changes
+
+    def get_last_seq(self):
+        """Sequence number of the last line, read from the end of the file"""
+        with open(self.filename, 'rb') as journal_file:
+            journal_file.seek(0, os.SEEK_END)
+            size = journal_file.tell()
+            chunk_size = 4096
+            while True:
+                journal_file.seek(max(0, size - chunk_size))
+                lines = journal_file.read().splitlines()
+                if len(lines) > 1 or chunk_size >= size:
+                    return json.loads(lines[-1])['seq']
+                chunk_size *= 4
+
+    def append(self, changes):
+        """Append changes given as (op, activity_id, row), returns number of the changes not written into the database CSV"""
+        if not self.exists():
+            self.create()
+        seq = self.get_last_seq()
+        now = datetime.datetime.now().isoformat(timespec='seconds')
+        with open(self.filename, 'a') as journal_file:
+            for op, activity_id, row in changes:
+                seq += 1
+                journal_file.write(json.dumps({'seq': seq, 'time': now, 'op': op, 'activity_id': activity_id, 'row': row}) + "\n")
+        return seq - self.read_header()['seq']
+
+    def read_header(self):
+        with open(self.filename, 'r') as journal_file:
+            return json.loads(journal_file.readline())
+
+    def create(self):
+        """Start the journal. The current database becomes the snapshot, the starting point of restores."""
+        logger.info(f"Creating journal of changes {self.filename}")
+        write_rows(iter_rows(config['storage']['activities-database']), config['storage']['activities-snapshot'])
+        now = datetime.datetime.now().isoformat(timespec='seconds')
+        self.rewrite({'op': 'header', 'seq': 0, 'base_seq': 0, 'base_time': now}, [])
+
+    def rewrite(self, header, changes):
+        with open(self.filename + ".tmp", 'w') as journal_file:
+            journal_file.write(json.dumps(header) + "\n")
+            for change in changes:
+                journal_file.write(json.dumps(change) + "\n")
+        os.replace(self.filename + ".tmp", self.filename)
+
+
+def get_journal():
+    return ActivityJournal(config['storage']['activities-journal'])
+
+
+def sort_key(row):
+    return row['date'], int(row['activity_id'])
+
+
+def apply_changes(rows, changes):
+    """
+    Apply changes to rows (dict activity id -> row, in the order of the database) in place.
+    An activity keeps its position in the database, new activities are added at the end.
+    """
+    for change in changes:
+        if change['op'] == JOURNAL_SORT:
+            sorted_rows = sorted(rows.values(), key=sort_key)
+            rows.clear()
+            rows.update((int(row['activity_id']), row) for row in sorted_rows)
+        elif change['op'] == JOURNAL_DELETE:
+            rows.pop(change['activity_id'], None)
+        else:
+            rows[change['activity_id']] = change['row']
+    return rows
+
+
+def iter_database_rows():
+    """Rows of the database with the changes from the journal which are not written into it yet"""
+    filename = config['storage']['activities-database']
+    header, changes = get_journal().read()
+    pending = [change for change in changes if change['seq'] > header['seq']]
+
+    if any(change['op'] == JOURNAL_SORT for change in pending):
+        rows = {int(row['activity_id']): row for row in iter_rows(filename)}
+        yield from apply_changes(rows, pending).values()
+        return
+
+    # stream the database, the same result as apply_changes without holding all the rows
+    changed = {}
+    deleted = set()
+    for change in pending:
+        activity_id = change['activity_id']
+        if change['op'] == JOURNAL_DELETE:
+            changed.pop(activity_id, None)
+            deleted.add(activity_id)
+        else:
+            # an activity deleted before is added at the end (deleted stays set so it is skipped at its original position)
+            changed[activity_id] = change['row']
+    for row in iter_rows(filename):
+        activity_id = int(row['activity_id'])
+        if activity_id in deleted:
+            continue
+        yield changed.pop(activity_id, row)
+    yield from changed.values()
+
+
+def record_changes(changes):
+    """Append changes to the journal and compact it when enough of them accumulated"""
+    pending_count = get_journal().append(changes)
+    if pending_count >= config['journal']['compact-after-changes']:
+        compact_database()
+
+
+def insert_activity(activity: Activity):
+    record_changes([(JOURNAL_INSERT, activity.activity_id, activity_to_row(activity))])
+
+
+def update_activities(activities: List[Activity]):
+    """Store new versions of activities already in the database"""
+    record_changes([(JOURNAL_UPDATE, activity.activity_id, activity_to_row(activity)) for activity in activities])
+
+
+def replace_database(activities: List[Activity]):
+    """Write the activities as the current state of the database, e.g. after a migration of its format"""
+    write_database(activities)
+    journal = get_journal()
+    if journal.exists():
+        header, changes = journal.read()
+        header['seq'] = changes[-1]['seq'] if changes else header['seq']
+        journal.rewrite(header, changes)
+
+
+def rewrite_database(activities: List[Activity]):
+    """
+    Store new versions of all the activities at once, e.g. regenerated from their files. Unlike update_activities they are not
+    recorded in the journal, which would otherwise grow by the whole database with every regeneration and keep it for the
+    retention period. The rewritten database becomes the snapshot instead, so it is the oldest state restores can reach.
+    """
+    replace_database(activities)
+    update_derived_data()
+    journal = get_journal()
+    if journal.exists():
+        header, _ = journal.read()
+        logger.warning(f"The database was rewritten, it can no longer be restored to the state before "
+                       f"(the oldest state available was from {header['base_time']})")
+        journal.create()
+
+
+def compact_database():
+    """Write the changes from the journal into the database and fold changes older than the retention period into the snapshot"""
+    journal = get_journal()
+    if not journal.exists():
+        return
+    with instrumentation.span("journal-compaction"):
+        header, changes = journal.read()
+        logger.info(f"Compacting journal {journal.filename} ({len(changes)} changes)")
+        write_rows(iter_database_rows())
+        header['seq'] = changes[-1]['seq'] if changes else header['seq']
+
+        retention_start = (datetime.datetime.now() - datetime.timedelta(days=config['journal']['retention-days'])) \
+            .isoformat(timespec='seconds')
+        expired = [change for change in changes if change['time'] < retention_start]
+        if expired:
+            snapshot_filename = config['storage']['activities-snapshot']
+            rows = {int(row['activity_id']): row for row in iter_rows(snapshot_filename)}
+            write_rows(apply_changes(rows, expired).values(), snapshot_filename)
+            header['base_seq'] = expired[-1]['seq']
+            header['base_time'] = expired[-1]['time']
+            logger.info(f"{len(expired)} changes older than {retention_start} folded into {snapshot_filename}")
+        journal.rewrite(header, changes[len(expired):])
+
+
+def restore_database(timestamp):
+    """
+    Point-in-time recovery - bring the database to the state it had at the timestamp (ISO format, e.g. 2024-05-01T20:00:00).
+    The differences are recorded as changes, so the restore can be undone by another restore. Files of activities are not restored.
+    """
+    journal = get_journal()
+    header, changes = journal.read()
+    if not journal.exists() or timestamp < header['base_time']:
+        logger.error(f"Cannot restore the database to {timestamp}, the oldest available state is from {header['base_time']}")
+        return
+
+    rows = {int(row['activity_id']): row for row in iter_rows(config['storage']['activities-snapshot'])}
+    target = apply_changes(rows, [change for change in changes if change['time'] <= timestamp])
+    current = {int(row['activity_id']): row for row in iter_database_rows()}
+
+    restore_changes = [(JOURNAL_DELETE, activity_id, None) for activity_id in current if activity_id not in target]
+    restore_changes += [(JOURNAL_UPDATE if activity_id in current else JOURNAL_INSERT, activity_id, row)
+                        for activity_id, row in target.items() if current.get(activity_id) != row]
+    logger.info(f"Restoring the database to {timestamp}: {len(restore_changes)} activities changed")
+    if restore_changes:
+        journal.append(restore_changes + [(JOURNAL_SORT, None, None)])
+        compact_database()
+        restored_ids = {activity_id for op, activity_id, _ in restore_changes if op != JOURNAL_DELETE}
+        update_derived_data([activity for activity in iter_activities_from_csv() if activity.activity_id in restored_ids])
 
 
 def resort_database():
     logger.info("Re-sorting the database")
-    activities = load_and_backup()
-    sorted_activities = sorted(activities, key=lambda activity: (activity.date, activity.activity_id))
-    write_database(sorted_activities, config['storage']['activities-database'])
+    get_journal().append([(JOURNAL_SORT, None, None)])
+    compact_database()
 
 
 def delete_activity(activity_id):
     logger.info(f"Deleting activity {activity_id}")
-    activities = load_and_backup()
-    activity = next((activity for activity in activities if activity.activity_id == activity_id), None)
+    activity = next((activity for activity in iter_activities_from_csv() if activity.activity_id == activity_id), None)
 
     if not activity:
         logger.warning(f"Activity not found in the database. Nothing deleted")
         return
 
-    activities.remove(activity)
     delete_activity_files(activity)
-    write_database(activities, config['storage']['activities-database'])
+    archive.remove(activity)
+    record_changes([(JOURNAL_DELETE, activity_id, None)])
+    update_derived_data()
 
 
 def delete_activity_files(activity: Activity):
@@ -147,14 +472,17 @@ def delete_activity_files(activity: Activity):
     if os.path.exists(activity.gpx_filename):
         logger.info(f"Deleting {activity.gpx_filename}")
         os.remove(activity.gpx_filename)
+    if os.path.exists(activity.fit_filename):
+        logger.info(f"Deleting {activity.fit_filename}")
+        os.remove(activity.fit_filename)
     if os.path.exists(activity.json_filename):
         logger.info(f"Deleting {activity.json_filename}")
         os.remove(activity.json_filename)
 
 
 def update_activity(new_activity: Activity):
-    activities = load_and_backup()
-    old_activity = next((activity for activity in activities if activity.activity_id == new_activity.activity_id), None)
+    old_activity = next((activity for activity in iter_activities_from_csv() if activity.activity_id == new_activity.activity_id),
+                        None)
 
     if not old_activity:
         logger.warning(f"Activity not found in the database. Nothing to be updated")
@@ -164,9 +492,28 @@ def update_activity(new_activity: Activity):
     if old_activity.date != new_activity.date or old_activity.activity_type != new_activity.activity_type:
         delete_activity_files(old_activity)
 
-    # replace the activity with the new version and save the DB
+    # the new version takes place of the old one in the DB
     # it is not expected that date of the activity would change. If it does, make sure to re-sort the DB
     logger.info(f"Replacing {str(old_activity)} with {str(new_activity)}")
-    index = activities.index(old_activity)
-    activities[index] = new_activity
-    write_database(activities, config['storage']['activities-database'])
+    update_activities([new_activity])
+    update_derived_data([new_activity])
+
+
+def update_derived_data(activities=()):
+    """
+    Bring data derived from the database - the spatial index, explored tiles and the heatmap - in line with it after any change,
+    so that the map never shows a deleted activity. Activities no longer in the database are dropped from them.
+    activities - optional. New or changed activities to (re)compute, their coordinates are loaded when needed
+    """
+    # imported here as they depend on storage
+    import explorertiles
+    import heatmap
+    import spatialindex
+
+    existing_ids = {activity.activity_id for activity in iter_activities_from_csv()}
+    for activity in activities:
+        if not activity.coordinates and activity.has_gps_data:
+            activity.load_coordinates()
+    spatialindex.update_index(activities, existing_ids)
+    explorertiles.update_store(activities, existing_ids)
+    heatmap.update_heatmap(activities, existing_ids)
@@ -0,0 +1,24 @@
+"""
+Tests run on config-default.toml only, so that a config-local.toml of the developer running them does not change the results. All
+storage and output paths point to a temporary directory of the test.
+"""
+import os
+import sys
+import tomllib
+
+import pytest
+
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIRECTORY)
+
+from benchmarks.run import configure_scratch_directory  # noqa: E402
+from common import config  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def default_config(tmp_path):
+    with open(os.path.join(ROOT_DIRECTORY, "config-default.toml"), "rb") as default_file:
+        config.clear()
+        config.update(tomllib.load(default_file))
+    configure_scratch_directory(str(tmp_path))
+    return config
@@ -0,0 +1,104 @@
+"""
+Categorizer compiled into lookups (see categorization) gives the same categories as evaluating the mapping and the rules one by one,
+the way activities were categorized before the rules existed and as the config describes them.
+"""
+import random
+
+import pytest
+
+import storage
+from categorization import Categorizer, get_speed, get_type_mappings
+
+# rules of the kind consolidation.categorize_activities decided with
+RULES = [
+    {'category': "Other", 'name-contains': ["Praha 2-Nusle"]},
+    {'category': "Crosscountry", 'type-keys': ["running"], 'name-contains': ["Mariánské Hory", "Jizerka", "Kořenov"],
+     'months': [1, 2, 3, 12]},
+    {'category': "Inline", 'name-contains': ["Račice", "Opava", "Židlochovice"], 'min-speed': 12},
+    {'category': "Cycling", 'type-keys': ["running", "walking"], 'min-speed': 20},
+    {'category': "Skimo", 'type-keys': ["hiking"], 'date-from': "2015-01-01", 'date-to': "2015-03-31", 'max-distance': 15},
+    {'category': "Running", 'min-distance': 40, 'max-speed': 15},
+]
+NAMES = ["Praha 2-Nusle Running", "Jizerka", "Kořenov - Jizerka", "Evening Run", "Račice", "Opava Inline", "ŽIDLOCHOVICE",
+         "Mariánské Hory", ""]
+TYPE_KEYS = ["running", "walking", "hiking", "cycling", "inline_skating", "resort_skiing", "backcountry_skiing", "unknown_type"]
+
+
+def legacy_mapping(mappings, type_key):
+    """Category by type_key as it was looked up before the rules - the first mapping containing the type_key, else the first one"""
+    for mapping in mappings:
+        if mapping.contains_key(type_key):
+            return mapping
+    return mappings[0]
+
+
+def legacy_rule_matches(rule, activity):
+    month = int(activity.date[5:7])
+    speed = get_speed(activity)
+    return all([
+        'type-keys' not in rule or activity.activity_type in rule['type-keys'],
+        'name-contains' not in rule or any(pattern.lower() in activity.name.lower() for pattern in rule['name-contains']),
+        'date-from' not in rule or activity.date >= rule['date-from'],
+        'date-to' not in rule or activity.date <= rule['date-to'],
+        'months' not in rule or month in rule['months'],
+        'min-distance' not in rule or activity.distance >= rule['min-distance'],
+        'max-distance' not in rule or activity.distance <= rule['max-distance'],
+        'min-speed' not in rule or speed >= rule['min-speed'],
+        'max-speed' not in rule or speed <= rule['max-speed'],
+    ])
+
+
+def legacy_categorize(mappings, rules, activity):
+    for rule in rules:
+        if legacy_rule_matches(rule, activity):
+            return next(mapping for mapping in mappings if mapping.name == rule['category'])
+    return legacy_mapping(mappings, activity.activity_type)
+
+
+def generate_activities(count, seed=1):
+    rng = random.Random(seed)
+    activities = []
+    for activity_id in range(count):
+        date = f"{rng.randint(2013, 2016)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+        type_key = rng.choice(TYPE_KEYS)
+        activities.append(storage.Activity(activity_id, rng.uniform(0, 60), rng.uniform(0, 300), date, "10:00:00",
+                                           f"{date}_{type_key}_{activity_id}", False, type_key, rng.choice(NAMES)))
+    return activities
+
+
+def test_mapping_without_rules_matches_legacy_lookup(default_config):
+    mappings = get_type_mappings()
+    categorizer = Categorizer(mappings, [])
+    type_keys = {type_key for mapping in default_config['activities']['mapping'] for type_key in mapping['type_keys']}
+
+    for activity in generate_activities(200):
+        assert categorizer.categorize(activity) is legacy_mapping(mappings, activity.activity_type)
+    for type_key in sorted(type_keys) + ["unknown_type"]:
+        activity = storage.Activity(1, 10, 60, "2024-01-01", "10:00:00", "f", False, type_key, "")
+        assert categorizer.categorize(activity) is legacy_mapping(mappings, type_key)
+
+
+def test_rules_match_evaluation_one_by_one():
+    mappings = get_type_mappings()
+    categorizer = Categorizer(mappings, RULES)
+    activities = generate_activities(5000)
+
+    categories = [categorizer.categorize(activity) for activity in activities]
+    assert categories == [legacy_categorize(mappings, RULES, activity) for activity in activities]
+    # every rule is the first matching one for some of the activities
+    first_matches = {next((index for index, rule in enumerate(RULES) if legacy_rule_matches(rule, activity)), None)
+                     for activity in activities}
+    assert first_matches >= set(range(len(RULES)))
+
+
+def test_categorize_all_matches_categorize():
+    categorizer = Categorizer(get_type_mappings(), RULES)
+    activities = generate_activities(1000)
+
+    assert [mapping for _, mapping in categorizer.categorize_all(iter(activities))] == \
+        [categorizer.categorize(activity) for activity in activities]
+
+
+def test_rule_with_unknown_category():
+    with pytest.raises(ValueError):
+        Categorizer(get_type_mappings(), [{'category': "Rowing"}])
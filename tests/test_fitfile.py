@@ -0,0 +1,116 @@
+"""
+Decoding of positions from FIT files (see fitfile).
+
+data/activity.fit was written by the encoder of the official Garmin FIT SDK (garmin-fit-sdk 21.218): developer data id, field
+description, file id, device info, timer events, 30 record messages (one per second from 2024-05-01T08:00:00Z, position_lat and
+position_long stepping by 0.0001 and 0.0002 degrees from 50.0 and 14.4, records 10 and 11 without a position, each record with
+distance, heart rate, altitude and a developer heart rate field), lap, session and activity. The positions expected below were
+decoded by the SDK's decoder. Cases the SDK encoder does not write (compressed timestamp headers, big-endian definitions) are built
+by hand.
+"""
+import datetime
+import io
+import os
+import struct
+import zipfile
+
+import pytest
+
+import fitfile
+from benchmarks import synthetic
+
+FIXTURE = os.path.join(os.path.dirname(__file__), "data", "activity.fit")
+START_TIMESTAMP = int(datetime.datetime(2024, 5, 1, 8, 0, 0, tzinfo=datetime.timezone.utc).timestamp())
+FIT_START_TIMESTAMP = START_TIMESTAMP - fitfile.FIT_EPOCH
+
+
+def read_fixture():
+    with open(FIXTURE, "rb") as fit_file:
+        return fit_file.read()
+
+
+def to_semicircles(degrees):
+    return round(degrees * 2 ** 31 / 180)
+
+
+def build_fit(records):
+    """FIT file of the records (definition and data messages as bytes) with a 12 byte header"""
+    data = b''.join(records)
+    header = struct.pack('<BBHI4s', 12, 0x10, 2132, len(data), b'.FIT')
+    return header + data + struct.pack('<H', synthetic.fit_crc(header + data))
+
+
+def test_positions_of_sdk_encoded_file():
+    positions = fitfile.read_positions(read_fixture())
+
+    expected_indices = [index for index in range(30) if index not in (10, 11)]
+    assert len(positions) == len(expected_indices)
+    for (lat, lon, timestamp), index in zip(positions, expected_indices):
+        assert lat == pytest.approx(50.0 + index * 0.0001, abs=1e-7)
+        assert lon == pytest.approx(14.4 + index * 0.0002, abs=1e-7)
+        assert timestamp == START_TIMESTAMP + index
+
+
+def test_stream_and_original_download_give_same_positions():
+    data = read_fixture()
+    with open(FIXTURE, "rb") as fit_file:
+        assert fitfile.read_positions(fit_file) == fitfile.read_positions(data)
+    original_download = synthetic.fit_to_original_download(123, data)
+    assert fitfile.extract_fit(original_download) == data
+    assert fitfile.extract_fit(data) == data
+
+
+def test_chained_files():
+    data = read_fixture()
+    assert fitfile.read_positions(data + data) == fitfile.read_positions(data) * 2
+
+
+def test_compressed_timestamps_and_big_endian_definition():
+    records = [
+        # local message 0 - record with timestamp, position_lat and position_long, big-endian
+        struct.pack('>BBBHB', 0x40, 0, 1, 20, 3) + bytes([253, 4, 0x86, 0, 4, 0x85, 1, 4, 0x85]),
+        struct.pack('>BIii', 0x00, FIT_START_TIMESTAMP, to_semicircles(50.0), to_semicircles(14.4)),
+        # local message 1 - record with position only, its timestamp is in the compressed header
+        struct.pack('<BBBHB', 0x41, 0, 0, 20, 2) + bytes([0, 4, 0x85, 1, 4, 0x85]),
+    ]
+    # time offsets of 5 bits roll over every 32 seconds
+    offsets = [1, 20, 35]
+    for offset in offsets:
+        timestamp = FIT_START_TIMESTAMP + offset
+        records.append(struct.pack('<Bii', 0x80 | (1 << 5) | (timestamp & 0x1F), to_semicircles(50.0 + offset * 0.001),
+                                   to_semicircles(14.4)))
+
+    positions = fitfile.read_positions(build_fit(records))
+
+    assert [timestamp for _, _, timestamp in positions] == [START_TIMESTAMP] + [START_TIMESTAMP + offset for offset in offsets]
+    assert positions[0][0] == pytest.approx(50.0, abs=1e-7)
+    assert positions[-1][0] == pytest.approx(50.035, abs=1e-7)
+
+
+def test_record_without_timestamp():
+    records = [
+        struct.pack('<BBBHB', 0x40, 0, 0, 20, 2) + bytes([0, 4, 0x85, 1, 4, 0x85]),
+        struct.pack('<Bii', 0x00, to_semicircles(50.0), to_semicircles(14.4)),
+    ]
+    [(lat, lon, timestamp)] = fitfile.read_positions(build_fit(records))
+    assert timestamp is None
+
+
+@pytest.mark.parametrize("corrupt", [
+    lambda data: data[:len(data) // 2],
+    lambda data: data[:8] + b'.GPX' + data[12:],
+    lambda data: data[:14] + bytes([0x05]) + data[15:],
+])
+def test_corrupt_file(corrupt):
+    with pytest.raises(fitfile.FitError):
+        fitfile.read_positions(corrupt(read_fixture()))
+
+
+def test_archive_without_fit_file():
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zip_file:
+        zip_file.writestr("123_ACTIVITY.gpx", "<gpx/>")
+    with pytest.raises(fitfile.FitError):
+        fitfile.extract_fit(buffer.getvalue())
+    with pytest.raises(fitfile.FitError):
+        fitfile.extract_fit(buffer.getvalue()[:-10])
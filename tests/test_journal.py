@@ -0,0 +1,128 @@
+"""Replay of the journal of database changes, its compaction and point-in-time restore (see storage)"""
+import datetime
+import types
+
+import pytest
+
+import storage
+
+START = datetime.datetime(2024, 5, 1, 8, 0, 0)
+
+
+class Clock(datetime.datetime):
+    """datetime whose now() is set by the test, changes in the journal are timestamped by it"""
+    current = START
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls.current
+
+
+@pytest.fixture(autouse=True)
+def clock(monkeypatch):
+    Clock.current = START
+    monkeypatch.setattr(storage, "datetime", types.SimpleNamespace(datetime=Clock, timedelta=datetime.timedelta))
+    return Clock
+
+
+def create_activity(activity_id, date, name="Morning run", distance=5.0):
+    return storage.Activity(activity_id, distance, 30.0, date, "08:00:00", f"{date}_running_{activity_id}", False, "running", name)
+
+
+def get_state(filename=None):
+    return [(activity.activity_id, activity.name) for activity in storage.iter_activities_from_csv(filename)]
+
+
+def advance(clock, **kwargs):
+    clock.current += datetime.timedelta(**kwargs)
+    return clock.current.isoformat(timespec='seconds')
+
+
+@pytest.fixture
+def database():
+    storage.write_database([create_activity(1, "2024-04-01"), create_activity(2, "2024-04-02"), create_activity(3, "2024-04-03")])
+
+
+def test_changes_are_replayed_without_writing_database(database, clock):
+    advance(clock, seconds=1)
+    storage.insert_activity(create_activity(4, "2024-04-04"))
+    storage.update_activities([create_activity(2, "2024-04-02", name="Evening run")])
+    storage.record_changes([(storage.JOURNAL_DELETE, 1, None)])
+
+    assert get_state() == [(2, "Evening run"), (3, "Morning run"), (4, "Morning run")]
+    database_filename = storage.config['storage']['activities-database']
+    assert get_state(database_filename) == [(1, "Morning run"), (2, "Morning run"), (3, "Morning run")]
+
+
+def test_activity_deleted_and_inserted_again_moves_to_end(database, clock):
+    advance(clock, seconds=1)
+    storage.record_changes([(storage.JOURNAL_DELETE, 1, None)])
+    storage.insert_activity(create_activity(1, "2024-04-01", name="Re-downloaded"))
+
+    assert get_state() == [(2, "Morning run"), (3, "Morning run"), (1, "Re-downloaded")]
+
+
+def test_sort_restores_order_by_date(database, clock):
+    advance(clock, seconds=1)
+    storage.insert_activity(create_activity(5, "2024-03-01"))
+    storage.resort_database()
+
+    assert [activity_id for activity_id, _ in get_state()] == [5, 1, 2, 3]
+
+
+def test_compaction_writes_changes_into_database(database, clock, default_config):
+    default_config['journal']['compact-after-changes'] = 2
+    advance(clock, seconds=1)
+    storage.insert_activity(create_activity(4, "2024-04-04"))
+    storage.update_activities([create_activity(3, "2024-04-03", name="Evening run")])
+
+    database_filename = default_config['storage']['activities-database']
+    assert get_state(database_filename) == [(1, "Morning run"), (2, "Morning run"), (3, "Evening run"), (4, "Morning run")]
+    header, changes = storage.get_journal().read()
+    assert header['seq'] == changes[-1]['seq'] == 2
+    assert get_state() == get_state(database_filename)
+
+
+def test_compaction_folds_expired_changes_into_snapshot(database, clock, default_config):
+    default_config['journal']['retention-days'] = 1
+    advance(clock, seconds=1)
+    storage.update_activities([create_activity(1, "2024-04-01", name="Old change")])
+    expired_time = clock.current.isoformat(timespec='seconds')
+    advance(clock, days=2)
+    storage.update_activities([create_activity(2, "2024-04-02", name="Recent change")])
+    storage.compact_database()
+
+    header, changes = storage.get_journal().read()
+    assert [change['activity_id'] for change in changes] == [2]
+    assert header['base_seq'] == 1
+    assert header['base_time'] == expired_time
+    snapshot_filename = default_config['storage']['activities-snapshot']
+    assert get_state(snapshot_filename) == [(1, "Old change"), (2, "Morning run"), (3, "Morning run")]
+    assert get_state() == [(1, "Old change"), (2, "Recent change"), (3, "Morning run")]
+
+
+def test_restore_to_point_in_time(database, clock):
+    advance(clock, seconds=1)
+    storage.update_activities([create_activity(1, "2024-04-01", name="First change")])
+    first_change_time = clock.current.isoformat(timespec='seconds')
+    before_restore = advance(clock, minutes=1)
+    storage.record_changes([(storage.JOURNAL_DELETE, 2, None)])
+    storage.insert_activity(create_activity(4, "2024-04-04"))
+    state_before_restore = get_state()
+
+    advance(clock, minutes=1)
+    storage.restore_database(first_change_time)
+    assert get_state() == [(1, "First change"), (2, "Morning run"), (3, "Morning run")]
+
+    # the restore is recorded as changes, so another restore undoes it
+    advance(clock, minutes=1)
+    storage.restore_database(before_restore)
+    assert sorted(get_state()) == sorted(state_before_restore)
+
+
+def test_restore_before_oldest_state_changes_nothing(database, clock):
+    advance(clock, seconds=1)
+    storage.update_activities([create_activity(1, "2024-04-01", name="First change")])
+
+    storage.restore_database((START - datetime.timedelta(days=1)).isoformat(timespec='seconds'))
+    assert get_state() == [(1, "First change"), (2, "Morning run"), (3, "Morning run")]
@@ -0,0 +1,104 @@
+"""Removal of GPS spikes and splitting of tracks at gaps (see trackcleaner)"""
+import pytest
+
+import trackcleaner
+
+# about 5 m north per point
+STEP = 0.00005
+
+
+@pytest.fixture(autouse=True)
+def cleaning_enabled(default_config):
+    default_config['cleaning']['enabled'] = True
+
+
+def straight_track(count, start_lat=50.0, start_time=0):
+    return [(start_lat + index * STEP, 14.4, start_time + index) for index in range(count)]
+
+
+def test_disabled_by_default(default_config):
+    default_config['cleaning']['enabled'] = False
+    track = straight_track(20)
+    track[10] = (51.0, 14.4, 10)
+
+    [part], result = trackcleaner.clean(track, "running")
+    assert len(part) == 20
+    assert result.removed_points == 0
+
+
+def test_empty_track():
+    [part], result = trackcleaner.clean([], "running")
+    assert len(part) == 0
+    assert (result.removed_points, result.parts) == (0, 1)
+
+
+def test_short_track_kept():
+    [part], result = trackcleaner.clean(straight_track(2), "running")
+    assert len(part) == 2
+    assert result.removed_points == 0
+
+
+def test_clean_track_unchanged():
+    [part], result = trackcleaner.clean(straight_track(50), "running")
+    assert len(part) == 50
+    assert (result.removed_points, result.parts) == (0, 1)
+
+
+@pytest.mark.parametrize("with_timestamps", [True, False])
+def test_spike_removed(with_timestamps):
+    track = straight_track(20)
+    track[7] = (50.1, 14.4, 7)
+    if not with_timestamps:
+        track = [(lat, lon, None) for lat, lon, _ in track]
+
+    [part], result = trackcleaner.clean(track, "running")
+    assert len(part) == 19
+    assert 50.1 not in part[:, 0]
+    assert (result.removed_points, result.parts) == (1, 1)
+
+
+def test_all_spike_track():
+    """Every point is far from the previous one - no part is plausible, the track is kept as its longest part instead of none"""
+    track = [(50.0 if index % 2 else 50.5, 14.4, index) for index in range(20)]
+
+    [part], result = trackcleaner.clean(track, "running")
+    assert len(part) == 1
+    assert (result.removed_points, result.parts) == (19, 1)
+
+
+def test_single_split():
+    """Recording resumed 3 km further after a pause - two parts, nothing removed"""
+    track = straight_track(10) + straight_track(10, start_lat=50.03, start_time=1000)
+
+    parts, result = trackcleaner.clean(track, "running")
+    assert [len(part) for part in parts] == [10, 10]
+    assert (result.removed_points, result.parts) == (0, 2)
+    coordinates, breaks = trackcleaner.join_parts(parts)
+    assert len(coordinates) == 20
+    assert breaks == [10]
+
+
+def test_split_at_implausible_speed():
+    """A jump shorter than split-distance-m but too fast for the activity type splits the track too"""
+    track = straight_track(10) + straight_track(10, start_lat=50.0 + 9 * STEP + 0.005, start_time=10)
+
+    parts, _ = trackcleaner.clean(track, "running")
+    assert [len(part) for part in parts] == [10, 10]
+
+
+def test_short_part_dropped(default_config):
+    track = straight_track(10) + straight_track(3, start_lat=50.03, start_time=1000)
+
+    [part], result = trackcleaner.clean(track, "running")
+    assert len(part) == 10
+    assert (result.removed_points, result.parts) == (3, 1)
+    assert default_config['cleaning']['min-part-points'] > 3
+
+
+def test_points_without_position_removed():
+    track = straight_track(10)
+    track[4] = (0.0, 0.0, 4)
+
+    [part], result = trackcleaner.clean(track, "running")
+    assert len(part) == 9
+    assert result.removed_points == 1
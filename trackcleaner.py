@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Cleaning of full resolution tracks before they are simplified, see [cleaning].
+
+GPS glitches survive simplification - a single point far off the track (a spike) keeps two extra vertices and draws a long needle,
+a jump when recording resumes after an auto-pause or a signal loss draws a straight line across the map. With NumPy, speed and
+distance between consecutive points are computed for the whole track at once and
+ - spikes are removed .. points reached and left at a speed over the limit of the activity type ([cleaning][max-speed-kmh]).
+                         Tracks without timestamps use the distance instead (over split-distance-m in and out).
+ - tracks are split   .. at jumps which are still too fast or longer than split-distance-m. The parts are simplified separately and
+                         drawn as a multi-part line (Activity.breaks), parts shorter than min-part-points are dropped.
+Number of removed points and parts is recorded in the simplification report (see simplifier).
+"""
+from common import config
+
+METRES_PER_DEGREE = 111320
+SPIKE_PASSES = 3
+
+
+class CleaningResult:
+    def __init__(self, removed_points=0, parts=0):
+        self.removed_points = removed_points
+        self.parts = parts
+
+
+def get_max_speed(activity_type):
+    """Max plausible speed in m/s for the activity type, [cleaning][max-speed-kmh] of the type or its default"""
+    speeds = config['cleaning']['max-speed-kmh']
+    return speeds.get(activity_type, speeds['default']) / 3.6
+
+
+def get_steps(points, timestamps):
+    """Distance (m) and speed (m/s, None without timestamps) from each point to the next one"""
+    import numpy as np
+
+    latitudes = np.radians(points[:, 0])
+    d_lat = np.diff(points[:, 0])
+    d_lon = np.diff(points[:, 1]) * np.cos((latitudes[1:] + latitudes[:-1]) / 2)
+    distances = np.hypot(d_lat, d_lon) * METRES_PER_DEGREE
+    if timestamps is None:
+        return distances, None
+    # several points recorded within the same second are treated as a second apart
+    return distances, distances / np.maximum(np.diff(timestamps), 1.0)
+
+
+def clean(track, activity_type=None):
+    """
+    Remove spikes and split the track at gaps.
+    track - list of (latitude, longitude, timestamp in seconds or None)
+    Returns (list of parts as NumPy arrays of (latitude, longitude), CleaningResult).
+    """
+    import numpy as np
+
+    points = np.array([(lat, lon) for lat, lon, _ in track], dtype=np.float64).reshape(-1, 2)
+    timestamps = None
+    if track and all(timestamp is not None for _, _, timestamp in track):
+        timestamps = np.array([timestamp for _, _, timestamp in track], dtype=np.float64)
+    if not config['cleaning']['enabled'] or len(points) < 3:
+        return [points], CleaningResult(0, 1)
+
+    cleaning_config = config['cleaning']
+    max_speed = get_max_speed(activity_type)
+    split_distance = cleaning_config['split-distance-m']
+    original_count = len(points)
+
+    # points without a position are of no use
+    valid = np.isfinite(points).all(axis=1) & ~((points[:, 0] == 0) & (points[:, 1] == 0))
+    if timestamps is not None:
+        valid &= np.isfinite(timestamps)
+    points = points[valid]
+    timestamps = timestamps[valid] if timestamps is not None else None
+
+    # removing a spike may uncover another one next to it. A cluster of several points off the track is not a spike, it ends up
+    # as a short part after the split below and gets dropped.
+    for _ in range(SPIKE_PASSES):
+        if len(points) < 3:
+            break
+        distances, speeds = get_steps(points, timestamps)
+        too_far = speeds > max_speed if speeds is not None else distances > split_distance
+        spikes = np.zeros(len(points), dtype=bool)
+        spikes[1:-1] = too_far[:-1] & too_far[1:]
+        if not spikes.any():
+            break
+        points = points[~spikes]
+        timestamps = timestamps[~spikes] if timestamps is not None else None
+
+    parts = [points]
+    if len(points) >= 2:
+        distances, speeds = get_steps(points, timestamps)
+        gaps = distances > split_distance
+        if speeds is not None:
+            gaps |= speeds > max_speed
+        parts = np.split(points, np.flatnonzero(gaps) + 1)
+    kept_parts = [part for part in parts if len(part) >= cleaning_config['min-part-points']]
+    # a track too short to be split is kept as it is
+    if not kept_parts:
+        kept_parts = [max(parts, key=len)]
+    removed_points = original_count - sum(len(part) for part in kept_parts)
+    return kept_parts, CleaningResult(removed_points, len(kept_parts))
+
+
+def join_parts(parts):
+    """Coordinates of the parts joined into one list and indices where the parts (except the first one) start"""
+    coordinates = []
+    breaks = []
+    for part in parts:
+        if coordinates:
+            breaks.append(len(coordinates))
+        coordinates.extend(part)
+    return coordinates, breaks